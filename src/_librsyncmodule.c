@@ -25,6 +25,10 @@
 #include <librsync.h>
 #define RSM_JOB_BLOCKSIZE 65536
 
+/* Historic signature format of rdiff-backup, used if none is given */
+#define RSM_MD4_SIG_MAGIC 0x72730136
+#define RSM_DEFAULT_STRONG_LEN 8
+
 static PyObject *librsyncError;
 
 /* Sets python error string from result */
@@ -36,6 +40,82 @@ _librsync_seterror(rs_result result, char *location)
   PyErr_SetString(librsyncError, error_string);
 }
 
+/* Run one step of a librsync job without holding the GIL, so that
+   several jobs can work in parallel from Python threads.  The input
+   buffer is pinned through the buffer protocol and the output buffer
+   lives on the stack of the calling thread, hence only the job itself
+   needs to be protected by a lock against concurrent cycles. */
+static rs_result
+_librsync_job_iter(rs_job_t *job, PyThread_type_lock lock,
+                   rs_buffers_t *buf)
+{
+  rs_result result;
+
+  Py_BEGIN_ALLOW_THREADS
+  PyThread_acquire_lock(lock, WAIT_LOCK);
+  result = rs_job_iter(job, buf);
+  PyThread_release_lock(lock);
+  Py_END_ALLOW_THREADS
+  return result;
+}
+
+/* Feed the input buffer of args to the job, and return a triple
+   (done, bytes_used, output_string), where done is true if the job
+   is finished and bytes_used is the number of input bytes processed.
+   An empty input buffer signals the end of the input.
+
+   If a writable output buffer is given as second argument, the output
+   is written into it instead of being copied into a new string, and
+   the third element of the triple is the number of bytes written.
+*/
+static PyObject *
+_librsync_job_cycle(rs_job_t *job, PyThread_type_lock lock,
+                    PyObject *args, char *location)
+{
+  char stack_outbuf[RSM_JOB_BLOCKSIZE];
+  Py_buffer inbuf, outbuf;
+  Py_ssize_t inbuf_length, outbuf_length;
+  int has_outbuf;
+  rs_buffers_t buf;
+  rs_result result;
+
+  outbuf.obj = NULL;
+  if (!PyArg_ParseTuple(args, "y*|w*:cycle", &inbuf, &outbuf))
+	return NULL;
+  has_outbuf = (outbuf.obj != NULL);
+
+  inbuf_length = inbuf.len;
+  buf.next_in = inbuf.buf;
+  buf.avail_in = (size_t)inbuf_length;
+  buf.eof_in = (inbuf_length == 0);
+  if (has_outbuf) {
+	outbuf_length = outbuf.len;
+	buf.next_out = outbuf.buf;
+  } else {
+	outbuf_length = RSM_JOB_BLOCKSIZE;
+	buf.next_out = stack_outbuf;
+  }
+  buf.avail_out = (size_t)outbuf_length;
+
+  result = _librsync_job_iter(job, lock, &buf);
+  PyBuffer_Release(&inbuf);
+  if (has_outbuf)
+	PyBuffer_Release(&outbuf);
+
+  if (result != RS_DONE && result != RS_BLOCKED) {
+	_librsync_seterror(result, location);
+	return NULL;
+  }
+
+  if (has_outbuf)
+	return Py_BuildValue("(inn)", (result == RS_DONE),
+			inbuf_length - (Py_ssize_t)buf.avail_in,
+			outbuf_length - (Py_ssize_t)buf.avail_out);
+  return Py_BuildValue("(iny#)", (result == RS_DONE),
+		  inbuf_length - (Py_ssize_t)buf.avail_in,
+		  stack_outbuf, outbuf_length - (Py_ssize_t)buf.avail_out);
+}
+
 
 /* --------------- SigMaker Object for incremental signatures */
 static PyTypeObject _librsync_SigMakerType;
@@ -44,35 +124,85 @@ typedef struct {
   PyObject_HEAD
   PyObject *x_attr;
   rs_job_t *sig_job;
+  PyThread_type_lock lock;
 } _librsync_SigMakerObject;
 
+/* Set the signature format to use given the magic number and strong
+   sum length passed from Python, zero standing for the historic
+   default.  Return -1 and set an exception if the format can't be
+   produced by this librsync version. */
+static int
+_librsync_get_sig_format(unsigned int *magic, Py_ssize_t *strong_len)
+{
+#ifdef RS_DEFAULT_STRONG_LEN
+  /* librsync before 1.0 only knows MD4 signatures */
+  if (*magic != 0 && *magic != RSM_MD4_SIG_MAGIC) {
+	PyErr_SetString(librsyncError,
+					"signature format not supported by this librsync");
+	return -1;
+  }
+  *magic = RSM_MD4_SIG_MAGIC;
+  if (*strong_len == 0)
+	*strong_len = RS_DEFAULT_STRONG_LEN;
+#else
+  if (*magic == 0)
+	*magic = RSM_MD4_SIG_MAGIC;
+  if (*strong_len == 0)
+	*strong_len = RSM_DEFAULT_STRONG_LEN;
+#endif
+  return 0;
+}
+
+/* Call with the block length, and optionally the strong sum length and
+   the magic number of the signature format */
 static PyObject*
 _librsync_new_sigmaker(PyObject* self, PyObject* args)
 {
   _librsync_SigMakerObject* sm;
-  Py_ssize_t blocklen;
+  Py_ssize_t blocklen, strong_len = 0;
+  unsigned int magic = 0;
 
-  if (!PyArg_ParseTuple(args, "l:new_sigmaker", &blocklen))
+  if (!PyArg_ParseTuple(args, "l|nI:new_sigmaker",
+						&blocklen, &strong_len, &magic))
+	return NULL;
+  if (_librsync_get_sig_format(&magic, &strong_len) < 0)
 	return NULL;
 
   sm = PyObject_New(_librsync_SigMakerObject, &_librsync_SigMakerType);
   if (sm == NULL) return NULL;
   sm->x_attr = NULL;
+  sm->lock = PyThread_allocate_lock();
+  if (sm->lock == NULL) {
+	sm->sig_job = NULL;
+	Py_DECREF(sm);
+	return PyErr_NoMemory();
+  }
 
 #ifdef RS_DEFAULT_STRONG_LEN
-  sm->sig_job = rs_sig_begin((size_t)blocklen,
-                (size_t)RS_DEFAULT_STRONG_LEN);
+  sm->sig_job = rs_sig_begin((size_t)blocklen, (size_t)strong_len);
 #else
-  sm->sig_job = rs_sig_begin((size_t)blocklen,
-                (size_t)8, RS_MD4_SIG_MAGIC);
+  sm->sig_job = rs_sig_begin((size_t)blocklen, (size_t)strong_len,
+                             (rs_magic_number)magic);
 #endif
+  if (sm->sig_job == NULL) {
+	/* librsync before 2.2 doesn't know all signature formats */
+	Py_DECREF(sm);
+	PyErr_SetString(librsyncError,
+					"signature format not supported by this librsync");
+	return NULL;
+  }
   return (PyObject*)sm;
 }
 
 static void
 _librsync_sigmaker_dealloc(PyObject* self)
 {
-  rs_job_free(((_librsync_SigMakerObject *)self)->sig_job);
+  _librsync_SigMakerObject *sm = (_librsync_SigMakerObject *)self;
+
+  if (sm->sig_job != NULL)
+	rs_job_free(sm->sig_job);
+  if (sm->lock != NULL)
+	PyThread_free_lock(sm->lock);
   PyObject_Del(self);
 }
 
@@ -84,30 +214,8 @@ _librsync_sigmaker_dealloc(PyObject* self)
 static PyObject *
 _librsync_sigmaker_cycle(_librsync_SigMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RSM_JOB_BLOCKSIZE];
-  Py_ssize_t inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "y#:cycle", &inbuf, &inbuf_length))
-	return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RSM_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->sig_job, &buf);
-
-  if (result != RS_DONE && result != RS_BLOCKED) {
-	_librsync_seterror(result, "signature cycle");
-	return NULL;
-  }
-
-  return Py_BuildValue("(iny#)", (result == RS_DONE),
-		  (Py_ssize_t)inbuf_length - (Py_ssize_t)buf.avail_in,
-		  outbuf, (Py_ssize_t)RSM_JOB_BLOCKSIZE - (Py_ssize_t)buf.avail_out);
+  return _librsync_job_cycle(self->sig_job, self->lock, args,
+                             "signature cycle");
 }
 
 static PyMethodDef _librsync_sigmaker_methods[] = {
@@ -192,45 +300,83 @@ typedef struct {
   PyObject_HEAD
   PyObject *x_attr;
   rs_job_t *delta_job;
+  rs_job_t *sig_loader;
   rs_signature_t *sig_ptr;
+  PyThread_type_lock lock;
 } _librsync_DeltaMakerObject;
 
-/* Call with the entire signature loaded into one big string */
+/* Build the hash table of the loaded signature and start the delta job,
+   must be called without the GIL.  The hash table can take a while for
+   big signatures. */
+static rs_result
+_librsync_deltamaker_start(_librsync_DeltaMakerObject *dm, char **location)
+{
+  rs_result result;
+
+  *location = "delta rs_build_hash_table";
+  result = rs_build_hash_table(dm->sig_ptr);
+  if (result == RS_DONE)
+	dm->delta_job = rs_delta_begin(dm->sig_ptr);
+  return result;
+}
+
+/* Call either with the entire signature loaded into one big string, or
+   without argument, in which case the signature has to be fed in
+   chunks to the load_sig() method before the first cycle(). */
 static PyObject*
 _librsync_new_deltamaker(PyObject* self, PyObject* args)
 {
   _librsync_DeltaMakerObject* dm;
-  char *sig_string, outbuf[RSM_JOB_BLOCKSIZE];
-  Py_ssize_t sig_length;
-  rs_job_t *sig_loader;
-  rs_signature_t *sig_ptr;
+  char *location;
+  Py_buffer sig_string;
   rs_buffers_t buf;
   rs_result result;
-  if (!PyArg_ParseTuple(args,"y#:new_deltamaker", &sig_string, &sig_length))
+  PyThread_type_lock lock;
+
+  sig_string.obj = NULL;
+  if (!PyArg_ParseTuple(args,"|y*:new_deltamaker", &sig_string))
 	return NULL;
+  lock = PyThread_allocate_lock();
+  if (lock == NULL) {
+	if (sig_string.obj != NULL)
+	  PyBuffer_Release(&sig_string);
+	return PyErr_NoMemory();
+  }
   dm = PyObject_New(_librsync_DeltaMakerObject, &_librsync_DeltaMakerType);
-  if (dm == NULL) return NULL;
+  if (dm == NULL) {
+	if (sig_string.obj != NULL)
+	  PyBuffer_Release(&sig_string);
+	PyThread_free_lock(lock);
+	return NULL;
+  }
   dm->x_attr = NULL;
-  /* Put signature at sig_ptr and build hash */
-  sig_loader = rs_loadsig_begin(&sig_ptr);
-  buf.next_in = sig_string;
-  buf.avail_in = (size_t)sig_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RSM_JOB_BLOCKSIZE;
+  dm->lock = lock;
+  dm->sig_ptr = NULL;
+  dm->delta_job = NULL;
+  dm->sig_loader = rs_loadsig_begin(&dm->sig_ptr);
+  if (sig_string.obj == NULL)
+	return (PyObject*)dm;
+
+  /* Put the whole signature at sig_ptr at once */
+  Py_BEGIN_ALLOW_THREADS
+  buf.next_in = sig_string.buf;
+  buf.avail_in = (size_t)sig_string.len;
+  buf.next_out = NULL;
+  buf.avail_out = 0;
   buf.eof_in = 1;
-  result = rs_job_iter(sig_loader, &buf);
-  rs_job_free(sig_loader);
+  result = rs_job_iter(dm->sig_loader, &buf);
+  rs_job_free(dm->sig_loader);
+  dm->sig_loader = NULL;
+  location = "delta rs_signature_t builder";
+  if (result == RS_DONE)
+	result = _librsync_deltamaker_start(dm, &location);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&sig_string);
   if (result != RS_DONE) {
-	_librsync_seterror(result, "delta rs_signature_t builder");
+	Py_DECREF(dm);
+	_librsync_seterror(result, location);
 	return NULL;
   }
-  if ((result = rs_build_hash_table(sig_ptr)) != RS_DONE) {
-	_librsync_seterror(result, "delta rs_build_hash_table");
-	return NULL;
-  }
-
-  dm->sig_ptr = sig_ptr;
-  dm->delta_job = rs_delta_begin(sig_ptr);
   return (PyObject*)dm;
 }
 
@@ -238,48 +384,87 @@ static void
 _librsync_deltamaker_dealloc(PyObject* self)
 {
   _librsync_DeltaMakerObject *dm = (_librsync_DeltaMakerObject *)self;
-  rs_signature_t *sig_ptr = dm->sig_ptr;
 
-  rs_free_sumset(sig_ptr);
-  rs_job_free(dm->delta_job);
+  if (dm->sig_loader != NULL)
+	rs_job_free(dm->sig_loader);
+  if (dm->delta_job != NULL)
+	rs_job_free(dm->delta_job);
+  if (dm->sig_ptr != NULL)
+	rs_free_sumset(dm->sig_ptr);
+  if (dm->lock != NULL)
+	PyThread_free_lock(dm->lock);
   PyObject_Del(self);
 }
 
-/* Take a chunk of the new file in an input string, and return a
-   triple (done bytes_used, delta_string), where done is true iff no
-   more data is coming and bytes_used is the number of bytes of the
-   input string processed.
+/* Feed a chunk of the signature to a deltamaker created without one,
+   an empty chunk signals the end of the signature.  Only the parsed
+   signature is kept in memory, not the string it was loaded from.
+   Return the number of bytes of the chunk used, which is all of them
+   as long as the signature isn't complete.
 */
 static PyObject *
-_librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
+_librsync_deltamaker_load_sig(_librsync_DeltaMakerObject *self,
+                              PyObject *args)
 {
-  char *inbuf, outbuf[RSM_JOB_BLOCKSIZE];
+  Py_buffer inbuf;
   Py_ssize_t inbuf_length;
   rs_buffers_t buf;
   rs_result result;
+  char *location = "delta rs_signature_t builder";
 
-  if (!PyArg_ParseTuple(args, "y#:cycle", &inbuf, &inbuf_length))
+  if (!PyArg_ParseTuple(args, "y*:load_sig", &inbuf))
 	return NULL;
+  if (self->sig_loader == NULL) {
+	PyBuffer_Release(&inbuf);
+	PyErr_SetString(librsyncError, "signature already loaded");
+	return NULL;
+  }
 
-  buf.next_in = inbuf;
+  inbuf_length = inbuf.len;
+  buf.next_in = inbuf.buf;
   buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RSM_JOB_BLOCKSIZE;
+  buf.next_out = NULL;
+  buf.avail_out = 0;
   buf.eof_in = (inbuf_length == 0);
 
-  result = rs_job_iter(self->delta_job, &buf);
+  Py_BEGIN_ALLOW_THREADS
+  PyThread_acquire_lock(self->lock, WAIT_LOCK);
+  result = rs_job_iter(self->sig_loader, &buf);
+  if (result == RS_DONE) {
+	rs_job_free(self->sig_loader);
+	self->sig_loader = NULL;
+	result = _librsync_deltamaker_start(self, &location);
+  }
+  PyThread_release_lock(self->lock);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&inbuf);
+
   if (result != RS_DONE && result != RS_BLOCKED) {
-	_librsync_seterror(result, "delta cycle");
+	_librsync_seterror(result, location);
 	return NULL;
   }
+  return PyLong_FromSsize_t(inbuf_length - (Py_ssize_t)buf.avail_in);
+}
 
-  return Py_BuildValue("(iny#)", (result == RS_DONE),
-		  (Py_ssize_t)inbuf_length - (Py_ssize_t)buf.avail_in,
-		  outbuf, (Py_ssize_t)RSM_JOB_BLOCKSIZE - (Py_ssize_t)buf.avail_out);
+/* Take a chunk of the new file in an input string, and return a
+   triple (done bytes_used, delta_string), where done is true iff no
+   more data is coming and bytes_used is the number of bytes of the
+   input string processed.
+*/
+static PyObject *
+_librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
+{
+  if (self->delta_job == NULL) {
+	PyErr_SetString(librsyncError, "signature not completely loaded");
+	return NULL;
+  }
+  return _librsync_job_cycle(self->delta_job, self->lock, args,
+                             "delta cycle");
 }
 
 static PyMethodDef _librsync_deltamaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_deltamaker_cycle, METH_VARARGS},
+  {"load_sig", (PyCFunction)_librsync_deltamaker_load_sig, METH_VARARGS},
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
@@ -368,6 +553,7 @@ typedef struct {
   rs_job_t *patch_job;
   FILE *patch_file;
   PyObject *basis_file;
+  PyThread_type_lock lock;
 } _librsync_PatchMakerObject;
 
 /* Call with the basis file */
@@ -387,20 +573,35 @@ _librsync_new_patchmaker(PyObject* self, PyObject* args)
   Py_INCREF(python_file);
 
   pm = PyObject_New(_librsync_PatchMakerObject, &_librsync_PatchMakerType);
-  if (pm == NULL) return NULL;
+  if (pm == NULL) {
+	Py_DECREF(python_file);
+	return NULL;
+  }
   pm->x_attr = NULL;
 
   pm->basis_file = python_file;
+  pm->patch_job = NULL;
+  pm->patch_file = NULL;
+  pm->lock = PyThread_allocate_lock();
+  if (pm->lock == NULL) {
+	Py_DECREF(pm);
+	return PyErr_NoMemory();
+  }
   /* We duplicate python_fd so that we will be able to call fclose()
      on our FILE* handle, avoiding any conflicts with the destruction
      of python_file. */
   int dup_fd = dup(python_fd);
   if (dup_fd < 0) {
-      return PyErr_SetFromErrno(librsyncError);
+	PyErr_SetFromErrno(librsyncError);
+	Py_DECREF(pm);
+	return NULL;
   }
   pm->patch_file = fdopen(dup_fd, "rb"); /* same mode as in the Python code */
   if (pm->patch_file == NULL) {
-      return PyErr_SetFromErrno(librsyncError);
+	PyErr_SetFromErrno(librsyncError);
+	close(dup_fd);
+	Py_DECREF(pm);
+	return NULL;
   }
   pm->patch_job = rs_patch_begin(rs_file_copy_cb, pm->patch_file);
 
@@ -412,8 +613,12 @@ _librsync_patchmaker_dealloc(PyObject* self)
 {
   _librsync_PatchMakerObject *pm = (_librsync_PatchMakerObject *)self;
   Py_DECREF(pm->basis_file);
-  rs_job_free(pm->patch_job);
-  fclose(pm->patch_file);
+  if (pm->patch_job != NULL)
+	rs_job_free(pm->patch_job);
+  if (pm->patch_file != NULL)
+	fclose(pm->patch_file);
+  if (pm->lock != NULL)
+	PyThread_free_lock(pm->lock);
   PyObject_Del(self);
 }
 
@@ -425,29 +630,8 @@ _librsync_patchmaker_dealloc(PyObject* self)
 static PyObject *
 _librsync_patchmaker_cycle(_librsync_PatchMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RSM_JOB_BLOCKSIZE];
-  Py_ssize_t inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "y#:cycle", &inbuf, &inbuf_length))
-	return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RSM_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->patch_job, &buf);
-  if (result != RS_DONE && result != RS_BLOCKED) {
-	_librsync_seterror(result, "patch cycle");
-	return NULL;
-  }
-
-  return Py_BuildValue("(iny#)", (result == RS_DONE),
-		  (Py_ssize_t)inbuf_length - (Py_ssize_t)buf.avail_in,
-		  outbuf, (Py_ssize_t)RSM_JOB_BLOCKSIZE - (Py_ssize_t)buf.avail_out);
+  return _librsync_job_cycle(self->patch_job, self->lock, args,
+                             "patch cycle");
 }
 
 static PyMethodDef _librsync_patchmaker_methods[] = {
@@ -524,6 +708,168 @@ static PyTypeObject _librsync_PatchMakerType = {
 };
 
 
+/* --------------- Whole file jobs
+
+   These run a complete signature, delta or patch job between file
+   descriptors, with large buffers and without going back to Python
+   for each block.  The descriptors are duplicated, so that the FILE*
+   handles can be closed without closing the files of the caller;
+   their positions are shared though, and move along.
+*/
+
+#define RSM_WHOLE_BUFSIZE (1024 * 1024)
+
+/* Open the count given file descriptors as FILE* handles in files.
+   Returns 0 on success, else -1 with errno set and no handle open. */
+static int
+_librsync_fdopen_all(int *fds, char **modes, FILE **files, int count)
+{
+  int i, dup_fd, saved_errno;
+
+  for (i = 0; i < count; i++) {
+	files[i] = NULL;
+	dup_fd = dup(fds[i]);
+	if (dup_fd >= 0) {
+	  files[i] = fdopen(dup_fd, modes[i]);
+	  if (files[i] == NULL) {
+		saved_errno = errno;
+		close(dup_fd);
+		errno = saved_errno;
+	  }
+	}
+	if (files[i] == NULL) {
+	  saved_errno = errno;
+	  while (i-- > 0)
+		fclose(files[i]);
+	  errno = saved_errno;
+	  return -1;
+	}
+  }
+  return 0;
+}
+
+/* Close the count handles in files, the output being the last one.
+   Returns -1 with errno set if the output couldn't be written. */
+static int
+_librsync_fclose_all(FILE **files, int count)
+{
+  int i;
+
+  for (i = 0; i < count - 1; i++)
+	fclose(files[i]);
+  return fclose(files[count - 1]) ? -1 : 0;
+}
+
+/* Return None or raise the error corresponding to a whole file job */
+static PyObject *
+_librsync_whole_result(rs_result result, int close_result, char *location)
+{
+  if (result != RS_DONE) {
+	_librsync_seterror(result, location);
+	return NULL;
+  }
+  if (close_result < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+  Py_RETURN_NONE;
+}
+
+/* Write the signature of the file basis_fd to sig_fd, in the format
+   given like to new_sigmaker */
+static PyObject *
+_librsync_sig_file(PyObject* self, PyObject* args)
+{
+  int fds[2];
+  char *modes[2] = {"rb", "wb"};
+  FILE *files[2];
+  Py_ssize_t blocklen, strong_len = 0;
+  unsigned int magic = 0;
+  rs_stats_t stats;
+  rs_result result;
+  int close_result;
+
+  if (!PyArg_ParseTuple(args, "iin|nI:sig_file", &fds[0], &fds[1],
+						&blocklen, &strong_len, &magic))
+	return NULL;
+  if (_librsync_get_sig_format(&magic, &strong_len) < 0)
+	return NULL;
+  if (_librsync_fdopen_all(fds, modes, files, 2) < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+
+  Py_BEGIN_ALLOW_THREADS
+#ifdef RS_DEFAULT_STRONG_LEN
+  result = rs_sig_file(files[0], files[1], (size_t)blocklen,
+                       (size_t)strong_len, &stats);
+#else
+  result = rs_sig_file(files[0], files[1], (size_t)blocklen,
+                       (size_t)strong_len, (rs_magic_number)magic, &stats);
+#endif
+  close_result = _librsync_fclose_all(files, 2);
+  Py_END_ALLOW_THREADS
+  return _librsync_whole_result(result, close_result, "signature file");
+}
+
+/* Write the delta of the file new_fd against the signature in sig_fd
+   to delta_fd */
+static PyObject *
+_librsync_delta_file(PyObject* self, PyObject* args)
+{
+  int fds[3];
+  char *modes[3] = {"rb", "rb", "wb"};
+  FILE *files[3];
+  char *location;
+  rs_signature_t *sig_ptr = NULL;
+  rs_stats_t stats;
+  rs_result result;
+  int close_result;
+
+  if (!PyArg_ParseTuple(args, "iii:delta_file", &fds[0], &fds[1], &fds[2]))
+	return NULL;
+  if (_librsync_fdopen_all(fds, modes, files, 3) < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+
+  Py_BEGIN_ALLOW_THREADS
+  location = "delta file rs_loadsig_file";
+  result = rs_loadsig_file(files[0], &sig_ptr, &stats);
+  if (result == RS_DONE) {
+	location = "delta file rs_build_hash_table";
+	result = rs_build_hash_table(sig_ptr);
+  }
+  if (result == RS_DONE) {
+	location = "delta file";
+	result = rs_delta_file(sig_ptr, files[1], files[2], &stats);
+  }
+  if (sig_ptr != NULL)
+	rs_free_sumset(sig_ptr);
+  close_result = _librsync_fclose_all(files, 3);
+  Py_END_ALLOW_THREADS
+  return _librsync_whole_result(result, close_result, location);
+}
+
+/* Write the result of applying the delta in delta_fd to the basis file
+   basis_fd to out_fd; basis_fd must be seekable */
+static PyObject *
+_librsync_patch_file(PyObject* self, PyObject* args)
+{
+  int fds[3];
+  char *modes[3] = {"rb", "rb", "wb"};
+  FILE *files[3];
+  rs_stats_t stats;
+  rs_result result;
+  int close_result;
+
+  if (!PyArg_ParseTuple(args, "iii:patch_file", &fds[0], &fds[1], &fds[2]))
+	return NULL;
+  if (_librsync_fdopen_all(fds, modes, files, 3) < 0)
+	return PyErr_SetFromErrno(PyExc_OSError);
+
+  Py_BEGIN_ALLOW_THREADS
+  result = rs_patch_file(files[0], files[1], files[2], &stats);
+  close_result = _librsync_fclose_all(files, 3);
+  Py_END_ALLOW_THREADS
+  return _librsync_whole_result(result, close_result, "patch file");
+}
+
+
 /* --------------- _librsync module definition */
 
 static PyMethodDef _librsyncMethods[] = {
@@ -533,6 +879,12 @@ static PyMethodDef _librsyncMethods[] = {
    "Return a deltamaker object, for computing deltas"},
   {"new_patchmaker", _librsync_new_patchmaker, METH_VARARGS,
    "Return a patchmaker object, for patching basis files"},
+  {"sig_file", _librsync_sig_file, METH_VARARGS,
+   "Write the signature of a basis file descriptor to another one"},
+  {"delta_file", _librsync_delta_file, METH_VARARGS,
+   "Write the delta of a file descriptor against a signature one"},
+  {"patch_file", _librsync_patch_file, METH_VARARGS,
+   "Write the patched basis file descriptor to another one"},
   {NULL, NULL, 0, NULL}
 };
 
@@ -548,6 +900,10 @@ PyMODINIT_FUNC PyInit__librsync(void)
   if (m == NULL)
     return NULL;
 
+  /* only used by the whole file jobs */
+  rs_inbuflen = RSM_WHOLE_BUFSIZE;
+  rs_outbuflen = RSM_WHOLE_BUFSIZE;
+
   d = PyModule_GetDict(m);
   librsyncError = PyErr_NewException("_librsync.librsyncError", NULL, NULL);
   PyDict_SetItemString(d, "librsyncError", librsyncError);
@@ -110,7 +110,7 @@ class QuotedRPath(rpath.RPath):
 def set_init_quote_vals():
     """Set quoting value from Globals on all conns"""
     for conn in Globals.connections:
-        conn.FilenameMapping.set_init_quote_vals_local()
+        conn.reval_async("FilenameMapping.set_init_quote_vals_local")
 
 
 # @API(set_init_quote_vals_local, 200)
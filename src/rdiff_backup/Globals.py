@@ -72,6 +72,58 @@ conn_bufsize = 393216
 # stuck in buffers when moving over a remote connection.
 pipeline_max_length = 500
 
+# Number of threads computing in advance the signatures of changed files
+# on the destination side.  With 1 (or less), each signature is computed
+# only when it is read from the pipeline.
+signature_workers = 1
+
+# Number of threads computing in advance the diffs of changed files on
+# the source side, and the maximum number of bytes they may hold in
+# memory (files too big are only read when needed).
+delta_workers = 1
+delta_buffer_size = 67108864
+
+# Files bigger than segment_size bytes (if not 0) have their signatures
+# and deltas computed in segments of about this size, by segment_workers
+# threads in parallel.  The signatures loaded at once to compute the deltas
+# of the segments of a file take at most segment_memory bytes, unless a
+# single one is bigger.
+segment_size = 0
+segment_workers = 4
+segment_memory = 268435456
+
+# Regular files smaller than small_file_size bytes (if not 0) are sent
+# without signature as whole snapshots, packed together in batches.
+small_file_size = 0
+
+# If true, the signatures of the mirror files are stored in the
+# rdiff-backup-data/signatures directory while they are written, so that
+# the next backup doesn't need to read them again (see sigcache module).
+signature_cache = None
+
+# Format of the mirror_metadata files written, "text" or "binary", the
+# latter being more compact and quicker to read, see metadata module.
+metadata_format = "text"
+
+# If true, the backup writes the metadata diff of the previous backup along
+# with the new snapshot, see metadata.PatchDiffMan.
+metadata_diffs = None
+
+# Maximum size in bytes of the metadata reconstructed from snapshots and
+# diffs cached in the repository, 0 to not cache it, see metadata module.
+metadata_cache_size = 268435456
+
+# If true, large metadata, extended attributes and ACL files are read
+# in processes of their own, in parallel to their consumer, as long as
+# no other thread runs in the forked process.
+metadata_processes = False
+
+# Format of the librsync signatures, one of librsync.SIG_FORMATS, and
+# the length of their strong sums.  None means the one recorded in the
+# repository, else the historic MD4 format with 8 bytes.
+signature_format = None
+signature_strong_len = None
+
 # True if script is running as a server
 server = None
 
@@ -235,6 +287,19 @@ null_separator = None
 # Determines whether or not ssh will be run with the -C switch
 ssh_compression = 1
 
+# If set to "zlib" or "lzma", the frames sent over remote connections are
+# compressed with this method at the given level, see connection module.
+connection_compression = None
+connection_compression_level = 6
+
+# Number of pipes to each remote process, the data of big files being
+# striped over the additional ones, see connection.DataChannel.
+connection_channels = 1
+
+# If true, the pipeline length and the buffer and block sizes are tuned
+# to the remote connections, see SetConnections.tune_connections.
+connection_tuning = None
+
 # If true, print statistics after successful backup
 print_statistics = None
 
@@ -394,7 +459,8 @@ def set_dict_val(name, key, val):
 def postset_regexp(name, re_string, flags=None):
     """Compile re_string on all existing connections, set to name"""
     for conn in connections:
-        conn.Globals.postset_regexp_local(name, re_string, flags)
+        conn.reval_async("Globals.postset_regexp_local",
+                         name, re_string, flags)
 
 
 # @API(postset_regexp_local, 200)
@@ -407,6 +473,7 @@ def postset_regexp_local(name, re_string, flags):
         globals()[name] = re.compile(re_string)
 
 
+# @API(set_api_version, 201)
 def set_api_version(val):
     """sets the actual API version after having verified that the new
     value is an integer between mix and max values."""
@@ -29,7 +29,7 @@ from .log import Log, LoggerError, ErrorLog
 from . import (
     Globals, Time, SetConnections, robust, rpath,
     manage, backup, connection, restore, FilenameMapping,
-    Security, C, statistics, compare
+    Security, C, statistics, compare, daemon
 )
 from rdiffbackup import arguments
 
@@ -40,6 +40,9 @@ _force = None
 _select_opts = []
 _select_files = []
 _user_mapping_filename, _group_mapping_filename, _preserve_numerical_ids = None, None, None
+_connection_statistics_filename = None
+_connection_measures = None  # (round trip time, bandwidth) if tuned
+_server_socket = None  # path of the Unix socket a server daemon listens on
 
 # These are global because they are set while we are trying to figure
 # whether to restore or to backup
@@ -230,6 +233,7 @@ def _parse_cmdlineoptions_compat200(arglist):  # noqa: C901
     global _remote_cmd, _remote_schema, _remove_older_than_string
     global _user_mapping_filename, _group_mapping_filename, \
         _preserve_numerical_ids
+    global _connection_statistics_filename, _server_socket
 
     def sel_fl(filename):
         """Helper function for including/excluding filelists below"""
@@ -279,6 +283,8 @@ def _parse_cmdlineoptions_compat200(arglist):  # noqa: C901
     elif arglist.action == "server":
         _action = "server"
         Globals.server = True
+        if arglist.listen:
+            _server_socket = os.fsencode(arglist.listen)
     elif arglist.action == "verify":
         if arglist.entity == "servers":
             _action = "test-server"
@@ -313,11 +319,31 @@ def _parse_cmdlineoptions_compat200(arglist):  # noqa: C901
     if arglist.action in ('backup'):
         Globals.set("file_statistics", arglist.file_statistics)
         Globals.set("print_statistics", arglist.print_statistics)
+        Globals.set("signature_cache", arglist.signature_cache)
+        Globals.set("signature_format", arglist.signature_format)
+        Globals.set("signature_strong_len", arglist.signature_strong_length)
+        Globals.set("signature_workers", arglist.signature_workers)
+        Globals.set("delta_workers", arglist.delta_workers)
+        Globals.set("delta_buffer_size", arglist.delta_buffer_size)
+        Globals.set("metadata_format", arglist.metadata_format)
+        Globals.set("metadata_diffs", arglist.metadata_diffs)
+        Globals.set("segment_memory", arglist.segment_memory)
+        Globals.set("segment_size", arglist.segment_size)
+        Globals.set("segment_workers", arglist.segment_workers)
+        Globals.set("small_file_size", arglist.small_file_size)
     Globals.set("null_separator", arglist.null_separator)
     Globals.set("parsable_output", arglist.parsable_output)
     Globals.set("ssh_compression", arglist.ssh_compression)
+    Globals.set("connection_compression", arglist.connection_compression)
+    Globals.set("connection_compression_level",
+                arglist.connection_compression_level)
+    Globals.set("connection_channels", arglist.connection_channels)
+    Globals.set("connection_tuning", arglist.connection_tuning)
+    _connection_statistics_filename = arglist.connection_statistics
     Globals.set("use_compatible_timestamps", arglist.use_compatible_timestamps)
     Globals.set("do_fsync", arglist.fsync)
+    Globals.set("metadata_cache_size", arglist.metadata_cache_size)
+    Globals.set("metadata_processes", arglist.metadata_processes)
     if arglist.current_time is not None:
         Globals.set_integer('current_time', arglist.current_time)
     if arglist.chars_to_quote is not None:
@@ -391,14 +417,18 @@ def _commandline_error(message):
 
 def _misc_setup(rps):
     """Set default change ownership flag, umask, relay regexps"""
+    global _connection_measures
     os.umask(0o77)
     Time.setcurtime(Globals.current_time)
     SetConnections.UpdateGlobal("client_conn", Globals.local_connection)
+    if Globals.connection_tuning:
+        _connection_measures = SetConnections.tune_connections()
     Globals.postset_regexp('no_compression_regexp',
                            Globals.no_compression_regexp_string)
     for conn in Globals.connections:
-        conn.robust.install_signal_handlers()
-        conn.Hardlink.initialize_dictionaries()
+        with conn.batch():
+            conn.reval_async("robust.install_signal_handlers")
+            conn.reval_async("Hardlink.initialize_dictionaries")
 
 
 def _init_user_group_mapping(destination_conn):
@@ -427,6 +457,8 @@ def _init_user_group_mapping(destination_conn):
 def _take_action(rps):
     """Do whatever action says"""
     if _action == "server":
+        if _server_socket:
+            sys.exit(daemon.serve(_server_socket))
         connection.PipeConnection(sys.stdin.buffer, sys.stdout.buffer).Server()
         sys.exit(0)
     elif _action == "test-server":
@@ -465,9 +497,36 @@ def _cleanup():
         ErrorLog.close()
     Log.close_logfile()
     if not Globals.server:
+        if _connection_statistics_filename:
+            _write_connection_statistics(_connection_statistics_filename)
         SetConnections.CloseConnections()
 
 
+def _write_connection_statistics(filename):
+    """Write the statistics of the remote connections as YAML to filename
+
+    The statistics of each connection are given by its number, as seen
+    from the client and, if the API version allows, from the server.
+
+    """
+    report = {}
+    for conn in Globals.connections[1:]:
+        if conn:
+            report[conn.conn_number] = {"client": conn.get_statistics()}
+    if Globals.get_api_version() >= 201:
+        for conn in Globals.connections[1:]:
+            if conn:
+                report[conn.conn_number]["server"] = \
+                    conn.SetConnections.get_connection_statistics()[0]
+    try:
+        with open(filename, "w") as stats_file:
+            yaml.safe_dump({"connections": report}, stats_file,
+                           default_flow_style=False)
+    except OSError as exc:
+        Log("Unable to write connection statistics to file '{fi}' due to "
+            "exception '{ex}'".format(fi=filename, ex=exc), 2)
+
+
 def _action_backup(rpin, rpout):
     """Backup, possibly incrementally, src_path to dest_path."""
     global _incdir
@@ -483,15 +542,41 @@ def _action_backup(rpin, rpout):
     _backup_warn_if_infinite_regress(rpin, rpout)
     if _prevtime:
         Time.setprevtime(_prevtime)
-        rpout.conn.Main.backup_touch_curmirror_local(rpin, rpout)
+        rpout.conn.reval_async("Main.backup_touch_curmirror_local",
+                               rpin, rpout)
         backup.Mirror_and_increment(rpin, rpout, _incdir)
-        rpout.conn.Main.backup_remove_curmirror_local()
+        rpout.conn.reval_async("Main.backup_remove_curmirror_local")
     else:
         backup.Mirror(rpin, rpout)
-        rpout.conn.Main.backup_touch_curmirror_local(rpin, rpout)
+        rpout.conn.reval_async("Main.backup_touch_curmirror_local",
+                               rpin, rpout)
+    _backup_connection_statistics(rpout)
     rpout.conn.Main.backup_close_statistics(time.time())
 
 
+def _backup_connection_statistics(rpout):
+    """Record the tuning and compression of connections in the statistics
+
+    All frames pass through the connections of the client, so their
+    sizes are counted here, but the time spent is summed over all sides.
+
+    """
+    if _connection_measures:
+        rpout.conn.statistics.set_tuning_stats(
+            *_connection_measures, Globals.pipeline_max_length,
+            Globals.conn_bufsize, Globals.blocksize)
+    remote_conns = [conn for conn in Globals.connections[1:]
+                    if conn and conn.compression]
+    if not remote_conns:
+        return
+    data_size, compressed_size, seconds = \
+        SetConnections.get_compression_stats()
+    for conn in remote_conns:
+        seconds += conn.SetConnections.get_compression_stats()[2]
+    rpout.conn.statistics.set_connection_stats(data_size, compressed_size,
+                                               seconds)
+
+
 def _backup_quoted_rpaths(rpout):
     """Get QuotedRPath versions of important RPaths.  Return rpout"""
     global _incdir
@@ -1022,7 +1107,8 @@ def _checkdest_need_check(dest_rp):
         return None
     for filename in Globals.rbdir.listdir():
         if filename not in [
-                b'chars_to_quote', b'special_escapes', b'backup.log'
+                b'chars_to_quote', b'special_escapes', b'signature_format',
+                b'backup.log'
         ]:
             break
     else:  # This may happen the first backup just after we test for quoting
@@ -18,17 +18,37 @@
 # 02110-1301, USA
 """Invoke rdiff utility to make signatures, deltas, or patch"""
 
+import concurrent.futures
+import hashlib
+import io
+import os
+import tempfile
+import threading
 from . import Globals, log, rpath, hash, librsync
 
 
 def get_signature(rp, blocksize=None):
-    """Take signature of rpin file and return in file object"""
+    """Take signature of rpin file and return in file object
+
+    The signature of files bigger than Globals.segment_size is computed
+    in segments in parallel, see _get_segment_size.
+
+    """
     if not blocksize:
         blocksize = _find_blocksize(rp.getsize())
     log.Log(
         "Getting signature of %s with blocksize %s" % (rp.get_safeindexpath(),
                                                        blocksize), 7)
-    return librsync.SigFile(rp.open("rb"), blocksize)
+    segment_size = _get_segment_size(rp.getsize(), blocksize)
+    if segment_size:
+        return _get_segmented_signature(rp, blocksize, segment_size)
+    return librsync.SigFile(rp.open("rb"), blocksize, get_sig_format())
+
+
+def get_sig_format():
+    """Return format of new signatures, see librsync.get_sig_format"""
+    return librsync.get_sig_format(Globals.signature_format,
+                                   Globals.signature_strong_len)
 
 
 def get_delta_sigrp_hash(rp_signature, rp_new):
@@ -36,6 +56,11 @@ def get_delta_sigrp_hash(rp_signature, rp_new):
     log.Log(
         "Getting delta (with hash) of %s with signature %s" %
         (rp_new.get_safepath(), rp_signature.get_safeindexpath()), 7)
+    segment_size = _get_segment_size(rp_new.getsize(),
+                                     _find_blocksize(rp_new.getsize()))
+    if segment_size:
+        return _SegmentedDeltaFile(rp_signature.open("rb"), rp_new,
+                                   segment_size)
     return librsync.DeltaFile(
         rp_signature.open("rb"), hash.FileWrapper(rp_new.open("rb")))
 
@@ -45,23 +70,36 @@ def write_delta(basis, new, delta, compress=None):
     log.Log(
         "Writing delta %s from %s -> %s" %
         (basis.get_safepath(), new.get_safepath(), delta.get_safepath()), 7)
-    deltafile = librsync.DeltaFile(get_signature(basis), new.open("rb"))
-    delta.write_from_fileobj(deltafile, compress)
+    if (basis.conn is Globals.local_connection
+            and new.conn is Globals.local_connection
+            and delta.conn is Globals.local_connection):
+        _write_delta_local(basis, new, delta, compress)
+    else:
+        deltafile = librsync.DeltaFile(get_signature(basis), new.open("rb"))
+        delta.write_from_fileobj(deltafile, compress)
 
 
 def write_patched_fp(basis_fp, delta_fp, out_fp):
     """Write patched file to out_fp given input fps.  Closes input files"""
-    rpath.copyfileobj(librsync.PatchedFile(basis_fp, delta_fp), out_fp)
+    if librsync.is_true_file(basis_fp) and librsync.is_true_file(out_fp):
+        # the delta is usually small compared to the files, so it is worth
+        # uncompressing it first to let librsync patch completely in C
+        delta_fp = _get_true_file(delta_fp)
+        librsync.write_patched(basis_fp, delta_fp, out_fp)
+    else:
+        rpath.copyfileobj(librsync.PatchedFile(basis_fp, delta_fp), out_fp)
     basis_fp.close()
     delta_fp.close()
 
 
-def patch_local(rp_basis, rp_delta, outrp=None, delta_compressed=None):
+def patch_local(rp_basis, rp_delta, outrp=None, delta_compressed=None,
+                patched_wrapper=None):
     """Patch routine that must be run locally, writes to outrp
 
     This should be run local to rp_basis because it needs to be a real
     file (librsync may need to seek around in it).  If outrp is None,
-    patch rp_basis instead.
+    patch rp_basis instead.  If given, patched_wrapper is called with the
+    patched file object and returns the file object actually written.
 
     The return value is the close value of the delta, so it can be
     used to produce hashes.
@@ -74,7 +112,17 @@ def patch_local(rp_basis, rp_delta, outrp=None, delta_compressed=None):
         deltafile = rp_delta.open("rb", 1)
     else:
         deltafile = rp_delta.open("rb")
+    if not patched_wrapper and librsync.is_true_file(deltafile):
+        # all files are local, hence librsync can patch completely in C
+        if outrp:
+            return _write_patched_local(rp_basis, deltafile, outrp)
+        tf = rp_basis.get_temp_rpath(sibling=True)
+        retval = _write_patched_local(rp_basis, deltafile, tf)
+        rpath.rename(tf, rp_basis)
+        return retval
     patchfile = librsync.PatchedFile(rp_basis.open("rb"), deltafile)
+    if patched_wrapper:
+        patchfile = patched_wrapper(patchfile)
     if outrp:
         return outrp.write_from_fileobj(patchfile)
     else:
@@ -95,6 +143,349 @@ def _find_blocksize(file_len):
         return int(pow(file_len, 0.5) / 16) * 16
 
 
+def _get_segment_size(file_len, blocksize):
+    """Return size of the segments of a file of file_len, 0 if unsegmented
+
+    Files bigger than Globals.segment_size are split into segments of
+    about this size, a multiple of the block size, whose signatures and
+    deltas are computed in parallel.  The signatures of consecutive
+    segments simply add up to the signature of the file, and the deltas
+    of the segments of the new file, each against the whole signature,
+    to its delta.  Hence only the computation is split, the signatures
+    and deltas exchanged, and the increments, remain the usual ones.
+
+    """
+    if not Globals.segment_size or file_len <= Globals.segment_size:
+        return 0
+    return max(Globals.segment_size // blocksize, 1) * blocksize
+
+
+def _get_segmented_signature(rp, blocksize, segment_size):
+    """Return signature file of rp, computed in segments in parallel"""
+
+    def get_segment_signature(segment):
+        """Return the signature of the segment (offset, length)"""
+        sig_fp = librsync.SigFile(_SegmentFile(rp, *segment), blocksize,
+                                  get_sig_format())
+        sig = sig_fp.read()
+        sig_fp.close()
+        return sig
+
+    with concurrent.futures.ThreadPoolExecutor(
+            Globals.segment_workers) as pool:
+        sigs = list(pool.map(get_segment_signature,
+                             _get_segments(rp.getsize(), segment_size)))
+    return io.BytesIO(librsync.join_signatures(sigs))
+
+
+def _get_segments(file_len, segment_size):
+    """Return list of (offset, length) of the segments of a file
+
+    The length of the last segment is None, so that it goes up to the
+    end of the file, even if the file grew meanwhile.
+
+    """
+    segments = [(offset, segment_size)
+                for offset in range(0, file_len, segment_size)]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+
+class _SegmentFile:
+    """Read the length bytes of rp at offset, up to the end if None
+
+    If a hasher is given, the bytes read are passed on to it as those of
+    the segment with the given index, see _SegmentHasher.
+
+    """
+
+    def __init__(self, rp, offset, length, hasher=None, index=None):
+        self.fileobj = rp.open("rb")
+        self.fileobj.seek(offset)
+        self.offset = offset
+        self.left = length
+        self.hasher = hasher
+        self.index = index
+
+    def read(self, length=-1):
+        if self.left is not None and (length < 0 or length > self.left):
+            length = self.left
+        buf = self.fileobj.read(length)
+        if self.left is not None:
+            self.left -= len(buf)
+        if self.hasher is not None:
+            if buf:
+                self.hasher.update(self.index, self.offset, buf)
+            else:
+                self.hasher.complete(self.index)
+        self.offset += len(buf)
+        return buf
+
+    def close(self):
+        return self.fileobj.close()
+
+
+class _SegmentHasher:
+    """Hash a file from the segments read by several threads
+
+    The bytes are hashed in order while the segment they belong to is the
+    first one not completely hashed.  The bytes read meanwhile from the
+    following segments are read once more from the file when the hash
+    reaches them, as keeping them in memory could need up to the size of
+    all the segments being read.
+
+    """
+
+    def __init__(self, rp, segments):
+        self.rp = rp
+        self.ends = [offset for offset, length in segments]
+        self.completed = [False] * len(segments)
+        self.index = 0  # index of the segment being hashed
+        self.position = 0  # number of bytes hashed
+        self.sha1 = hashlib.sha1()
+        self.lock = threading.Lock()
+        self.catch_up_lock = threading.Lock()
+
+    def update(self, index, offset, buf):
+        """Take the bytes buf read at offset of the segment index"""
+        with self.lock:
+            self.ends[index] = offset + len(buf)
+            self._hash(offset, buf)
+
+    def complete(self, index):
+        """Mark the segment index as read and hash what it left behind
+
+        Only one thread catches up at a time, the others just go on, as
+        the thread catching up also hashes the segments they completed,
+        and anything left behind is hashed by get_report.
+
+        """
+        with self.lock:
+            self.completed[index] = True
+        if not self.catch_up_lock.acquire(blocking=False):
+            return
+        try:
+            with self.rp.open("rb") as fileobj:
+                while True:
+                    with self.lock:
+                        while (self.index < len(self.ends)
+                               and self.completed[self.index]
+                               and self.position >= self.ends[self.index]):
+                            self.index += 1
+                        if (self.index >= len(self.ends)
+                                or self.position >= self.ends[self.index]):
+                            return
+                        offset = self.position
+                        length = min(self.ends[self.index] - offset,
+                                     Globals.blocksize)
+                    fileobj.seek(offset)
+                    buf = fileobj.read(length)
+                    if not buf:
+                        return
+                    with self.lock:
+                        self._hash(offset, buf)
+        finally:
+            self.catch_up_lock.release()
+
+    def get_report(self):
+        """Hash what is left of the file and return the hash report"""
+        with self.catch_up_lock, self.rp.open("rb") as fileobj:
+            fileobj.seek(self.position)
+            while True:
+                buf = fileobj.read(Globals.blocksize)
+                if not buf:
+                    break
+                with self.lock:
+                    self._hash(self.position, buf)
+        return hash.Report(None, self.sha1.hexdigest())
+
+    def _hash(self, offset, buf):
+        """Hash the part of buf read at offset which follows position"""
+        if offset <= self.position < offset + len(buf):
+            self.sha1.update(buf[self.position - offset:])
+            self.position = offset + len(buf)
+
+
+class _SegmentedDeltaFile:
+    """Delta of a file, computed in segments in parallel
+
+    The deltas of the segments are written to temporary files, which
+    are then read in order as one delta.  At most segment_workers
+    segments are computed ahead of the one being read, and each of them
+    loads its own copy of the signature, as the hash table of a loaded
+    signature isn't safe to share between threads in librsync.  The
+    signature is hence spooled to a temporary file, from which each
+    segment streams it, and only as many segments are computed at once
+    as copies of the signature fit in Globals.segment_memory.  Like the
+    file returned by get_delta_sigrp_hash, close() returns the hash of the
+    new file, which is computed from the segments read, see
+    _SegmentHasher.
+
+    """
+
+    def __init__(self, sig_fp, rp_new, segment_size):
+        """Start computing the delta of rp_new against sig_fp"""
+        self.sig_path = _spool_to_tempfile(sig_fp)
+        self.rp_new = rp_new
+        self.segments = _get_segments(rp_new.getsize(), segment_size)
+        self.hasher = _SegmentHasher(rp_new, self.segments)
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            _get_segment_concurrency(os.path.getsize(self.sig_path)))
+        self.delta_futures = []
+        for index in range(min(Globals.segment_workers, len(self.segments))):
+            self._submit_segment(index)
+        self.part_index = -1  # index of the segment delta being read
+        self.part_fp = None
+        self.part_left = 0
+
+    def read(self, length=-1):
+        """Read from the deltas of the segments, joined into one"""
+        bufs = []
+        while length:
+            if not self.part_left and not self._next_part():
+                break
+            buf = self.part_fp.read(
+                self.part_left if length < 0 else min(length, self.part_left))
+            if not buf:
+                raise librsync.librsyncError("Segment delta ended early")
+            bufs.append(buf)
+            self.part_left -= len(buf)
+            if length > 0:
+                length -= len(buf)
+        return b"".join(bufs)
+
+    def close(self):
+        """Close the deltas of the segments and return the hash report"""
+        if self.part_fp is not None:
+            self.part_fp.close()
+            self.part_fp = None
+        for future in self.delta_futures[self.part_index + 1:]:
+            if not future.cancel() and not future.exception():
+                future.result().close()
+        self.pool.shutdown()
+        os.unlink(self.sig_path)
+        return self.hasher.get_report()
+
+    def _next_part(self):
+        """Switch to the delta of the next segment, return false at end
+
+        The deltas of the segments are joined by leaving out the header
+        of all but the first one, and the end command of all but the
+        last one.  The delta of the segment segment_workers after the
+        one consumed is started meanwhile.
+
+        """
+        if self.part_fp is not None:
+            self.part_fp.close()
+            self.part_fp = None
+        self.part_index += 1
+        if self.part_index >= len(self.segments):
+            return False
+        if len(self.delta_futures) < len(self.segments):
+            self._submit_segment(len(self.delta_futures))
+        self.part_fp = self.delta_futures[self.part_index].result()
+        end = self.part_fp.seek(0, io.SEEK_END)
+        if self.part_index < len(self.segments) - 1:
+            end -= librsync.DELTA_END_LEN
+        start = librsync.DELTA_HEADER_LEN if self.part_index else 0
+        self.part_fp.seek(start)
+        self.part_left = end - start
+        return True
+
+    def _submit_segment(self, index):
+        """Start computing the delta of the segment index"""
+        self.delta_futures.append(
+            self.pool.submit(self._get_segment_delta, index))
+
+    def _get_segment_delta(self, index):
+        """Return temporary file with the delta of the segment index"""
+        delta_fp = librsync.DeltaFile(
+            open(self.sig_path, "rb"),
+            _SegmentFile(self.rp_new, *self.segments[index],
+                         hasher=self.hasher, index=index))
+        segment_fp = tempfile.TemporaryFile()
+        try:
+            rpath.copyfileobj(delta_fp, segment_fp)
+        except BaseException:
+            segment_fp.close()
+            raise
+        finally:
+            delta_fp.close()
+        segment_fp.seek(0)
+        return segment_fp
+
+
+def _spool_to_tempfile(fp):
+    """Copy fp to a new temporary file, close fp and return the file's path"""
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as spool_fp:
+            rpath.copyfileobj(fp, spool_fp)
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        fp.close()
+    return path
+
+
+def _get_segment_concurrency(sig_size):
+    """Return how many segment deltas may load a signature of sig_size
+
+    At least one, and at most Globals.segment_workers.
+
+    """
+    return max(1, min(Globals.segment_workers,
+                      Globals.segment_memory // max(sig_size, 1)))
+
+
+def _write_delta_local(basis, new, delta, compress):
+    """Like write_delta, but letting librsync read the files from C"""
+    with tempfile.TemporaryFile() as sig_fp:
+        with basis.open("rb") as basis_fp:
+            librsync.write_signature(basis_fp, sig_fp,
+                                     _find_blocksize(basis.getsize()),
+                                     get_sig_format())
+        sig_fp.seek(0)
+        with new.open("rb") as new_fp:
+            if compress:  # compress the usually small delta in Python
+                delta_fp = tempfile.TemporaryFile()
+                librsync.write_delta(sig_fp, new_fp, delta_fp)
+                delta_fp.seek(0)
+                delta.write_from_fileobj(delta_fp, compress)
+            else:
+                assert not delta.lstat(), (
+                    "File '{rp!s}' already exists".format(rp=delta))
+                with delta.open("wb") as delta_fp:
+                    librsync.write_delta(sig_fp, new_fp, delta_fp)
+                delta.setdata()
+
+
+def _write_patched_local(rp_basis, delta_fp, outrp):
+    """Write rp_basis patched with true file delta_fp to outrp
+
+    Like outrp.write_from_fileobj(PatchedFile(...)), but done by librsync
+    completely in C.  Returns the close value of delta_fp.
+
+    """
+    assert not outrp.lstat(), "File '{rp!s}' already exists".format(rp=outrp)
+    with rp_basis.open("rb") as basis_fp, outrp.open("wb") as out_fp:
+        librsync.write_patched(basis_fp, delta_fp, out_fp)
+    outrp.setdata()
+    return delta_fp.close()
+
+
+def _get_true_file(fp):
+    """Return fp if it is a true file, else a temporary copy of it"""
+    if librsync.is_true_file(fp):
+        return fp
+    true_fp = tempfile.TemporaryFile()
+    rpath.copyfileobj(fp, true_fp)
+    fp.close()
+    true_fp.seek(0)
+    return true_fp
+
+
 def _write_via_tempfile(fp, rp):
     """Write fileobj fp to rp by writing to tempfile and renaming"""
     tf = rp.get_temp_rpath(sibling=True)
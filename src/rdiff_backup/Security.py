@@ -224,7 +224,8 @@ def _set_allowed_requests(sec_level):
             "Main.backup_touch_curmirror_local",
             "Main.backup_remove_curmirror_local",
             "Main.backup_close_statistics", "regress.check_pids",
-            "statistics.record_error",
+            "statistics.record_error", "statistics.set_connection_stats",
+            "statistics.set_tuning_stats",
             "log.ErrorLog.write_if_open", "fs_abilities.backup_set_globals"
         ])
     if sec_level == "all":
@@ -241,7 +242,15 @@ def _set_allowed_requests(sec_level):
         ])
     if Globals.server:
         requests.extend([
-            "SetConnections.init_connection_remote", "log.Log.setverbosity",
+            "SetConnections.init_connection_remote",
+            "SetConnections.set_connection_compression",
+            "SetConnections.get_compression_stats",
+            "SetConnections.get_connection_statistics",
+            "SetConnections.probe_connection",
+            "SetConnections.listen_for_channels",
+            "SetConnections.accept_channels",
+            "SetConnections.relay_channel",
+            "Globals.set_api_version", "log.Log.setverbosity",
             "log.Log.setterm_verbosity", "Time.setprevtime_local",
             "Globals.postset_regexp_local",
             "backup.SourceStruct.set_session_info",
@@ -24,10 +24,16 @@ the related connections.
 
 """
 
+import hmac
 import os
 import re
+import shutil
+import socket
 import sys
 import subprocess
+import tempfile
+import threading
+import time
 from .log import Log
 from . import Globals, connection, rpath
 
@@ -37,10 +43,36 @@ from . import Globals, connection, rpath
 __cmd_schema = b"ssh -C {h} rdiff-backup --server"
 __cmd_schema_no_compress = b"ssh {h} rdiff-backup --server"
 
+# A remote command starting with this prefix is instead the path of the
+# Unix socket of a server daemon to connect to, see daemon
+_SOCKET_CMD_PREFIX = b"unix:"
+
 # This is a list of remote commands used to start the connections.
 # The first is None because it is the local connection.
 __conn_remote_cmds = [None]
 
+# Seconds the server waits for the data channels of its connection
+_CHANNEL_TIMEOUT = 60
+# (socket, directory, key) the server listens with for data channels
+_channel_listener = None
+
+# Connections are tuned by measuring the minimum of a few round trips,
+# and the bandwidth with probes growing from the minimum to the maximum
+# size until one takes long enough, see tune_connections
+_TUNING_ROUND_TRIPS = 5
+_TUNING_PROBE_SIZES = (65536, 8388608)
+_TUNING_PROBE_SECONDS = 0.25
+# The pipeline grows by its default length every so many seconds of
+# round trip time, the connection buffer holds the data sent in so many
+# seconds, and at least a quarter of the data in flight
+_TUNING_PIPELINE_RTT = 0.025
+_TUNING_BUFFER_SECONDS = 0.1
+# The safe limits of the tuned values, the block size being a third of
+# the connection buffer like by default
+_TUNED_PIPELINE_LENGTHS = (500, 4000)
+_TUNED_CONN_BUFSIZES = (65536, 4194304)
+_TUNED_BLOCKSIZES = (32768, 1048576)
+
 
 class SetConnectionsException(Exception):
     pass
@@ -60,7 +92,11 @@ def get_cmd_pairs(arglist, remote_schema=None, remote_cmd=None):
         __cmd_schema = __cmd_schema_no_compress
 
     if Globals.remote_tempdir:
-        __cmd_schema += (b" --tempdir=" + Globals.remote_tempdir)
+        if __cmd_schema.startswith(_SOCKET_CMD_PREFIX):
+            Log("Remote temporary directory ignored with a server daemon, "
+                "it must be set when starting it.", 2)
+        else:
+            __cmd_schema += (b" --tempdir=" + Globals.remote_tempdir)
 
     if not arglist:
         return []
@@ -101,6 +137,59 @@ def init_connection_remote(conn_number):
     Globals.connection_dict[conn_number] = Globals.local_connection
 
 
+# @API(SetConnections.set_connection_compression, 201)
+def set_connection_compression(method, level):
+    """Run on server side to compress what is sent to the client
+
+    Returns false if the compression method isn't supported.
+
+    """
+    if not connection.is_compression_supported(method):
+        return False
+    Globals.connections[1].compression = (method, level)
+    return True
+
+
+# @API(SetConnections.get_compression_stats, 201)
+def get_compression_stats():
+    """Return the compression statistics summed over our connections
+
+    These are the bytes of frames before and after compression, sent
+    and received, and the seconds spent to compress and decompress.
+
+    """
+    stats = [0, 0, 0.0]
+    for conn in Globals.connections[1:]:
+        if conn:
+            for pos, value in enumerate(conn.compression_stats):
+                stats[pos] += value
+    return tuple(stats)
+
+
+# @API(SetConnections.get_connection_statistics, 201)
+def get_connection_statistics():
+    """Return the statistics of our connections, by connection number
+
+    See connection.PipeConnection.get_statistics.  The connection of a
+    server to the client has number 0.
+
+    """
+    return {conn.conn_number: conn.get_statistics()
+            for conn in Globals.connections[1:] if conn}
+
+
+# @API(SetConnections.probe_connection, 201)
+def probe_connection(data, size):
+    """Return size random bytes, data being ignored
+
+    Used to measure the bandwidth of the connection, see
+    tune_connections.  The bytes are random so that they aren't
+    compressed, like data.
+
+    """
+    return os.urandom(size)
+
+
 # @API(add_redirected_conn, 200)
 def add_redirected_conn(conn_number):
     """Run on server side - tell about redirected connection"""
@@ -108,16 +197,159 @@ def add_redirected_conn(conn_number):
         connection.RedirectedConnection(conn_number)
 
 
+# @API(SetConnections.listen_for_channels, 201)
+def listen_for_channels():
+    """Run on server side to listen for data channels of its connection
+
+    Returns the path of the Unix socket to connect to, and the key to
+    send to be accepted, see relay_channel, or None if Unix sockets
+    aren't supported here.
+
+    """
+    global _channel_listener
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    tempdir = tempfile.mkdtemp(prefix="rdiff-backup-channels-")
+    path = os.path.join(tempdir, "socket")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    _channel_listener = (sock, tempdir, os.urandom(16))
+    return path, _channel_listener[2]
+
+
+# @API(SetConnections.accept_channels, 201)
+def accept_channels(count):
+    """Run on server side to accept count data channels, return success
+
+    Each channel sends the key and its number once connected, so that
+    the channels are used in the same order as on the client side.
+
+    """
+    global _channel_listener
+    sock, tempdir, key = _channel_listener
+    _channel_listener = None
+    channels = [None] * count
+    sock.settimeout(_CHANNEL_TIMEOUT)
+    try:
+        while None in channels:
+            channel_sock = sock.accept()[0]
+            channel_sock.settimeout(_CHANNEL_TIMEOUT)
+            hello = channel_sock.recv(len(key) + 1, socket.MSG_WAITALL)
+            if (len(hello) == len(key) + 1 and hello[-1] < count
+                    and hmac.compare_digest(hello[:-1], key)):
+                channel_sock.settimeout(None)
+                channels[hello[-1]] = connection.DataChannel(
+                    channel_sock.makefile("rb"), channel_sock.makefile("wb"),
+                    sock=channel_sock)
+            else:
+                channel_sock.close()
+    except OSError as exc:
+        Log("Data channels couldn't be accepted: {exc}".format(exc=exc), 2)
+        for channel in channels:
+            if channel:
+                channel.close()
+        return False
+    finally:
+        sock.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+    Globals.connections[1].data_channels = channels
+    return True
+
+
+# @API(SetConnections.relay_channel, 201)
+def relay_channel(path, hello):
+    """Run on server side to relay its connection as a data channel
+
+    The connection to the client is relayed to and from the Unix socket
+    at path, after sending hello to it, see accept_channels.  The
+    process exits once both directions are closed, hence the request
+    must be asynchronous.
+
+    """
+    conn = Globals.connections[1]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(hello)
+
+    def relay_to_client():
+        while True:
+            data = sock.recv(Globals.conn_bufsize)
+            if not data:
+                break
+            conn.outpipe.write(data)
+            conn.outpipe.flush()
+        conn.outpipe.close()
+
+    thread = threading.Thread(target=relay_to_client, daemon=True)
+    thread.start()
+    while True:
+        data = conn.inpipe.read1(Globals.conn_bufsize)
+        if not data:
+            break
+        sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+    thread.join()
+    os._exit(0)  # there is nothing left to answer
+
+
 def UpdateGlobal(setting_name, val):
     """Update value of global variable across all connections"""
     for conn in Globals.connections:
-        conn.Globals.set(setting_name, val)
+        conn.reval_async("Globals.set", setting_name, val)
+
+
+def tune_connections():
+    """Tune the pipeline length and buffer sizes to the remote connections
+
+    The round trip time and bandwidth of each remote connection are
+    measured, and the pipeline length, the connection buffer size and
+    the block size set on all sides within safe limits according to the
+    slowest of them.  This must be done before the caches sized after
+    the pipeline length are created, e.g. by set_source_select.
+
+    Return the round trip time in seconds and the bandwidth in bytes
+    per second, or None if there is nothing to tune.
+
+    """
+    conns = [conn for conn in Globals.connections[1:] if conn]
+    if not conns:
+        return None
+    if Globals.get_api_version() < 201:
+        Log("Warning: connection tuning requires API version 201, the "
+            "default pipeline length and buffer sizes are used.", 2)
+        return None
+    measures = [_measure_connection(conn) for conn in conns]
+    round_trip_time = max(measure[0] for measure in measures)
+    bandwidth = min(measure[1] for measure in measures)
+
+    pipeline_max_length = _clamp(
+        int(round_trip_time / _TUNING_PIPELINE_RTT + 1)
+        * _TUNED_PIPELINE_LENGTHS[0], _TUNED_PIPELINE_LENGTHS)
+    conn_bufsize = _clamp(
+        int(max(bandwidth * _TUNING_BUFFER_SECONDS,
+                bandwidth * round_trip_time / 4)) // 65536 * 65536,
+        _TUNED_CONN_BUFSIZES)
+    blocksize = _clamp(conn_bufsize // 3 // 16384 * 16384, _TUNED_BLOCKSIZES)
+    UpdateGlobal("pipeline_max_length", pipeline_max_length)
+    UpdateGlobal("conn_bufsize", conn_bufsize)
+    UpdateGlobal("blocksize", blocksize)
+    Log("Connections tuned to a round trip time of {rtt:.1f} ms and a "
+        "bandwidth of {bw:.0f} KiB/s: pipeline length {pl}, connection "
+        "buffer size {cb} bytes, block size {bs} bytes.".format(
+            rtt=round_trip_time * 1000, bw=bandwidth / 1024,
+            pl=pipeline_max_length, cb=conn_bufsize, bs=blocksize), 4)
+    return round_trip_time, bandwidth
 
 
 def BackupInitConnections(reading_conn, writing_conn):
     """Backup specific connection initialization"""
-    reading_conn.Globals.set("isbackup_reader", 1)
-    writing_conn.Globals.set("isbackup_writer", 1)
+    if Globals.small_file_size and Globals.get_api_version() < 201:
+        Log("Warning: sending small files whole requires API version 201, "
+            "signatures and diffs are used for all files.", 2)
+        UpdateGlobal("small_file_size", 0)
+    reading_conn.reval_async("Globals.set", "isbackup_reader", 1)
+    writing_conn.reval_async("Globals.set", "isbackup_writer", 1)
     UpdateGlobal("backup_reader", reading_conn)
     UpdateGlobal("backup_writer", writing_conn)
 
@@ -249,35 +481,72 @@ def _init_connection(remote_cmd):
     if not remote_cmd:
         return Globals.local_connection
 
+    remote = _open_remote(remote_cmd)
+    if remote:
+        (stdout, stdin) = remote[:2]
+    else:
+        (stdin, stdout) = (None, None)
+    conn_number = len(Globals.connections)
+    conn = connection.PipeConnection(stdout, stdin, conn_number)
+
+    if not _validate_connection_version(conn, remote_cmd):
+        return None
+    Log("Registering connection %d" % conn_number, 7)
+    _init_connection_routing(conn, conn_number, remote_cmd)
+    _init_connection_settings(conn)
+    _init_connection_channels(conn, remote_cmd)
+    return conn
+
+
+def _open_remote(remote_cmd):
+    """Open the pipes to the server given by remote_cmd
+
+    The server is either started by running remote_cmd, or connected
+    to over a Unix socket if remote_cmd is a socket path prefixed with
+    _SOCKET_CMD_PREFIX.  Return a tuple (inpipe, outpipe, process,
+    socket), the last two being None if not applicable, or None if the
+    server can't be reached.
+
+    """
+    if not os.fsencode(remote_cmd).startswith(_SOCKET_CMD_PREFIX):
+        process = _start_remote_process(remote_cmd)
+        if not process:
+            return None
+        return (process.stdout, process.stdin, process, None)
+    path = os.fsencode(remote_cmd)[len(_SOCKET_CMD_PREFIX):]
+    Log("Connecting to server daemon at %s" % _safe_str(path), 4)
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return (sock.makefile("rb"), sock.makefile("wb"), None, sock)
+
+
+def _start_remote_process(remote_cmd):
+    """Run remote_cmd with pipes to it, return the process or None"""
     Log("Executing %s" % _safe_str(remote_cmd), 4)
     try:
         # we need buffered read on SSH communications, hence using
         # default value for bufsize parameter
         if os.name == 'nt':
             # FIXME workaround because python 3.7 doesn't yet accept bytes
-            process = subprocess.Popen(
+            return subprocess.Popen(
                 os.fsdecode(remote_cmd),
                 shell=True,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE)
         else:
-            process = subprocess.Popen(
+            return subprocess.Popen(
                 remote_cmd,
                 shell=True,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE)
-        (stdin, stdout) = (process.stdin, process.stdout)
     except OSError:
-        (stdin, stdout) = (None, None)
-    conn_number = len(Globals.connections)
-    conn = connection.PipeConnection(stdout, stdin, conn_number)
-
-    if not _validate_connection_version(conn, remote_cmd):
         return None
-    Log("Registering connection %d" % conn_number, 7)
-    _init_connection_routing(conn, conn_number, remote_cmd)
-    _init_connection_settings(conn)
-    return conn
 
 
 def _validate_connection_version(conn, remote_cmd):
@@ -367,11 +636,10 @@ Please make sure you have compatible versions of rdiff-backup.""".format(
     if Globals.api_version["actual"]:
         if (Globals.api_version["actual"] >= remote_api_version["min"]
                 and Globals.api_version["actual"] <= remote_api_version["max"]):
-            conn.Globals.set('api_version["actual"]',
-                             Globals.api_version["actual"])
+            _set_remote_api_version(conn, Globals.api_version["actual"])
             Log("API version agreed to be actual {api_ver} with {cmd}.".format(
                 api_ver=Globals.api_version["actual"], cmd=remote_cmd), 4)
-            return True
+            return _negotiate_compression(conn, remote_cmd)
         else:  # the actual version doesn't fit the other side
             Log("Fatal: remote rdiff-backup doesn't accept the API version "
                 "explicitly set locally to {api_ver}. "
@@ -388,20 +656,66 @@ Please make sure you have compatible versions of rdiff-backup.""".format(
                                  min(remote_api_version["max"],
                                      Globals.api_version["default"]))
         Globals.api_version["actual"] = actual_api_version
-        conn.Globals.set('api_version["actual"]', actual_api_version)
+        _set_remote_api_version(conn, actual_api_version)
         Log("API version agreed to be {api_ver} with {cmd}.".format(
             api_ver=actual_api_version, cmd=remote_cmd), 4)
+        return _negotiate_compression(conn, remote_cmd)
+
+
+def _set_remote_api_version(conn, api_version):
+    """Tell the remote side about the API version agreed
+
+    Before API version 201, the remote side had no function to set it,
+    and kept using its default version.
+
+    """
+    if api_version >= 201:
+        conn.Globals.set_api_version(api_version)
+    else:
+        conn.Globals.set('api_version["actual"]', api_version)
+
+
+def _negotiate_compression(conn, remote_cmd):
+    """Compress the frames sent both ways over conn, if requested
+
+    Compressed frames are only understood since API version 201, and
+    the compression method must be supported on both sides, else the
+    connection stays uncompressed.  Returns True in any case.
+
+    """
+    method = Globals.connection_compression
+    if not method:
         return True
+    level = Globals.connection_compression_level
+    if Globals.get_api_version() < 201:
+        Log("Warning: compression of the connection to {cmd} requires "
+            "API version 201, the connection isn't compressed.".format(
+                cmd=remote_cmd), 2)
+    elif not (connection.is_compression_supported(method)
+              and conn.SetConnections.set_connection_compression(method,
+                                                                 level)):
+        Log("Warning: compression method {meth} isn't supported on both "
+            "sides of the connection to {cmd}, the connection isn't "
+            "compressed.".format(meth=method, cmd=remote_cmd), 2)
+    else:
+        conn.compression = (method, level)
+        Log("Connection to {cmd} compressed with {meth} at level "
+            "{lvl}.".format(cmd=remote_cmd, meth=method, lvl=level), 4)
+    return True
 
 
 def _init_connection_routing(conn, conn_number, remote_cmd):
     """Called by _init_connection, establish routing, conn dict"""
     Globals.connection_dict[conn_number] = conn
 
-    conn.SetConnections.init_connection_remote(conn_number)
-    for other_remote_conn in Globals.connections[1:]:
-        conn.SetConnections.add_redirected_conn(other_remote_conn.conn_number)
-        other_remote_conn.SetConnections.add_redirected_conn(conn_number)
+    with conn.batch():
+        conn.reval_async("SetConnections.init_connection_remote",
+                         conn_number)
+        for other_remote_conn in Globals.connections[1:]:
+            conn.reval_async("SetConnections.add_redirected_conn",
+                             other_remote_conn.conn_number)
+            other_remote_conn.reval_async(
+                "SetConnections.add_redirected_conn", conn_number)
 
     Globals.connections.append(conn)
     __conn_remote_cmds.append(remote_cmd)
@@ -409,10 +723,88 @@ def _init_connection_routing(conn, conn_number, remote_cmd):
 
 def _init_connection_settings(conn):
     """Tell new conn about log settings and updated globals"""
-    conn.log.Log.setverbosity(Log.verbosity)
-    conn.log.Log.setterm_verbosity(Log.term_verbosity)
-    for setting_name in Globals.changed_settings:
-        conn.Globals.set(setting_name, Globals.get(setting_name))
+    with conn.batch():
+        conn.reval_async("log.Log.setverbosity", Log.verbosity)
+        conn.reval_async("log.Log.setterm_verbosity", Log.term_verbosity)
+        for setting_name in Globals.changed_settings:
+            conn.reval_async("Globals.set", setting_name,
+                             Globals.get(setting_name))
+
+
+def _init_connection_channels(conn, remote_cmd):
+    """Open the additional data channels of conn, if requested
+
+    Each channel is a pipe to another process started with remote_cmd,
+    which relays it to the server of conn over a Unix socket.  If a
+    process can't be started, fewer channels are used, and if none can
+    be set up, conn is used alone.
+
+    """
+    count = Globals.connection_channels - 1
+    if count < 1:
+        return
+    if Globals.get_api_version() < 201:
+        Log("Warning: data channels to {cmd} require API version 201, the "
+            "connection is used alone.".format(cmd=_safe_str(remote_cmd)), 2)
+        return
+    listening = conn.SetConnections.listen_for_channels()
+    if not listening:
+        Log("Warning: the server started by {cmd} doesn't support data "
+            "channels, the connection is used alone.".format(
+                cmd=_safe_str(remote_cmd)), 2)
+        return
+    path, key = listening
+    channels = []
+    for index in range(count):
+        remote = _open_remote(remote_cmd)
+        if not remote:
+            break
+        inpipe, outpipe, process, sock = remote
+        relay_conn = connection.PipeConnection(inpipe, outpipe)
+        relay_conn.reval_async("SetConnections.relay_channel",
+                               path, key + bytes((index, )))
+        channels.append(connection.DataChannel(
+            inpipe, outpipe, process=process, sock=sock))
+    # the server stops listening in any case, even without channels
+    if conn.SetConnections.accept_channels(len(channels)) and channels:
+        conn.data_channels = channels
+        Log("Data of connection {num} striped over {cnt} channels.".format(
+            num=conn.conn_number, cnt=len(channels) + 1), 4)
+    else:
+        for channel in channels:
+            channel.close()
+        Log("Warning: data channels to {cmd} couldn't be opened, the "
+            "connection is used alone.".format(cmd=_safe_str(remote_cmd)), 2)
+
+
+def _measure_connection(conn):
+    """Return the round trip time and bandwidth of conn, see tune_connections
+
+    The bandwidth is measured in both directions at once, random data
+    being sent and received back.
+
+    """
+    round_trip_time = min(_time_probe(conn, 0)
+                          for i in range(_TUNING_ROUND_TRIPS))
+    size, max_size = _TUNING_PROBE_SIZES
+    while True:
+        seconds = max(_time_probe(conn, size) - round_trip_time, 1e-6)
+        if seconds >= _TUNING_PROBE_SECONDS or size >= max_size:
+            return round_trip_time, 2 * size / seconds
+        size = min(size * 4, max_size)
+
+
+def _time_probe(conn, size):
+    """Return the seconds taken to exchange size random bytes with conn"""
+    data = os.urandom(size)
+    start_time = time.perf_counter()
+    conn.SetConnections.probe_connection(data, size)
+    return time.perf_counter() - start_time
+
+
+def _clamp(value, limits):
+    """Return value limited to the (minimum, maximum) pair limits"""
+    return min(max(value, limits[0]), limits[1])
 
 
 def _test_connection(conn_number, rp):
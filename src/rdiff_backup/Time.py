@@ -52,7 +52,7 @@ def setcurtime(curtime=None):
     """Sets the current time in curtime and curtimestr on all systems"""
     t = curtime or time.time()
     for conn in Globals.connections:
-        conn.Time.setcurtime_local(int(t))
+        conn.reval_async("Time.setcurtime_local", int(t))
 
 
 # @API(setcurtime_local, 200)
@@ -69,7 +69,7 @@ def setprevtime(timeinseconds):
             secs=timeinseconds))
     timestr = timetostring(timeinseconds)
     for conn in Globals.connections:
-        conn.Time.setprevtime_local(timeinseconds, timestr)
+        conn.reval_async("Time.setprevtime_local", timeinseconds, timestr)
 
 
 # @API(setprevtime_local, 200)
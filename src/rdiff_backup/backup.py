@@ -18,10 +18,18 @@
 # 02110-1301, USA
 """High level functions for mirroring and mirror+incrementing"""
 
+import collections
+import concurrent.futures
 import errno
+import io
 from . import Globals, metadata, rorpiter, Hardlink, robust, \
     increment, rpath, log, selection, Time, Rdiff, statistics, iterfile, \
-    hash, longname
+    hash, longname, sigcache, librsync
+
+
+# How many flush markers may be on their way, with signatures or diffs,
+# when these are pushed as streams, see DestinationStruct.get_sigs
+_MAX_FLUSHES_AHEAD = 2
 
 
 def Mirror(src_rpath, dest_rpath):
@@ -78,6 +86,7 @@ class SourceStruct:
         sel.parse_selection_args(tuplelist, filelists)
         sel_iter = sel.set_iter()
         cache_size = Globals.pipeline_max_length * 3  # to and from+leeway
+        cache_size += _get_sig_lookahead() + _get_stream_lookahead()
         cls._source_select = rorpiter.CacheIndexable(sel_iter, cache_size)
         Globals.set('select_mirror', sel_iter)
 
@@ -88,16 +97,59 @@ class SourceStruct:
 
     @classmethod
     def get_diffs(cls, dest_sigiter):
-        """Return diffs of any files with signature in dest_sigiter"""
+        """Return diffs of any files with signature in dest_sigiter
+
+        If more than one delta worker is configured, the diffs and
+        snapshots of the next files are read in parallel, ahead of the
+        consumer, as long as they fit in the delta buffer size.
+
+        The diffs are pushed as a stream to the destination if it is
+        remote and the API version allows it, see _is_streamed.
+
+        """
+        diff_iter = cls._get_diffs(dest_sigiter)
+        if _is_streamed():
+            return iterfile.MiscIterStream(diff_iter)
+        return diff_iter
+
+    @classmethod
+    def _get_diffs(cls, dest_sigiter):
+        """Yield diffs of dest_sigiter, see get_diffs"""
+        if Globals.delta_workers > 1:
+            prefetcher = _FilePrefetcher(Globals.delta_workers,
+                                         Globals.pipeline_max_length,
+                                         Globals.delta_buffer_size)
+            diff_iter = prefetcher.iterate(
+                cls._iterate_diffs(dest_sigiter, prefetcher.prefetch))
+        else:
+            diff_iter = cls._iterate_diffs(dest_sigiter)
+        for diff_rorp in diff_iter:
+            if (diff_rorp is iterfile.MiscIterFlush
+                    and Globals.backup_reader is Globals.backup_writer):
+                continue  # local flushes only limit the look-ahead
+            yield diff_rorp
+        log.Log("At most {mem} bytes of signatures were loaded at once "
+                "to compute deltas".format(
+                    mem=librsync.get_signature_memory()[1]), 6)
+
+    @classmethod
+    def _iterate_diffs(cls, dest_sigiter, prefetch=None):
+        """Yield diffs of dest_sigiter, prefetching files if requested"""
         source_rps = cls._source_select
         error_handler = robust.get_error_handler("ListError")
 
+        def attach_file(diff_rorp, src_rp, fileobj):
+            """Attach fileobj to diff_rorp, possibly prefetched"""
+            if prefetch:
+                fileobj = prefetch(fileobj, src_rp.getsize())
+            diff_rorp.setfile(fileobj)
+
         def attach_snapshot(diff_rorp, src_rp):
             """Attach file of snapshot to diff_rorp, w/ error checking"""
             fileobj = robust.check_common_error(
                 error_handler, rpath.RPath.open, (src_rp, "rb"))
             if fileobj:
-                diff_rorp.setfile(hash.FileWrapper(fileobj))
+                attach_file(diff_rorp, src_rp, hash.FileWrapper(fileobj))
             else:
                 diff_rorp.zero()
             diff_rorp.set_attached_filetype('snapshot')
@@ -107,15 +159,19 @@ class SourceStruct:
             fileobj = robust.check_common_error(
                 error_handler, Rdiff.get_delta_sigrp_hash, (dest_sig, src_rp))
             if fileobj:
-                diff_rorp.setfile(fileobj)
+                attach_file(diff_rorp, src_rp, fileobj)
                 diff_rorp.set_attached_filetype('diff')
             else:
                 diff_rorp.zero()
                 diff_rorp.set_attached_filetype('snapshot')
 
+        streamed = _is_streamed()
         for dest_sig in dest_sigiter:
             if dest_sig is iterfile.MiscIterFlushRepeat:
-                yield iterfile.MiscIterFlush  # Flush buffer when get_sigs does
+                if streamed:  # send it back to acknowledge the signatures
+                    yield dest_sig
+                else:
+                    yield iterfile.MiscIterFlush  # Flush buffer as get_sigs
                 continue
             src_rp = (source_rps.get(dest_sig.index)
                       or rpath.RORPath(dest_sig.index))
@@ -129,7 +185,7 @@ class SourceStruct:
                     reset_perms = True
                     src_rp.chmod(0o400 | src_rp.getperms())
 
-                if dest_sig.isreg():
+                if dest_sig.isreg() and dest_sig.file:
                     attach_diff(diff_rorp, src_rp, dest_sig)
                 else:
                     attach_snapshot(diff_rorp, src_rp)
@@ -145,6 +201,8 @@ class SourceStruct:
 # @API(DestinationStruct, 200)
 class DestinationStruct:
     """Hold info used by destination side when backing up"""
+    sig_cache = None  # sigcache.SigCache, if signatures are cached
+    flushes_ahead = 0  # flush markers sent with signatures, not back yet
 
     @classmethod
     def set_rorp_cache(cls, baserp, source_iter, for_increment):
@@ -159,59 +217,119 @@ class DestinationStruct:
         dest_iter = cls._get_dest_select(baserp, for_increment)
         collated = rorpiter.Collate2Iters(source_iter, dest_iter)
         cls.CCPP = CacheCollatedPostProcess(
-            collated, Globals.pipeline_max_length * 4, baserp)
+            collated, Globals.pipeline_max_length * 4 + _get_sig_lookahead()
+            + _get_stream_lookahead(), baserp)
         # pipeline len adds some leeway over just*3 (to and from and back)
+        cls.sig_cache = sigcache.get_cache()
 
     @classmethod
     def get_sigs(cls, dest_base_rpath):
-        """Yield signatures of any changed destination files
+        """Return iterator of signatures of any changed destination files
 
         If we are backing up across a pipe, we must flush the pipeline
         every so often so it doesn't get congested on destination end.
+        Locally, the flushes are only needed to limit how far the delta
+        workers may read ahead.
+
+        If the API version allows it, the signatures are instead pushed
+        as a stream, without waiting for the diffs, and the flush
+        markers come back with the diffs.  The signatures are paused
+        while too many markers are still out, so that they don't get
+        ahead of the patching by more than the caches hold.
+
+        If more than one signature worker is configured, the signatures
+        of the next changed files are computed in parallel, ahead of the
+        consumer, but still yielded in the order of the collated rorps.
+
+        """
+        cls.flushes_ahead = 0
+        if Globals.signature_workers > 1:
+            prefetcher = _FilePrefetcher(Globals.signature_workers,
+                                         _get_sig_lookahead())
+            sig_iter = prefetcher.iterate(
+                cls._iterate_sigs(dest_base_rpath, prefetcher.prefetch))
+        else:
+            sig_iter = cls._iterate_sigs(dest_base_rpath)
+        sig_iter = (sig for sig in sig_iter if sig is not None)
+        if _is_streamed():
+            return iterfile.MiscIterStream(sig_iter)
+        return sig_iter
+
+    @classmethod
+    def _iterate_sigs(cls, dest_base_rpath, prefetch=None):
+        """Yield signature, flush marker or None for each collated rorp
+
+        None is yielded for unchanged rorps, so that the caller can keep
+        track of the position within the CCPP.  If given, the prefetch
+        function is applied to the signature files before attaching them.
 
         """
         flush_threshold = Globals.pipeline_max_length - 2
         num_rorps_seen = 0
+        streamed = _is_streamed()
         for src_rorp, dest_rorp in cls.CCPP:
-            if (Globals.backup_reader is not Globals.backup_writer):
+            if (Globals.backup_reader is not Globals.backup_writer
+                    or Globals.delta_workers > 1):
                 num_rorps_seen += 1
                 if (num_rorps_seen > flush_threshold):
                     num_rorps_seen = 0
                     yield iterfile.MiscIterFlushRepeat
+                    if streamed:
+                        cls.flushes_ahead += 1
+                        while cls.flushes_ahead > _MAX_FLUSHES_AHEAD:
+                            yield iterfile.MiscIterFlush  # pause the stream
             if not (src_rorp and dest_rorp and src_rorp == dest_rorp
                     and (not Globals.preserve_hardlinks
                          or Hardlink.rorp_eq(src_rorp, dest_rorp))):
 
                 index = src_rorp and src_rorp.index or dest_rorp.index
                 sig = cls._get_one_sig(dest_base_rpath, index, src_rorp,
-                                       dest_rorp)
+                                       dest_rorp, prefetch)
                 if sig:
                     cls.CCPP.flag_changed(index)
                     yield sig
+                    continue
+            yield None
 
     @classmethod
     def patch(cls, dest_rpath, source_diffiter, start_index=()):
         """Patch dest_rpath with an rorpiter of diffs"""
-        ITR = rorpiter.IterTreeReducer(PatchITRB, [dest_rpath, cls.CCPP])
+        ITR = rorpiter.IterTreeReducer(PatchITRB,
+                                       [dest_rpath, cls.CCPP, cls.sig_cache])
+        source_diffiter = cls._count_flushes(source_diffiter)
         for diff in rorpiter.FillInIter(source_diffiter, dest_rpath):
             log.Log("Processing changed file %s" % diff.get_safeindexpath(), 5)
             ITR(diff.index, diff)
         ITR.finish_processing()
         cls.CCPP.close()
+        if cls.sig_cache:
+            cls.sig_cache.close()
         dest_rpath.setdata()
 
     @classmethod
     def patch_and_increment(cls, dest_rpath, source_diffiter, inc_rpath):
         """Patch dest_rpath with rorpiter of diffs and write increments"""
-        ITR = rorpiter.IterTreeReducer(IncrementITRB,
-                                       [dest_rpath, inc_rpath, cls.CCPP])
+        ITR = rorpiter.IterTreeReducer(
+            IncrementITRB, [dest_rpath, inc_rpath, cls.CCPP, cls.sig_cache])
+        source_diffiter = cls._count_flushes(source_diffiter)
         for diff in rorpiter.FillInIter(source_diffiter, dest_rpath):
             log.Log("Processing changed file %s" % diff.get_safeindexpath(), 5)
             ITR(diff.index, diff)
         ITR.finish_processing()
         cls.CCPP.close()
+        if cls.sig_cache:
+            cls.sig_cache.close()
         dest_rpath.setdata()
 
+    @classmethod
+    def _count_flushes(cls, diff_iter):
+        """Yield the diffs, counting the flush markers coming back"""
+        for diff in diff_iter:
+            if diff is iterfile.MiscIterFlushRepeat:
+                cls.flushes_ahead -= 1
+            else:
+                yield diff
+
     @classmethod
     def _get_dest_select(cls, rpath, use_metadata=1):
         """
@@ -237,7 +355,8 @@ class DestinationStruct:
         return get_iter_from_fs()
 
     @classmethod
-    def _get_one_sig(cls, dest_base_rpath, index, src_rorp, dest_rorp):
+    def _get_one_sig(cls, dest_base_rpath, index, src_rorp, dest_rorp,
+                     prefetch=None):
         """Return a signature given source and destination rorps"""
         if (Globals.preserve_hardlinks and src_rorp
                 and Hardlink.is_linked(src_rorp)):
@@ -245,11 +364,13 @@ class DestinationStruct:
             dest_sig.flaglinked(Hardlink.get_link_index(src_rorp))
         elif dest_rorp:
             dest_sig = dest_rorp.getRORPath()
-            if dest_rorp.isreg():
+            if dest_rorp.isreg() and not _is_small_file(dest_rorp):
                 dest_rp = longname.get_mirror_rp(dest_base_rpath, dest_rorp)
                 sig_fp = cls._get_one_sig_fp(dest_rp)
                 if sig_fp is None:
                     return None
+                if prefetch:
+                    sig_fp = prefetch(sig_fp)
                 dest_sig.setfile(sig_fp)
         else:
             dest_sig = rpath.RORPath(index)
@@ -269,6 +390,10 @@ class DestinationStruct:
             # destination.  Permissions are changed permanently, which
             # should propagate to the diffs
             dest_rp.chmod(0o400 | dest_rp.getperms())
+        if cls.sig_cache:
+            sig_fp = cls.sig_cache.get_signature(dest_rp)
+            if sig_fp is not None:
+                return sig_fp
         try:
             return Rdiff.get_signature(dest_rp)
         except IOError as e:
@@ -287,6 +412,179 @@ class DestinationStruct:
                 raise
 
 
+def _is_small_file(rorp):
+    """Return true if rorp is a regular file sent whole, without signature
+
+    Computing the signature and the delta of a small file costs more
+    than sending it whole, and snapshots of small files are packed
+    together by iterfile.MiscIterToFile.  Sources before API version 201
+    expect a signature for each regular file.
+
+    """
+    return (Globals.small_file_size and rorp.isreg()
+            and rorp.getsize() < Globals.small_file_size
+            and Globals.get_api_version() >= 201)
+
+
+def _is_streamed():
+    """Return true if signatures and diffs are pushed over a connection
+
+    Since API version 201, see iterfile.MiscIterStream, which avoids
+    waiting for a round trip each time the pipeline is flushed.
+
+    """
+    return (Globals.backup_reader is not Globals.backup_writer
+            and Globals.get_api_version() >= 201)
+
+
+def _get_stream_lookahead():
+    """Return by how many more rorps signatures may get ahead if streamed
+
+    While _MAX_FLUSHES_AHEAD flush markers haven't come back, as many
+    more pipelines of rorps are on their way to the source or back.
+
+    """
+    if _is_streamed():
+        return Globals.pipeline_max_length * _MAX_FLUSHES_AHEAD
+    return 0
+
+
+def _get_sig_lookahead():
+    """Return by how many rorps signatures may be computed in advance
+
+    The caches on source and destination side must be made larger by
+    this number so that they aren't outrun by the signature workers.
+
+    """
+    if Globals.signature_workers > 1:
+        return Globals.pipeline_max_length
+    return 0
+
+
+class _FilePrefetcher:
+    """Read files in a pool of threads ahead of their consumer
+
+    The files are registered while the objects they are attached to are
+    generated, and those objects are then delayed until enough newer
+    ones are waiting behind them, so that the workers have the time to
+    read the files completely into memory.  The order isn't changed.
+
+    """
+
+    def __init__(self, workers, max_lag, max_bytes=None):
+        """Initialize the prefetcher
+
+        The number of queued objects is limited to twice the number of
+        workers, and no object is held back while more than max_lag
+        objects have been generated after it.  If max_bytes is given,
+        files are only prefetched as long as the sum of their expected
+        sizes doesn't exceed it.
+
+        """
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.max_queued = 2 * workers
+        self.max_lag = max_lag
+        self.max_bytes = max_bytes
+        self.buffered_bytes = 0
+
+    def prefetch(self, fileobj, size=0):
+        """Return a file-like object giving the prefetched fileobj
+
+        size is the expected size of the content of fileobj.  If it
+        doesn't fit anymore in the buffer, fileobj is returned as is,
+        to be read only when needed.
+
+        """
+        if (self.max_bytes is not None
+                and self.buffered_bytes + size > self.max_bytes):
+            return fileobj
+        self.buffered_bytes += size
+
+        def release():
+            self.buffered_bytes -= size
+
+        return _PrefetchedFile(self.pool.submit(_read_whole_file, fileobj),
+                               release)
+
+    def iterate(self, obj_iter):
+        """Yield objects of obj_iter, delayed to let the pool work
+
+        A None object only counts for the lag.  A flush marker is a
+        barrier: it and all objects before it are yielded at once.
+
+        """
+        queue = collections.deque()  # holds (position, object) pairs
+        position = 0
+        try:
+            for obj in obj_iter:
+                position += 1
+                if obj is not None:
+                    queue.append((position, obj))
+                if (obj is iterfile.MiscIterFlush
+                        or obj is iterfile.MiscIterFlushRepeat):
+                    while queue:
+                        yield queue.popleft()[1]
+                while queue and (len(queue) > self.max_queued
+                                 or position - queue[0][0] >= self.max_lag):
+                    yield queue.popleft()[1]
+            while queue:
+                yield queue.popleft()[1]
+        finally:
+            self.pool.shutdown()
+
+
+class _PrefetchedFile:
+    """File-like object returning the result of _read_whole_file
+
+    The release function is called once the content has been entirely
+    read, or as soon as the file is closed or has failed.
+
+    """
+
+    def __init__(self, future, release=None):
+        self.future = future
+        self.release = release
+        self.buf = None
+        self.closeval = None
+
+    def read(self, length=-1):
+        """Return next length bytes, waiting for the worker if needed"""
+        if self.buf is None:
+            try:
+                data, self.closeval = self.future.result()
+            except BaseException:
+                self._release()
+                raise
+            self.buf = io.BytesIO(data)
+        result = self.buf.read(length)
+        if not result and length != 0:
+            self._release()
+        return result
+
+    def close(self):
+        """Pass on the close value of the original file"""
+        self._release()
+        if self.buf is None:
+            self.closeval = self.future.result()[1]
+        return self.closeval
+
+    def _release(self):
+        """Call the release function, but only once"""
+        if self.release:
+            self.release()
+            self.release = None
+
+
+def _read_whole_file(fileobj):
+    """Return the content and close value of fileobj"""
+    try:
+        data = fileobj.read()
+    except BaseException:
+        fileobj.close()
+        raise
+    return data, fileobj.close()
+
+
 class CacheCollatedPostProcess:
     """
 
@@ -543,7 +841,11 @@ class CacheCollatedPostProcess:
         if success == 1 or success == 2:
             self.statfileobj.add_changed(source_rorp, dest_rorp)
 
-        if metadata_rorp and metadata_rorp.lstat():
+        if isinstance(self.metawriter, metadata.DiffWriter):
+            if metadata_rorp and not metadata_rorp.lstat():
+                metadata_rorp = None
+            self.metawriter.write_diff(metadata_rorp, dest_rorp)
+        elif metadata_rorp and metadata_rorp.lstat():
             self.metawriter.write_object(metadata_rorp)
         if Globals.file_statistics:
             statistics.FileStats.update(source_rorp, dest_rorp, changed, inc)
@@ -575,8 +877,13 @@ class PatchITRB(rorpiter.ITRBranch):
 
     """
 
-    def __init__(self, basis_root_rp, CCPP):
-        """Set basis_root_rp, the base of the tree to be incremented"""
+    def __init__(self, basis_root_rp, CCPP, sig_cache=None):
+        """Set basis_root_rp, the base of the tree to be incremented
+
+        If given, the signatures of the new mirror files are stored in
+        the sigcache.SigCache sig_cache as they are written.
+
+        """
         self.basis_root_rp = basis_root_rp
         assert basis_root_rp.conn is Globals.local_connection, (
             "Basis root path connection {conn} isn't "
@@ -586,6 +893,7 @@ class PatchITRB(rorpiter.ITRBranch):
                             or statistics.StatFileObj())
         self.dir_replacement, self.dir_update = None, None
         self.CCPP = CCPP
+        self.sig_cache = sig_cache
         self.error_handler = robust.get_error_handler("UpdateError")
 
     def can_fast_process(self, index, diff_rorp):
@@ -605,15 +913,19 @@ class PatchITRB(rorpiter.ITRBranch):
                 if robust.check_common_error(self.error_handler, rpath.rename,
                                              (tf, mirror_rp)) is None:
                     self.CCPP.flag_success(index)
+                    self._update_sig_cache(index, mirror_rp)
                 else:
                     tf.delete()
             elif mirror_rp and mirror_rp.lstat():
                 mirror_rp.delete()
                 self.CCPP.flag_deleted(index)
+                self._update_sig_cache(index, mirror_rp)
         else:
             tf.setdata()
             if tf.lstat():
                 tf.delete()
+        if self.sig_cache:
+            self.sig_cache.discard(index)
 
     def start_process_directory(self, index, diff_rorp):
         """Start processing directory - record information for later"""
@@ -701,7 +1013,8 @@ class PatchITRB(rorpiter.ITRBranch):
             rpath.copy_attribs(diff_rorp, new)
             return 2
 
-        report = robust.check_common_error(self.error_handler, rpath.copy,
+        report = robust.check_common_error(self.error_handler,
+                                           self._copy_snapshot,
                                            (diff_rorp, new))
         if isinstance(report, hash.Report):
             self.CCPP.update_hash(diff_rorp.index, report.sha1_digest)
@@ -715,12 +1028,38 @@ class PatchITRB(rorpiter.ITRBranch):
                 rp=diff_rorp, exp="diff",
                 att=diff_rorp.get_attached_filetype()))
         report = robust.check_common_error(
-            self.error_handler, Rdiff.patch_local, (basis_rp, diff_rorp, new))
+            self.error_handler, Rdiff.patch_local,
+            (basis_rp, diff_rorp, new, None, self._get_sig_wrapper(diff_rorp)))
         if isinstance(report, hash.Report):
             self.CCPP.update_hash(diff_rorp.index, report.sha1_digest)
             return 1
         return report != 0  # if report == 0, error
 
+    def _copy_snapshot(self, diff_rorp, new):
+        """Copy diff_rorp to new, computing its signature if cached"""
+        sig_wrapper = self._get_sig_wrapper(diff_rorp)
+        if not sig_wrapper:
+            return rpath.copy(diff_rorp, new)
+        if new.lstat():
+            new.delete()
+        return new.write_from_fileobj(sig_wrapper(diff_rorp.open("rb")))
+
+    def _get_sig_wrapper(self, diff_rorp):
+        """Return function wrapping the new data to compute its signature
+
+        None is returned if no signature needs to be computed.
+
+        """
+        if not self.sig_cache or not diff_rorp.isreg():
+            return None
+        return lambda fp: self.sig_cache.wrap(diff_rorp.index, fp,
+                                              diff_rorp.getsize())
+
+    def _update_sig_cache(self, index, mirror_rp):
+        """Store signature of the mirror file after it has been changed"""
+        if self.sig_cache:
+            self.sig_cache.update(index, mirror_rp)
+
     def _matches_cached_rorp(self, diff_rorp, new_rp):
         """Return true if new_rp matches cached src rorp
 
@@ -761,7 +1100,10 @@ class PatchITRB(rorpiter.ITRBranch):
                 rp=diff_rorp, exp="snapshot",
                 att=diff_rorp.get_attached_filetype()))
         self.dir_replacement = base_rp.get_temp_rpath(sibling=True)
-        if not self._patch_to_temp(None, diff_rorp, self.dir_replacement):
+        patched = self._patch_to_temp(None, diff_rorp, self.dir_replacement)
+        if self.sig_cache:  # only renamed later on, so don't cache
+            self.sig_cache.discard(diff_rorp.index)
+        if not patched:
             if self.dir_replacement.lstat():
                 self.dir_replacement.delete()
             # Was an error, so now restore original directory
@@ -793,9 +1135,10 @@ class IncrementITRB(PatchITRB):
 
     """
 
-    def __init__(self, basis_root_rp, inc_root_rp, rorp_cache):
+    def __init__(self, basis_root_rp, inc_root_rp, rorp_cache,
+                 sig_cache=None):
         self.inc_root_rp = inc_root_rp
-        PatchITRB.__init__(self, basis_root_rp, rorp_cache)
+        PatchITRB.__init__(self, basis_root_rp, rorp_cache, sig_cache)
 
     def fast_process_file(self, index, diff_rorp):
         """Patch base_rp with diff_rorp and write increment (neither is dir)"""
@@ -815,12 +1158,18 @@ class IncrementITRB(PatchITRB):
                                                  rpath.rename,
                                                  (tf, mirror_rp)) is None:
                         self.CCPP.flag_success(index)
+                        self._update_sig_cache(index, mirror_rp)
                     else:
                         tf.delete()
                 elif mirror_rp.lstat():
                     mirror_rp.delete()
                     self.CCPP.flag_deleted(index)
+                    self._update_sig_cache(index, mirror_rp)
+                if self.sig_cache:
+                    self.sig_cache.discard(index)
                 return  # normal return, otherwise error occurred
+        if self.sig_cache:
+            self.sig_cache.discard(index)
         tf.setdata()
         if tf.lstat():
             tf.delete()
@@ -18,9 +18,15 @@
 # 02110-1301, USA
 """Support code for remote execution and data transfer"""
 
+import collections
+import itertools
 import pickle
+import queue
 import sys
+import threading
+import time
 import traceback
+import zlib
 # we need those imports because they are used through the connection
 import gzip  # noqa: F401
 import os  # noqa: F401
@@ -45,6 +51,26 @@ try:
     import win32security  # noqa: F401
 except ImportError:
     pass
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Frames shorter than this aren't worth compressing
+_MIN_COMPRESSED_LEN = 256
+# Frames longer than 3 samples are only compressed if a sample of their
+# beginning, middle and end compresses to less than _MAX_SAMPLE_RATIO.
+_SAMPLE_LEN = 1024
+_MAX_SAMPLE_RATIO = 0.9
+# A stream may be sent ahead of its reads by this many connection buffers
+_STREAM_WINDOW_BUFFERS = 8
+# Frames are read into a reused buffer up to this many connection buffers
+_MAX_REUSED_BUFFERS = 4
+# At most this many parts are gathered by a single os.writev call
+try:
+    _MAX_WRITEV_PARTS = max(os.sysconf("SC_IOV_MAX"), 16)
+except (AttributeError, ValueError, OSError):
+    _MAX_WRITEV_PARTS = 16
 
 
 class ConnectionError(Exception):
@@ -82,6 +108,24 @@ class Connection:
     def __bool__(self):
         return True
 
+    def reval_async(self, function_string, *args):
+        """Execute command like reval, but without waiting for its result
+
+        Only connections through a pipe actually return before the
+        command has run, see PipeConnection.reval_async.
+
+        """
+        self.reval(function_string, *args)
+
+    def batch(self):
+        """Return context in which the calls made are sent together
+
+        Only connections through a pipe actually group them, see
+        PipeConnection.batch.
+
+        """
+        return _CallBatch(None)
+
 
 class LocalConnection(Connection):
     """Local connection
@@ -123,15 +167,24 @@ class LocalConnection(Connection):
 
 
 class ConnectionRequest:
-    """Simple wrapper around a PipeConnection request"""
+    """Simple wrapper around a PipeConnection request
+
+    An asynchronous request isn't answered, see
+    PipeConnection.reval_async.
 
-    def __init__(self, function_string, num_args):
+    """
+    asynchronous = False  # requests of API 200 don't set it
+
+    def __init__(self, function_string, num_args, asynchronous=False):
         self.function_string = function_string
         self.num_args = num_args
+        if asynchronous:
+            self.asynchronous = True
 
     def __str__(self):
-        return "ConnectionRequest: %s with %d arguments" % \
-            (self.function_string, self.num_args)
+        return "ConnectionRequest: %s with %d arguments%s" % \
+            (self.function_string, self.num_args,
+             self.asynchronous and " (asynchronous)" or "")
 
 
 class LowLevelPipeConnection(Connection):
@@ -152,14 +205,60 @@ class LowLevelPipeConnection(Connection):
     R - RPath
     Q - QuotedRPath
     r - RORPath only
+    p - RORPath packed by rorpcoding
     c - PipeConnection object
+    z - compressed frame, see _compress
+    I - iterator pushed as a stream
+    s - chunk of a stream, not part of any request
+    a - credit given back for a stream, not part of any request
+
+    Frames are only compressed once compression has been negotiated
+    with the other side, see SetConnections.
+
+    The chunks of a stream are sent as long as the receiving side has
+    given credits for them, in bytes, so that at most a window of
+    _STREAM_WINDOW_BUFFERS connection buffers is on its way or waiting
+    to be read.  A chunk holds the stream identifier, a kind byte ("d"
+    for data, "z" for the last data, "e" for an exception), the number
+    of bytes of file data sent over data channels with it, and data.
+
+    If the connection has data channels, see DataChannel, the big chunks
+    of files sent through iterators are striped over them.
+
+    The data of a frame can be given as a list of parts, which are
+    written together with the header by a single gathering write, see
+    _write_parts, instead of being joined first.  Frames whose data
+    isn't kept once read are read into a buffer reused from frame to
+    frame.
+
+    Once streams are pushed, frames are written by a thread of their
+    own, in order, so that both sides never wait for each other to
+    read while pushing streams to each other, see _start_writer.
 
     """
+    compression = None  # (method, level) used to compress frames
 
     def __init__(self, inpipe, outpipe):
         """inpipe is a file-type open for reading, outpipe for writing"""
         self.inpipe = inpipe
         self.outpipe = outpipe
+        self.outfd = _get_writev_fd(outpipe)
+        self.out_queue = None  # of frames to write, see _start_writer
+        self.writer = None
+        self.write_error = None  # exception which stopped the writer
+        self.in_buffer = bytearray()  # reused to read frames, see _get
+        self.in_streams = {}  # StreamFile of each stream received, by id
+        self.out_streams = {}  # _OutStream of each stream sent, by id
+        self.out_buffer = None  # frames held back in a batch, see _write
+        self.out_buffer_len = 0
+        self.data_channels = []  # DataChannel list, the same on both sides
+        # bytes of frames before and after compression, sent and received,
+        # and seconds spent to compress and decompress them
+        self.compression_stats = [0, 0, 0.0]
+        # frames and bytes sent, frames and bytes received, by frame type
+        self.frame_stats = {}
+        self.bytes_sent = 0  # bytes of all frames, before compression
+        self.bytes_received = 0
 
     def __str__(self):
         """Return string version
@@ -187,6 +286,8 @@ class LowLevelPipeConnection(Connection):
         elif ((hasattr(obj, "read") or hasattr(obj, "write"))
               and hasattr(obj, "close")):
             self._putfile(obj, req_num)
+        elif isinstance(obj, iterfile.MiscIterStream):
+            self._putstream(obj, req_num)
         elif hasattr(obj, "__next__") and hasattr(obj, "__iter__"):
             self._putiter(obj, req_num)
         else:
@@ -207,9 +308,44 @@ class LowLevelPipeConnection(Connection):
     def _putiter(self, iterator, req_num):
         """Put an iterator through the pipe"""
         self._write(
-            "i", self._i2b(VirtualFile.new(iterfile.MiscIterToFile(iterator))),
+            "i", self._i2b(VirtualFile.new(iterfile.MiscIterToFile(
+                iterator, channels=self.data_channels))),
             req_num)
 
+    def _putstream(self, stream, req_num):
+        """Put an iterator through the pipe, to be pushed as a stream
+
+        The chunks of the stream are only sent once the other side has
+        given credits for them, see PipeConnection._push_streams.  The
+        iterator is sent like any other before API version 201.
+
+        """
+        if Globals.get_api_version() < 201:
+            self._putiter(stream, req_num)
+            return
+        stream_id = next(_stream_ids)
+        self.out_streams[stream_id] = _OutStream(
+            iterfile.MiscIterToFile(stream, channels=self.data_channels))
+        self._write("I", self._i2b(stream_id, 4), req_num)
+
+    def _putstreamchunk(self, stream_id, kind, data, striped_len=0):
+        """Send a chunk of the stream with the given id
+
+        striped_len is the number of bytes sent over data channels with
+        the chunk, accounted for in the credits like the chunk itself.
+        data can be a list of parts, see _write.
+
+        """
+        if not isinstance(data, list):
+            data = [data]
+        self._start_writer()
+        self._write("s", [self._i2b(stream_id, 4) + kind
+                          + self._i2b(striped_len, 7)] + data, 0)
+
+    def _putstreamcredit(self, stream_id, credit):
+        """Allow the other side to send credit more bytes of a stream"""
+        self._write("a", self._i2b(stream_id, 4) + self._i2b(credit, 8), 0)
+
     def _putrpath(self, rpath, req_num):
         """Put an rpath into the pipe
 
@@ -236,6 +372,12 @@ class LowLevelPipeConnection(Connection):
         it must be excluded from the pickling
 
         """
+        if rorpcoding.is_supported():
+            packed = rorpcoding.RORPEncoder().encode(rorpath.index,
+                                                     rorpath.data)
+            if packed is not None:
+                self._write("p", packed, req_num)
+                return
         rorpath_repr = (rorpath.index, rorpath.data)
         self._write("r", pickle.dumps(rorpath_repr,
                                       Globals.PICKLE_PROTOCOL), req_num)
@@ -254,19 +396,141 @@ class LowLevelPipeConnection(Connection):
         self._write("q", b"", 255)
 
     def _write(self, headerchar, data, req_num):
-        """Write header and then data to the pipe"""
+        """Write header and then data, bytes or a list of parts, to the pipe"""
         assert len(headerchar) == 1, (
             "Header type {hdr} can only have one letter/byte".format(
                 hdr=headerchar))
         if isinstance(headerchar, str):  # it can only be an ASCII character
             headerchar = headerchar.encode('ascii')
+        parts = data if isinstance(data, list) else [data]
+        length = sum(map(len, parts))
+        self.compression_stats[0] += 9 + length
+        self._count_frame(headerchar, 0, 9 + length)
+        self.bytes_sent += 9 + length
+        if self.compression and length >= _MIN_COMPRESSED_LEN:
+            headerchar, data = self._compress(headerchar, b"".join(parts))
+            parts, length = [data], len(data)
+        self.compression_stats[1] += 9 + length
+        header = headerchar + self._i2b(req_num, 1) + self._i2b(length, 7)
+        if self.out_buffer is not None:
+            self.out_buffer.append(header)
+            self.out_buffer.extend(parts)
+            self.out_buffer_len += 9 + length
+            if self.out_buffer_len >= Globals.conn_bufsize:
+                self._flush_frames()
+            return
+        self._write_frames([header] + parts)
+
+    def _flush_frames(self):
+        """Write the frames held back in out_buffer at once"""
+        parts = self.out_buffer[:]
+        self.out_buffer.clear()
+        self.out_buffer_len = 0
+        self._write_frames(parts)
+
+    def _write_frames(self, parts):
+        """Write the parts of whole frames, or queue them for the writer"""
+        if self.write_error is not None:
+            raise ConnectionWriteError(
+                "Writer failed: {exc}".format(exc=self.write_error))
+        if self.out_queue is not None:
+            self.out_queue.put(parts)
+            return
         try:
-            self.outpipe.write(headerchar + self._i2b(req_num, 1) + self._i2b(len(data), 7))
-            self.outpipe.write(data)
-            self.outpipe.flush()
+            _write_parts(self.outpipe, self.outfd, parts)
         except (IOError, AttributeError):
             raise ConnectionWriteError()
 
+    def _start_writer(self):
+        """Write the frames in a thread from now on, if not done yet
+
+        Both sides may push streams at the same time, hence write more
+        than the pipes can hold before reading.  Writing in a thread,
+        the connection keeps on reading meanwhile, the frames queued
+        being bounded by the credits of the streams.
+
+        """
+        if self.out_queue is None:
+            self.out_queue = queue.Queue()
+            self.writer = threading.Thread(target=self._write_queued,
+                                           daemon=True)
+            self.writer.start()
+
+    def _write_queued(self):
+        """Write the frames queued until None, in the writer thread"""
+        while True:
+            parts = self.out_queue.get()
+            if parts is None:
+                break
+            try:
+                _write_parts(self.outpipe, self.outfd, parts)
+            except (IOError, AttributeError) as exc:
+                self.write_error = exc
+                break
+
+    def _count_frame(self, headerchar, pos, length):
+        """Count a frame sent (pos 0) or received (pos 2) in frame_stats"""
+        try:
+            stats = self.frame_stats[headerchar]
+        except KeyError:
+            stats = self.frame_stats[headerchar] = [0, 0, 0, 0]
+        stats[pos] += 1
+        stats[pos + 1] += length
+
+    def get_statistics(self):
+        """Return the statistics of the frames exchanged as a dictionary
+
+        The frames and bytes sent and received are given by frame type,
+        the bytes being counted before compression, header included.
+
+        """
+        return {"frames": {
+            headerchar.decode("ascii"): dict(zip(
+                ("sent_frames", "sent_bytes",
+                 "received_frames", "received_bytes"), stats))
+            for headerchar, stats in sorted(self.frame_stats.items())}}
+
+    def _compress(self, headerchar, data):
+        """Return the (header character, data) pair to send for data
+
+        A compressed frame holds the original header character, the
+        compression method and the compressed data.  The data is sent
+        uncompressed if a sample of it, or the data itself, doesn't
+        compress well, e.g. because it's already compressed.
+
+        """
+        start_time = time.perf_counter()
+        try:
+            if len(data) > 3 * _SAMPLE_LEN:
+                middle = (len(data) - _SAMPLE_LEN) // 2
+                sample = b"".join((data[:_SAMPLE_LEN],
+                                   data[middle:middle + _SAMPLE_LEN],
+                                   data[-_SAMPLE_LEN:]))
+                if (len(zlib.compress(sample, 1))
+                        > len(sample) * _MAX_SAMPLE_RATIO):
+                    return headerchar, data
+            method, level = self.compression
+            method_id, compress = _COMPRESSORS[method]
+            compressed = compress(data, level)
+            if len(compressed) + 2 >= len(data):
+                return headerchar, data
+            return b"z", b"".join((headerchar, bytes((method_id, )),
+                                   compressed))
+        finally:
+            self.compression_stats[2] += time.perf_counter() - start_time
+
+    def _decompress(self, data):
+        """Return the (header character, data) pair of a compressed frame"""
+        start_time = time.perf_counter()
+        try:
+            decompress = _DECOMPRESSORS[data[1]]
+        except KeyError:
+            raise ConnectionReadError(
+                "Compression method {meth} invalid.".format(meth=data[1]))
+        result = bytes(data[0:1]), decompress(data[2:])
+        self.compression_stats[2] += time.perf_counter() - start_time
+        return result
+
     def _read(self, length):
         """Read length bytes from inpipe, returning result"""
         try:
@@ -274,6 +538,32 @@ class LowLevelPipeConnection(Connection):
         except IOError:
             raise ConnectionReadError()
 
+    def _read_reused(self, length):
+        """Read length bytes from inpipe into in_buffer, returning a view
+
+        The view is only valid until the next frame is read, which saves
+        the allocation of a new buffer for each frame.  Frames bigger
+        than a few connection buffers are read as usual, not to keep a
+        big buffer around.
+
+        """
+        if (length > _MAX_REUSED_BUFFERS * Globals.conn_bufsize
+                or not hasattr(self.inpipe, "readinto")):
+            return self._read(length)
+        if len(self.in_buffer) < length:
+            self.in_buffer = bytearray(length)
+        view = memoryview(self.in_buffer)[:length]
+        pos = 0
+        try:
+            while pos < length:
+                read_len = self.inpipe.readinto(view[pos:])
+                if not read_len:
+                    return view[:pos]
+                pos += read_len
+        except IOError:
+            raise ConnectionReadError()
+        return view
+
     def _b2i(self, b):
         """Convert bytes to int using big endian byteorder"""
         return int.from_bytes(b, byteorder='big')
@@ -286,6 +576,8 @@ class LowLevelPipeConnection(Connection):
 
     def _get(self):
         """Read an object from the pipe and return (req_num, value)"""
+        if self.out_buffer:  # the other side may wait for them
+            self._flush_frames()
         header_string = self.inpipe.read(9)
         if not len(header_string) == 9:
             raise ConnectionReadError("Truncated header string (problem "
@@ -297,7 +589,16 @@ class LowLevelPipeConnection(Connection):
         if format_string == b"q":
             raise ConnectionQuit("Received quit signal")
 
-        data = self._read(length)
+        if format_string in b"bs":  # data kept once the frame is read
+            data = self._read(length)
+        else:
+            data = self._read_reused(length)
+        self.compression_stats[1] += 9 + length
+        if format_string == b"z":
+            format_string, data = self._decompress(data)
+        self.compression_stats[0] += 9 + len(data)
+        self._count_frame(format_string, 2, 9 + len(data))
+        self.bytes_received += 9 + len(data)
         if format_string == b"o":
             result = pickle.loads(data)
         elif format_string == b"b":
@@ -306,9 +607,20 @@ class LowLevelPipeConnection(Connection):
             result = VirtualFile(self, self._b2i(data))
         elif format_string == b"i":
             result = iterfile.FileToMiscIter(
-                VirtualFile(self, self._b2i(data)))
+                VirtualFile(self, self._b2i(data)), self.data_channels)
+        elif format_string == b"I":
+            result = iterfile.FileToMiscIter(
+                StreamFile(self, self._b2i(data)), self.data_channels)
+        elif format_string == b"s":
+            self._getstreamchunk(data)
+            return (None, None)
+        elif format_string == b"a":
+            self._getstreamcredit(data)
+            return (None, None)
         elif format_string == b"r":
             result = self._getrorpath(data)
+        elif format_string == b"p":
+            result = self._getpackedrorpath(data)
         elif format_string == b"R":
             result = self._getrpath(data)
         elif format_string == b"Q":
@@ -321,11 +633,35 @@ class LowLevelPipeConnection(Connection):
         log.Log.conn("received", result, req_num)
         return (req_num, result)
 
+    def _getstreamchunk(self, chunk):
+        """Queue the data of a stream chunk for its StreamFile"""
+        stream_id, kind = self._b2i(chunk[:4]), chunk[4:5]
+        stream = self.in_streams[stream_id]
+        if kind == b"e":
+            stream.chunks.append((pickle.loads(chunk[12:]), 0))
+        else:  # the data is given as view, not to copy it
+            stream.chunks.append((memoryview(chunk)[12:],
+                                  len(chunk) - 12 + self._b2i(chunk[5:12])))
+        if kind != b"d":  # the stream won't receive anything anymore
+            del self.in_streams[stream_id]
+
+    def _getstreamcredit(self, credit):
+        """Add the credit given back by the other side to its stream"""
+        stream = self.out_streams.get(self._b2i(credit[:4]))
+        if stream:  # else it has already been sent completely
+            stream.credit += self._b2i(credit[4:])
+
     def _getrorpath(self, raw_rorpath_buf):
         """Reconstruct RORPath object from raw data"""
         index, data = pickle.loads(raw_rorpath_buf)
         return rpath.RORPath(index, data)
 
+    def _getpackedrorpath(self, packed_rorpath_buf):
+        """Reconstruct RORPath object from a record packed by rorpcoding"""
+        index, data, has_file = rorpcoding.RORPDecoder().decode(
+            packed_rorpath_buf)
+        return rpath.RORPath(index, data)
+
     def _getrpath(self, raw_rpath_buf):
         """Return RPath object indicated by raw_rpath_buf"""
         conn_number, base, index, data = pickle.loads(raw_rpath_buf)
@@ -340,6 +676,11 @@ class LowLevelPipeConnection(Connection):
 
     def _close(self):
         """Close the pipes associated with the connection"""
+        if self.writer is not None:
+            self.out_queue.put(None)
+            self.writer.join()
+        for channel in self.data_channels:
+            channel.close()
         self.outpipe.close()
         self.inpipe.close()
 
@@ -373,6 +714,15 @@ class PipeConnection(LowLevelPipeConnection):
         self.unused_request_numbers = {}
         for i in range(256):
             self.unused_request_numbers[i] = None
+        # responses received while waiting for another one, by req_num
+        self.early_responses = {}
+        self.pushing = False  # true while streams are being pushed
+        # exception of an asynchronous request not reported yet
+        self.async_error = None
+        # calls, seconds, maximum seconds, bytes sent and received, by
+        # function string, of the requests made and of those answered
+        self.request_stats = {}
+        self.answer_stats = {}
 
     def __str__(self):
         return "PipeConnection %d" % self.conn_number
@@ -397,12 +747,14 @@ class PipeConnection(LowLevelPipeConnection):
         function.
 
         """
+        start = self._start_call()
         req_num = self._get_new_req_num()
         self._put(ConnectionRequest(function_string, len(args)), req_num)
         for arg in args:
             self._put(arg, req_num)
         result = self._get_response(req_num)
         self.unused_request_numbers[req_num] = None
+        self._count_call(self.request_stats, function_string, start)
         if isinstance(result, Exception):
             raise result
         elif isinstance(result, SystemExit):
@@ -412,12 +764,57 @@ class PipeConnection(LowLevelPipeConnection):
         else:
             return result
 
+    def reval_async(self, function_string, *args):
+        """Execute command on remote side without waiting for its result
+
+        The request is sent at once, or with the others of the batch if
+        made in one, see batch.  Its result is dropped by the remote
+        side, and an exception raised by it is only raised by the next
+        synchronous request, e.g. reval, which isn't executed then.
+        The asynchronous requests following a failed one are skipped.
+
+        Requests made back to this side by the command are only answered
+        once this side reads from the connection again, e.g. for the
+        next synchronous request.  Before API version 201, the request
+        is synchronous.
+
+        """
+        if Globals.get_api_version() < 201:
+            self.reval(function_string, *args)
+            return
+        start = self._start_call()
+        req_num = self._get_new_req_num()
+        self._put(ConnectionRequest(function_string, len(args), True),
+                  req_num)
+        for arg in args:
+            self._put(arg, req_num)
+        # no response will come, the other side reads requests in order
+        self.unused_request_numbers[req_num] = None
+        self._count_call(self.request_stats, function_string, start)
+
+    def batch(self):
+        """Return context in which the requests made are sent together
+
+        All frames written within the context are held back and written
+        at once when leaving it, or before reading from the connection,
+        e.g. for the result of a synchronous request.  Hence a batch of
+        asynchronous requests, possibly closed by a synchronous one, only
+        costs a single round trip:
+
+            with conn.batch():
+                conn.reval_async("Globals.set", "foo", 1)
+                conn.reval_async("Globals.set", "bar", 2)
+
+        """
+        return _CallBatch(self)
+
     # @API(quit, 200)
     def quit(self):
         """Close the associated pipes and tell server side to quit"""
         assert not Globals.server, "This function shouldn't run as server."
         self._putquit()
-        self._get()
+        while self._get()[0] is None:  # skip the frames of streams
+            pass
         self._close()
 
     def _get_response(self, desired_req_num):
@@ -426,26 +823,143 @@ class PipeConnection(LowLevelPipeConnection):
         Sometimes after a request is sent, the other side will make
         another request before responding to the original one.  In
         that case, respond to the request.  But return once the right
-        response is given.
+        response is given.  Streams are pushed before each read.
+
+        A response to an outer request, whose stream was being pushed
+        when this request was made, is kept until it is desired.
 
         """
         while 1:
+            self._push_streams()  # may itself receive the response
+            if desired_req_num in self.early_responses:
+                return self.early_responses.pop(desired_req_num)
             try:
                 req_num, object = self._get()
             except ConnectionQuit:
+                if self.async_error is not None:
+                    log.Log("Error of asynchronous request never reported: "
+                            "{exc}".format(exc=self.async_error), 2)
                 self._put("quitting", self._get_new_req_num())
                 self._close()
                 return
             if req_num == desired_req_num:
                 return object
+            elif req_num is None:  # frame of a stream, already handled
+                continue
+            elif isinstance(object, ConnectionRequest):
+                self._answer_request(object, req_num)
             else:
-                assert isinstance(object, ConnectionRequest), (
+                assert req_num not in self.unused_request_numbers, (
                     "Object '{obj}' isn't a connection request but "
                     "a '{otype}'.".format(obj=object, otype=type(object)))
+                self.early_responses[req_num] = object
+
+    def _wait_for_stream(self, stream):
+        """Read from pipe, responding to requests, until stream has chunks
+
+        If a response is received meanwhile, the request using the
+        stream is over and ConnectionReadError is raised, because the
+        stream won't be sent any further.
+
+        """
+        while 1:
+            self._push_streams()  # may itself receive chunks or responses
+            if stream.chunks:
+                return
+            if self.early_responses:
+                raise ConnectionReadError(
+                    "Request answered while waiting for stream {sid}".format(
+                        sid=stream.id))
+            req_num, object = self._get()
+            if req_num is None:
+                continue
+            elif isinstance(object, ConnectionRequest):
                 self._answer_request(object, req_num)
+            else:
+                self.early_responses[req_num] = object
+
+    def _push_streams(self):
+        """Send the chunks of the streams allowed by their credits
+
+        Reading the stream may lead to further requests and waits, in
+        which pushing is skipped.  An exception raised by reading is
+        sent to the other side, to be raised by its StreamFile.
+
+        """
+        if self.pushing or not self.out_streams:
+            return
+        self.pushing = True
+        try:
+            for stream_id, stream in list(self.out_streams.items()):
+                while stream.credit > 0 and not self.early_responses:
+                    try:
+                        data = stream.file.read_parts()
+                    except Exception as exc:
+                        del self.out_streams[stream_id]
+                        if self.early_responses:
+                            break  # nobody is reading the stream anymore
+                        if robust.is_routine_fatal(exc):
+                            raise
+                        self._putstreamchunk(
+                            stream_id, b"e",
+                            pickle.dumps(exc, Globals.PICKLE_PROTOCOL))
+                        break
+                    striped_len = stream.file.striped_len
+                    if stream.file.finished:
+                        del self.out_streams[stream_id]
+                        self._putstreamchunk(stream_id, b"z", data,
+                                             striped_len)
+                        break
+                    data_len = sum(map(len, data))
+                    if not data_len:  # paused, see iterfile.MiscIterStream
+                        break
+                    stream.credit -= data_len + striped_len
+                    self._putstreamchunk(stream_id, b"d", data, striped_len)
+        finally:
+            self.pushing = False
+
+    def get_statistics(self):
+        """Return the statistics of the connection as a dictionary
+
+        Besides the frames, see LowLevelPipeConnection.get_statistics,
+        the requests made and answered are given by function string,
+        with their number of calls, the total and maximum seconds they
+        took, and the bytes sent and received meanwhile.  The time and
+        bytes of a request include those of the requests nested in it,
+        and only the sending of an asynchronous request is accounted.
+
+        """
+        conn_stats = LowLevelPipeConnection.get_statistics(self)
+        for key, call_stats in (("requests", self.request_stats),
+                                ("answers", self.answer_stats)):
+            conn_stats[key] = {
+                function_string: dict(zip(
+                    ("calls", "seconds", "max_seconds",
+                     "sent_bytes", "received_bytes"), stats))
+                for function_string, stats in sorted(call_stats.items())}
+        return conn_stats
+
+    def _start_call(self):
+        """Return the start of a call to be given to _count_call"""
+        return (time.perf_counter(), self.bytes_sent, self.bytes_received)
+
+    def _count_call(self, call_stats, function_string, start):
+        """Count a call started at start in call_stats"""
+        seconds = time.perf_counter() - start[0]
+        try:
+            stats = call_stats[function_string]
+        except KeyError:
+            stats = call_stats[function_string] = [0, 0.0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+        stats[3] += self.bytes_sent - start[1]
+        stats[4] += self.bytes_received - start[2]
 
     def _answer_request(self, request, req_num):
         """Put the object requested by request down the pipe"""
+        start = self._start_call()
         del self.unused_request_numbers[req_num]
         argument_list = []
         for i in range(request.num_args):
@@ -454,13 +968,23 @@ class PipeConnection(LowLevelPipeConnection):
                 "Object {rnum} and argument {anum} numbers should be "
                 "the same.".object(rnum=req_num, anum=arg_req_num))
             argument_list.append(arg)
-        try:
-            Security.vet_request(request, argument_list)
-            result = eval(request.function_string)(*argument_list)
-        except BaseException:
-            result = self._extract_exception()
-        self._put(result, req_num)
+        if self.async_error is not None:
+            if request.asynchronous:  # skipped until the error is reported
+                self.unused_request_numbers[req_num] = None
+                return
+            result, self.async_error = self.async_error, None
+        else:
+            try:
+                Security.vet_request(request, argument_list)
+                result = eval(request.function_string)(*argument_list)
+            except BaseException:
+                result = self._extract_exception()
+        if not request.asynchronous:
+            self._put(result, req_num)
+        elif isinstance(result, BaseException):
+            self.async_error = result
         self.unused_request_numbers[req_num] = None
+        self._count_call(self.answer_stats, request.function_string, start)
 
     def _extract_exception(self):
         """Return active exception"""
@@ -474,10 +998,19 @@ class PipeConnection(LowLevelPipeConnection):
         return sys.exc_info()[1]
 
     def _get_new_req_num(self):
-        """Allot a new request number and return it"""
+        """Allot a new request number and return it
+
+        The server takes the highest unused number and the client the
+        lowest one, so that they don't collide if both make requests at
+        the same time, which happens while streams are pushed.
+
+        """
         if not self.unused_request_numbers:
             raise ConnectionError("Exhausted possible connection numbers")
-        req_num = list(self.unused_request_numbers.keys())[0]
+        if Globals.server:
+            req_num = max(self.unused_request_numbers)
+        else:
+            req_num = min(self.unused_request_numbers)
         del self.unused_request_numbers[req_num]
         return req_num
 
@@ -510,6 +1043,15 @@ class RedirectedConnection(Connection):
         return self.routing_conn.reval("RedirectedRun", self.conn_number,
                                        function_string, *args)
 
+    def reval_async(self, function_string, *args):
+        """Like reval but without waiting, see PipeConnection.reval_async"""
+        self.routing_conn.reval_async("RedirectedRun", self.conn_number,
+                                      function_string, *args)
+
+    def batch(self):
+        """Return context in which requests are sent together"""
+        return self.routing_conn.batch()
+
     def __str__(self):
         return "RedirectedConnection %d,%d" % (self.conn_number,
                                                self.routing_number)
@@ -621,6 +1163,181 @@ class VirtualFile:
         return self.connection.VirtualFile.closebyid(self.id)
 
 
+class StreamFile:
+    """File-like reading a stream pushed by the other side
+
+    The other side starts sending only once the stream is first read,
+    so that it isn't pushed before its consumer is running.  The chunks
+    received are queued until read, and the bytes read, including those
+    sent over data channels with them, are given back as credits once
+    they amount to a quarter of the window, so that the other side can
+    keep sending ahead of the reads.
+
+    """
+
+    def __init__(self, connection, id):
+        self.connection = connection
+        self.id = id
+        # (bytes or exception, credit taken by it) pairs
+        self.chunks = collections.deque()
+        self.window = Globals.conn_bufsize * _STREAM_WINDOW_BUFFERS
+        self.unacknowledged = None  # bytes read but not given back yet
+        connection.in_streams[id] = self
+
+    def read(self, length=None):
+        """Return the next chunk of the stream, waiting for it if needed
+
+        Chunks are complete records of a MiscIterToFile, hence they are
+        returned whole whatever the length, as memoryview of the frame
+        they were received in.
+
+        """
+        if self.unacknowledged is None:
+            self.connection._putstreamcredit(self.id, self.window)
+            self.unacknowledged = 0
+        if not self.chunks:
+            self.connection._wait_for_stream(self)
+        chunk, credit = self.chunks.popleft()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if self.id in self.connection.in_streams:
+            self.unacknowledged += credit
+            if self.unacknowledged >= self.window // 4:
+                self.connection._putstreamcredit(self.id,
+                                                 self.unacknowledged)
+                self.unacknowledged = 0
+        return chunk
+
+    def close(self):
+        return None
+
+
+class DataChannel:
+    """Additional pipe carrying file data next to a PipeConnection
+
+    A single pipe, e.g. through SSH, is limited by its TCP window and
+    cipher thread, hence the data of big files can be striped over
+    several channels to the same process, see SetConnections.  Only the
+    data goes over the channels, the records referring to it stay in
+    order on the connection, see iterfile.MiscIterToFile.
+
+    Each channel writes and reads in threads of its own, so that all
+    channels transfer in parallel and never block the connection.  The
+    data is sent as frames of a 7 bytes length followed by the bytes.
+
+    """
+
+    def __init__(self, inpipe, outpipe, process=None, sock=None):
+        """Use inpipe and outpipe, from process or socket sock if any"""
+        self.inpipe = inpipe
+        self.outpipe = outpipe
+        self.outfd = _get_writev_fd(outpipe)
+        self.process = process
+        self.sock = sock
+        self.error = None  # exception which stopped the writer
+        self.to_send = queue.Queue()
+        self.received = queue.Queue()  # of bytes, None once closed
+        self.writer = threading.Thread(target=self._write_frames, daemon=True)
+        self.writer.start()
+        threading.Thread(target=self._read_frames, daemon=True).start()
+
+    def send(self, data):
+        """Queue data to be sent over the channel"""
+        if self.error is not None:
+            raise ConnectionWriteError(
+                "Data channel failed: {exc}".format(exc=self.error))
+        self.to_send.put(data)
+
+    def receive(self):
+        """Return the next data received, waiting for it if needed"""
+        data = self.received.get()
+        if data is None:
+            self.received.put(None)  # for further calls
+            raise ConnectionReadError("Data channel closed")
+        return data
+
+    def close(self):
+        """Send what is queued, then close the channel for writing"""
+        self.to_send.put(None)
+        self.writer.join()
+        if self.process:
+            self.process.wait()
+
+    def _write_frames(self):
+        """Write the data queued until None, in the writer thread"""
+        try:
+            while True:
+                data = self.to_send.get()
+                if data is None:
+                    break
+                _write_parts(self.outpipe, self.outfd,
+                             [len(data).to_bytes(7, 'big'), data])
+        except (OSError, ValueError) as exc:
+            self.error = exc
+        finally:
+            try:
+                self.outpipe.close()
+                if self.sock:
+                    self.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def _read_frames(self):
+        """Queue the data received until the end, in the reader thread"""
+        try:
+            while True:
+                header = self.inpipe.read(7)
+                if len(header) != 7:
+                    break
+                length = int.from_bytes(header, 'big')
+                data = self.inpipe.read(length)
+                if len(data) != length:
+                    break
+                self.received.put(data)
+        except (OSError, ValueError):
+            pass
+        self.received.put(None)
+
+
+class _CallBatch:
+    """Context holding back the frames of a connection, see batch
+
+    Batches can be nested, the frames are only written when leaving the
+    outermost one.  Without connection, the context does nothing.
+
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.outermost = False
+
+    def __enter__(self):
+        if self.connection is not None and self.connection.out_buffer is None:
+            self.connection.out_buffer = []
+            self.outermost = True
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.outermost:
+            try:
+                if self.connection.out_buffer:
+                    self.connection._flush_frames()
+            finally:
+                self.connection.out_buffer = None
+
+
+class _OutStream:
+    """Stream pushed to the other side, see LowLevelPipeConnection"""
+
+    def __init__(self, file):
+        self.file = file  # the iterfile.MiscIterToFile to read from
+        self.credit = 0  # bytes the other side accepts to receive
+
+
+# unique identifiers of the streams sent by this process
+_stream_ids = itertools.count()
+
+
 def RedirectedRun(conn_number, func, *args):
     """Run func with args on connection with conn number conn_number
 
@@ -637,12 +1354,69 @@ def RedirectedRun(conn_number, func, *args):
     return conn.reval(func, *args)
 
 
+def _get_writev_fd(pipe):
+    """Return the file descriptor to write pipe with os.writev, if any
+
+    None is returned if the platform or the pipe don't allow it.
+
+    """
+    if not hasattr(os, "writev"):
+        return None
+    try:
+        return pipe.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _write_parts(pipe, fd, parts):
+    """Write the list of byte strings parts to pipe, and flush it
+
+    With the file descriptor fd of the pipe, see _get_writev_fd, the
+    parts are gathered by os.writev instead of being joined or written
+    one by one, so that they aren't copied and cost few system calls.
+    The list parts may be modified.
+
+    """
+    if fd is None:
+        for part in parts:
+            pipe.write(part)
+        pipe.flush()
+        return
+    pipe.flush()  # in case something was written to the pipe directly
+    pos = 0
+    while pos < len(parts):
+        written = os.writev(fd, parts[pos:pos + _MAX_WRITEV_PARTS])
+        while pos < len(parts) and written >= len(parts[pos]):
+            written -= len(parts[pos])
+            pos += 1
+        if written:  # the next part was only written partially
+            parts[pos] = memoryview(parts[pos])[written:]
+
+
+def is_compression_supported(method):
+    """Return true if frames can be compressed with method on this side"""
+    return method in _COMPRESSORS
+
+
+def _lzma_compress(data, level):
+    """Compress data using lzma, level being the preset"""
+    return lzma.compress(data, preset=level)
+
+
+# the compression methods by name, with their identifier on the wire
+_COMPRESSORS = {"zlib": (1, zlib.compress)}
+_DECOMPRESSORS = {1: zlib.decompress}
+if lzma:
+    _COMPRESSORS["lzma"] = (2, _lzma_compress)
+    _DECOMPRESSORS[2] = lzma.decompress
+
+
 # everything has to be available here for remote connection's use, but
 # put at bottom to reduce circularities.
 from . import (  # noqa: E402,F401
     Globals, Time, Rdiff, Hardlink, FilenameMapping, Security,
     Main, rorpiter, selection, increment, statistics, manage,
-    iterfile, rpath, robust, restore, backup,
+    iterfile, rorpcoding, rpath, robust, restore, backup,
     SetConnections, librsync, log, regress, fs_abilities,
     eas_acls, user_group, compare
 )
@@ -0,0 +1,166 @@
+# Copyright 2026 the rdiff-backup project
+#
+# This file is part of rdiff-backup.
+#
+# rdiff-backup is free software; you can redistribute it and/or modify
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# rdiff-backup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rdiff-backup; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA
+"""Serve many client sessions from a long-lived server process
+
+Instead of being started for each session, e.g. through ssh, a server
+daemon listens on a Unix socket and serves each accepted connection in
+a child process forked from it.  The sessions are hence isolated from
+each other, as their globals are only changed in their own process,
+but they don't pay for the start of Python and the imports, and re-use
+the file system abilities detected by previous sessions, which each
+child reports back to the daemon once done.
+
+Clients connect to the daemon with a remote schema like 'unix:{h}', see
+SetConnections.
+
+"""
+
+import errno
+import os
+import pickle
+import select
+import signal
+import socket
+import stat
+import sys
+from . import Globals, connection, fs_abilities
+from .log import Log
+
+
+def serve(path):
+    """Listen on the Unix socket at path and serve the clients connecting
+
+    This only returns, with the exit code, once the daemon is
+    terminated by SIGTERM or interrupted.  The socket is only accessible
+    with the permissions given by the umask.
+
+    """
+    if not hasattr(socket, "AF_UNIX") or not hasattr(os, "fork"):
+        Log.FatalError("Serving from a socket requires Unix sockets and "
+                       "processes to be forked, which this platform lacks.")
+    listener = _listen(path)
+    fs_abilities.enable_cache()
+    signal.signal(signal.SIGTERM, _terminate)
+    # the pipes the children report through, as {file descriptor: pid}
+    children = {}
+    Log("Serving clients connecting to {sock}".format(
+        sock=os.fsdecode(path)), 4)
+    try:
+        while True:
+            readable = select.select(list(children) + [listener], [], [])[0]
+            # reports first so that the next sessions benefit from them
+            for ready in readable:
+                if ready is listener:
+                    _fork_session(listener, children)
+                else:
+                    _collect_report(ready, children)
+    except (KeyboardInterrupt, SystemExit):
+        return 0
+    finally:
+        listener.close()
+        os.unlink(path)
+
+
+def _listen(path):
+    """Return a socket listening at path, replacing a stale socket file"""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(mode):
+            Log.FatalError("Path {sock} exists and isn't a socket.".format(
+                sock=os.fsdecode(path)))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError as exc:
+            if exc.errno != errno.ECONNREFUSED:
+                raise
+            os.unlink(path)  # left over by a daemon which didn't end well
+        else:
+            Log.FatalError("A server is already listening on {sock}.".format(
+                sock=os.fsdecode(path)))
+        finally:
+            probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    return listener
+
+
+def _terminate(signum, frame):
+    """Stop serving on SIGTERM, the running sessions go on"""
+    sys.exit(0)
+
+
+def _fork_session(listener, children):
+    """Accept a connection and serve it in a new child process"""
+    try:
+        sock = listener.accept()[0]
+    except OSError as exc:
+        Log("Connection couldn't be accepted: {exc}".format(exc=exc), 2)
+        return
+    report_fd, child_report_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        listener.close()
+        os.close(report_fd)
+        for fd in children:
+            os.close(fd)
+        _serve_session(sock, child_report_fd)
+    os.close(child_report_fd)
+    sock.close()
+    children[report_fd] = pid
+    Log("Serving session in process {pid}".format(pid=pid), 5)
+
+
+def _serve_session(sock, report_fd):
+    """Serve the client connected through sock, in the child process
+
+    Once the session is over, the file system abilities detected by it
+    are reported through report_fd, and the process exits.
+
+    """
+    exit_code = 0
+    try:
+        connection.PipeConnection(sock.makefile("rb"),
+                                  sock.makefile("wb")).Server()
+        with os.fdopen(report_fd, "wb") as report:
+            report.write(pickle.dumps(fs_abilities.get_cache_updates()))
+    except BaseException as exc:
+        Log("Session ended with an error: {exc}".format(exc=exc), 2)
+        exit_code = 1
+    finally:
+        os._exit(exit_code)  # nothing of the daemon may be run here
+
+
+def _collect_report(report_fd, children):
+    """Add what the child reports to the cache and wait for its end"""
+    chunks = []
+    while True:  # the child writes all at once and exits, we don't wait long
+        chunk = os.read(report_fd, Globals.conn_bufsize)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(report_fd)
+    os.waitpid(children.pop(report_fd), 0)
+    if chunks:  # nothing if the session failed or was a data channel
+        fs_abilities.update_cache(pickle.loads(b"".join(chunks)))
@@ -28,8 +28,18 @@ FSAbilities object describing it.
 
 import errno
 import os
+import time
 from . import Globals, log, selection, robust, SetConnections, \
-    FilenameMapping, win_acls, Time
+    FilenameMapping, win_acls, Time, librsync
+
+# Abilities detected by file system root and the settings influencing
+# the detection, as {key: (expiry time, abilities)}, kept by a server
+# daemon across its sessions, see enable_cache; None if not caching
+_cache = None
+# The entries added to the cache by this process
+_cache_updates = {}
+# Seconds after which cached abilities are detected again
+_CACHE_SECONDS = 3600
 
 
 class FSAbilities:
@@ -63,10 +73,22 @@ class FSAbilities:
         self.name = name
         self.root_rp = root_rp
         self.read_only = read_only
+        cache_key = _get_cache_key(root_rp, read_only)
+        cached = _cache.get(cache_key) if cache_key else None
+        if cached and cached[0] > time.time():
+            log.Log("Using abilities of file system at {rp} detected "
+                    "previously".format(rp=root_rp.get_safepath()), 5)
+            self.__dict__.update(cached[1])
+            return
         if self.read_only:
             self._init_readonly()
         else:
             self._init_readwrite()
+        if cache_key:
+            abilities = {key: value for key, value in vars(self).items()
+                         if key not in ("name", "root_rp", "read_only")}
+            _cache[cache_key] = _cache_updates[cache_key] = (
+                time.time() + _CACHE_SECONDS, abilities)
 
     def __str__(self):
         """Return pretty printable version of self"""
@@ -816,6 +838,48 @@ class BackupSetGlobals(SetGlobals):
         SetConnections.UpdateGlobal('escape_trailing_spaces', actual_ets)
         log.Log("Backup: escape_trailing_spaces = %d" % actual_ets, 4)
 
+    def set_signature_format(self, rbdir):
+        """Set the format of the signatures from options and repository
+
+        The format is recorded in the signature_format file of the
+        rdiff-backup-data directory, so that it remains the same over
+        the backup sessions unless explicitly changed.
+
+        """
+        sf_rp = rbdir.append("signature_format")
+        if sf_rp.lstat():
+            recorded = sf_rp.get_string().split()
+            if (len(recorded) != 2 or recorded[0] not in librsync.SIG_FORMATS
+                    or not recorded[1].isdigit()):
+                log.Log.FatalError(
+                    "Unknown signature format {sf} in {rp}".format(
+                        sf=recorded, rp=sf_rp.get_safepath()))
+            recorded_format, recorded_len = recorded[0], int(recorded[1])
+        else:
+            recorded = None
+            recorded_format = librsync.DEFAULT_SIG_FORMAT
+            recorded_len = librsync.DEFAULT_STRONG_LEN
+
+        actual_format = Globals.signature_format or recorded_format
+        if Globals.signature_strong_len is None:
+            actual_len = recorded_len
+        else:
+            actual_len = Globals.signature_strong_len
+        actual_len = librsync.get_sig_format(actual_format, actual_len)[1]
+
+        if recorded != [actual_format, str(actual_len)]:
+            if recorded:
+                log.Log("Changing signature format from {old} to {new} "
+                        "{len}".format(old=" ".join(recorded),
+                                       new=actual_format, len=actual_len), 3)
+                sf_rp.delete()
+            sf_rp.write_string("%s %d\n" % (actual_format, actual_len))
+
+        SetConnections.UpdateGlobal('signature_format', actual_format)
+        SetConnections.UpdateGlobal('signature_strong_len', actual_len)
+        log.Log("Backup: signature format = %s with %d bytes strong sums" %
+                (actual_format, actual_len), 4)
+
     def set_chars_to_quote(self, rbdir, force):
         """Set chars_to_quote setting for backup session
 
@@ -1034,6 +1098,44 @@ class SingleSetGlobals(RestoreSetGlobals):
         self.conn.Globals.set_local(conn_attr, 1)
 
 
+def enable_cache():
+    """Keep the abilities detected from now on, to re-use them
+
+    This is only meant for a server daemon, whose sessions run each in
+    a child process, hence the entries added by a session must be passed
+    to the daemon, see get_cache_updates and update_cache.  They are
+    kept for a limited time because the content of a directory, and not
+    only the file system, influences some abilities.
+
+    """
+    global _cache
+    if _cache is None:
+        _cache = {}
+
+
+def get_cache_updates():
+    """Return the entries added to the cache by this process"""
+    return _cache_updates
+
+
+def update_cache(entries):
+    """Add entries as returned by get_cache_updates to the cache"""
+    _cache.update(entries)
+
+
+def _get_cache_key(root_rp, read_only):
+    """Return the key of the abilities of root_rp in the cache
+
+    None is returned if there is no cache or root_rp doesn't exist.
+
+    """
+    if _cache is None or not root_rp.lstat():
+        return None
+    return (root_rp.path, read_only, root_rp.getdevloc(), root_rp.getinode(),
+            Globals.acls_active, Globals.eas_active, Globals.win_acls_active,
+            Globals.preserve_hardlinks)
+
+
 # @API(get_readonly_fsa, 200)
 def get_readonly_fsa(desc_string, rp):
     """Return an fsa with given description_string
@@ -1078,6 +1180,7 @@ def backup_set_globals(rpin, force):
     bsg.set_symlink_perms()
     update_quoting = bsg.set_chars_to_quote(Globals.rbdir, force)
     bsg.set_special_escapes(Globals.rbdir)
+    bsg.set_signature_format(Globals.rbdir)
     bsg.set_compatible_timestamps()
 
     if update_quoting and force:
@@ -18,9 +18,13 @@
 # 02110-1301, USA
 """Convert an iterator to a file object and vice-versa"""
 
+import collections
+import io
 import pickle
-import array
-from . import Globals, robust, rpath
+from . import Globals, robust, rorpcoding, rpath
+
+# Chunks of files from this size on are striped over the data channels
+_MIN_STRIPED_LEN = 16384
 
 
 class IterFileException(Exception):
@@ -198,25 +202,26 @@ class FileWrappingIter:
     data is written in chunks of Globals.blocksize, and the following
     blocks can identify themselves as continuations.
 
+    The buffer is kept as a list of the headers and data chunks, which
+    are only joined, hence copied, once when they are read.
+
     """
 
     def __init__(self, iter):
         """Initialize with iter"""
         self.iter = iter
-        self.array_buf = array.array('b')
+        self.buf_parts = collections.deque()
+        self.buf_len = 0
         self.currently_in_file = None
         self.closed = None
 
     def read(self, length):
         """Return next length bytes in file"""
         assert not self.closed, "Can't read from a closed file."
-        while len(self.array_buf) < length:
+        while self.buf_len < length:
             if not self._add_to_buffer():
                 break
-
-        result = self.array_buf[:length].tobytes()
-        del self.array_buf[:length]
-        return result
+        return self._take_from_buffer(length)
 
     def close(self):
         self.closed = 1
@@ -241,17 +246,15 @@ class FileWrappingIter:
             else:
                 pickled_data = pickle.dumps(currentobj,
                                             Globals.PICKLE_PROTOCOL)
-                self.array_buf.frombytes(b"o")
-                self.array_buf.frombytes(self._i2b(len(pickled_data), 7))
-                self.array_buf.frombytes(pickled_data)
+                self._add_chunk(b"o", pickled_data)
         return 1
 
     def _add_from_file(self, prefix_letter):
-        """Read a chunk from the current file and add to array_buf
+        """Read a chunk from the current file and add to the buffer
 
         prefix_letter and the length will be prepended to the file
         data.  If there is an exception while reading the file, the
-        exception will be added to array_buf instead.
+        exception will be added to the buffer instead.
 
         """
         buf = robust.check_common_error(self._read_error_handler,
@@ -260,15 +263,64 @@ class FileWrappingIter:
         if buf is None:  # error occurred above, encode exception
             self.currently_in_file = None
             excstr = pickle.dumps(self.last_exception, Globals.PICKLE_PROTOCOL)
-            total = b"".join((b'e', self._i2b(len(excstr), 7), excstr))
+            self._add_chunk(b"e", excstr)
         else:
-            total = b"".join((prefix_letter, self._i2b(len(buf), 7), buf))
-            if buf == b"":  # end of file
+            self._add_chunk(prefix_letter, buf)
+            if not buf:  # end of file
                 cstr = pickle.dumps(self.currently_in_file.close(),
                                     Globals.PICKLE_PROTOCOL)
                 self.currently_in_file = None
-                total += b"".join((b'h', self._i2b(len(cstr), 7), cstr))
-        self.array_buf.frombytes(total)
+                self._add_chunk(b"h", cstr)
+
+    def _add_chunk(self, prefix_letter, data):
+        """Add data with its header, the letter and length, to the buffer
+
+        data can also be a list of parts, which are added as they are.
+
+        """
+        parts = data if isinstance(data, list) else [data]
+        length = sum(map(len, parts))
+        self.buf_parts.append(prefix_letter + self._i2b(length, 7))
+        self.buf_parts.extend(part for part in parts if part)
+        self.buf_len += 8 + length
+
+    def _take_from_buffer(self, length=None):
+        """Remove and return the first length bytes of the buffer
+
+        The whole buffer is returned if length is None.  Chunks are
+        returned as they are if possible, else joined only once.
+
+        """
+        taken = self._take_parts(length)
+        if len(taken) == 1 and isinstance(taken[0], bytes):
+            return taken[0]
+        return b"".join(taken)
+
+    def _take_parts(self, length=None):
+        """Remove and return the parts of the first length bytes of the buffer
+
+        The whole buffer is returned if length is None.
+
+        """
+        if length is None or length >= self.buf_len:
+            taken = list(self.buf_parts)
+            self.buf_parts.clear()
+            self.buf_len = 0
+        else:
+            taken = []
+            missing = length
+            while missing:
+                part = self.buf_parts[0]
+                if len(part) <= missing:
+                    taken.append(self.buf_parts.popleft())
+                    missing -= len(part)
+                else:  # split the part, without copying it
+                    view = memoryview(part)
+                    taken.append(view[:missing])
+                    self.buf_parts[0] = view[missing:]
+                    missing = 0
+            self.buf_len -= length
+        return taken
 
     def _read_error_handler(self, exc, blocksize):
         """Log error when reading from file"""
@@ -297,27 +349,64 @@ class MiscIterFlushRepeat(MiscIterFlush):
     pass
 
 
+class MiscIterStream:
+    """Iterator to be pushed over a connection instead of being pulled
+
+    Passed over a connection, the iterator is usually read by the other
+    side through a virtual file, so that each read costs a round trip.
+    Wrapped in this class, it is instead sent ahead of the reads, as far
+    as the connection allows, see connection.PipeConnection.  The
+    wrapped iterator may yield MiscIterFlush to pause until it is read
+    again, e.g. if it mustn't get too far ahead of its consumer.
+
+    """
+
+    def __init__(self, iter):
+        self.iter = iter
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iter)
+
+
 class MiscIterToFile(FileWrappingIter):
     """Take an iter and give it a file-ish interface
 
     This expands on the FileWrappingIter by understanding how to
     process RORPaths with file objects attached.  It adds a new
-    character "r" to mark these.
+    character "r" to mark these, or "p" if the RORPath is packed by
+    rorpcoding, which the API version agreed with the other end allows.
 
     This is how we send signatures and diffs across the line.  As
     sending each one separately via a read() call would result in a
     lot of latency, the read()'s are buffered - a read() call with no
     arguments will return a variable length string (possibly empty).
 
+    Snapshots of regular files smaller than Globals.small_file_size are
+    read whole and packed together with their rorps and close values in
+    a single record marked "b", instead of one "r" record followed by
+    the "f", "c" and "h" records of each file.
+
     To flush the MiscIterToFile, have the iterator yield a
-    MiscIterFlush class.
+    MiscIterFlush class.  Once the end of the iterator has been added
+    to the buffer, finished is set to true.
+
+    If data channels are given, see connection.DataChannel, the big
+    "f" and "c" chunks are sent over them in turn, and replaced in the
+    buffer by "x" records holding the letter and the channel number.
+    The bytes sent this way during the last read are counted in
+    striped_len.
 
     """
 
-    def __init__(self, rpiter, max_buffer_bytes=None, max_buffer_rps=None):
+    def __init__(self, rpiter, max_buffer_bytes=None, max_buffer_rps=None,
+                 channels=None):
         """MiscIterToFile initializer
 
-        max_buffer_bytes is the maximum size of the buffer in bytes.
+        max_buffer_bytes is the maximum size of the buffer in bytes,
+        including the bytes striped over the data channels.
         max_buffer_rps is the maximum size of the buffer in rorps.
 
         """
@@ -325,30 +414,53 @@ class MiscIterToFile(FileWrappingIter):
         self.max_buffer_rps = max_buffer_rps or Globals.pipeline_max_length
         self.rorps_in_buffer = 0
         self.next_in_line = None
+        self.batch = []  # (index, data, contents, close value) of small files
+        self.batch_len = 0
+        self.finished = False
+        self.channels = channels
+        self.next_channel = 0
+        self.striped_len = 0
+        if rorpcoding.is_supported():
+            self.rorp_encoder = rorpcoding.RORPEncoder()
+        else:
+            self.rorp_encoder = None
         FileWrappingIter.__init__(self, rpiter)
 
     def read(self, length=None):
         """Return some number of bytes, including 0"""
+        self._fill_buffer(length)
+        return self._take_from_buffer(length)
+
+    def read_parts(self):
+        """Like read() without length, but return a list of byte strings
+
+        The parts aren't joined, so that they can be written at once
+        without being copied, see connection.LowLevelPipeConnection.
+
+        """
+        self._fill_buffer(None)
+        return self._take_parts()
+
+    def _fill_buffer(self, length):
+        """Fill the buffer for a read of length bytes, see read"""
         assert not self.closed, "Can't read from a closed file."
         assert length is None or length >= 0, (
             "Length {rlen} to read must be None (for all) or "
             "an integer positive or zero.".format(rlen=length))
+        self.striped_len = 0
         if length is None:
-            while (len(self.array_buf) < self.max_buffer_bytes
+            while (self.buf_len + self.batch_len + self.striped_len
+                   < self.max_buffer_bytes
                    and self.rorps_in_buffer < self.max_buffer_rps):
                 if not self._add_to_buffer():
                     break
-
-            result = self.array_buf.tobytes()
-            del self.array_buf[:]
+            self._add_batch()
             self.rorps_in_buffer = 0
-            return result
         else:
-            read_buffer = self.read()
-            while len(read_buffer) < length:
-                read_buffer += self.read()
-            self.array_buf.frombytes(read_buffer[length:])
-            return read_buffer[length:]
+            while self.buf_len + self.batch_len + self.striped_len < length:
+                if not self._add_to_buffer():
+                    break
+            self._add_batch()
 
     def close(self):
         self.closed = 1
@@ -367,9 +479,14 @@ class MiscIterToFile(FileWrappingIter):
                 try:
                     currentobj = next(self.iter)
                 except StopIteration:
+                    self._add_batch()
                     self._add_final()
                     return None
 
+            if self._is_batchable(currentobj):
+                self._add_to_batch(currentobj)
+                return 1
+            self._add_batch()
             if hasattr(currentobj, "read") and hasattr(currentobj, "close"):
                 self.currently_in_file = currentobj
                 self._add_from_file(b"f")
@@ -384,15 +501,34 @@ class MiscIterToFile(FileWrappingIter):
                 self._add_misc_object(currentobj)
         return 1
 
+    def _add_chunk(self, prefix_letter, data):
+        """Add data to the buffer, or over a data channel if big enough"""
+        if (self.channels and prefix_letter in (b"f", b"c")
+                and len(data) >= _MIN_STRIPED_LEN):
+            self.channels[self.next_channel].send(data)
+            self.striped_len += len(data)
+            data = prefix_letter + bytes((self.next_channel, ))
+            prefix_letter = b"x"
+            self.next_channel = (self.next_channel + 1) % len(self.channels)
+        FileWrappingIter._add_chunk(self, prefix_letter, data)
+
     def _add_misc_object(self, obj):
         """Add an arbitrary pickleable object to the buffer"""
         pickled_data = pickle.dumps(obj, Globals.PICKLE_PROTOCOL)
-        self.array_buf.frombytes(b"o")
-        self.array_buf.frombytes(self._i2b(len(pickled_data), 7))
-        self.array_buf.frombytes(pickled_data)
+        self._add_chunk(b"o", pickled_data)
 
     def _add_rorp(self, rorp):
         """Add a rorp to the buffer"""
+        if self.rorp_encoder:
+            packed = self.rorp_encoder.encode(rorp.index, rorp.data,
+                                              bool(rorp.file))
+            if packed is not None:
+                if rorp.file:
+                    self.next_in_line = rorp.file
+                else:
+                    self.rorps_in_buffer += 1
+                self._add_chunk(b"p", packed)
+                return
         if rorp.file:
             pickled_data = pickle.dumps((rorp.index, rorp.data, 1),
                                         Globals.PICKLE_PROTOCOL)
@@ -401,22 +537,84 @@ class MiscIterToFile(FileWrappingIter):
             pickled_data = pickle.dumps((rorp.index, rorp.data, 0),
                                         Globals.PICKLE_PROTOCOL)
             self.rorps_in_buffer += 1
-        self.array_buf.frombytes(b"r")
-        self.array_buf.frombytes(self._i2b(len(pickled_data), 7))
-        self.array_buf.frombytes(pickled_data)
+        self._add_chunk(b"r", pickled_data)
+
+    def _is_batchable(self, obj):
+        """Return true if obj is a rorp with a small snapshot attached
+
+        Batches are only understood since API version 201.
+
+        """
+        return (Globals.small_file_size and Globals.get_api_version() >= 201
+                and isinstance(obj, rpath.RORPath) and obj.file
+                and obj.data.get('filetype') == 'snapshot'
+                and obj.isreg() and obj.getsize() < Globals.small_file_size)
+
+    def _add_to_batch(self, rorp):
+        """Read the whole file of rorp and add both to the current batch
+
+        If the file can't be read, the exception is sent instead of its
+        contents.  The batch is added to the buffer once it's full.
+
+        """
+        contents = robust.check_common_error(self._read_error_handler,
+                                             rorp.file.read, [-1])
+        if contents is None:  # error occurred above, send the exception
+            contents, close_value = self.last_exception, None
+        else:
+            close_value = rorp.file.close()
+        self.batch.append((rorp.index, rorp.data, contents, close_value))
+        if isinstance(contents, bytes):
+            self.batch_len += len(contents)
+        self.rorps_in_buffer += 1
+        if (self.batch_len >= self.max_buffer_bytes
+                or len(self.batch) >= self.max_buffer_rps):
+            self._add_batch()
+
+    def _add_batch(self):
+        """Add the current batch of small files to the buffer, if any
+
+        The contents of the files are kept out of the pickled batch,
+        replaced by their lengths, and follow it in the record, so that
+        they are never copied into the pickle.  The record holds the
+        length of the pickle on 7 bytes, the pickle and the contents.
+
+        """
+        if self.batch:
+            batch, contents_parts = [], []
+            for index, data, contents, close_value in self.batch:
+                if isinstance(contents, bytes):
+                    contents_parts.append(contents)
+                    contents = len(contents)
+                batch.append((index, data, contents, close_value))
+            pickled_batch = pickle.dumps(batch, Globals.PICKLE_PROTOCOL)
+            self._add_chunk(b"b", [self._i2b(len(pickled_batch), 7),
+                                   pickled_batch] + contents_parts)
+            self.batch = []
+            self.batch_len = 0
 
     def _add_final(self):
         """Signal the end of the iterator to the other end"""
-        self.array_buf.frombytes(b"z")
-        self.array_buf.frombytes(self._i2b(0, 7))
+        self._add_chunk(b"z", b"")
+        self.finished = True
 
 
 class FileToMiscIter(IterWrappingFile):
-    """Take a MiscIterToFile and turn it back into a iterator"""
+    """Take a MiscIterToFile and turn it back into a iterator
 
-    def __init__(self, file):
+    The data channels must be the other ends of those of the
+    MiscIterToFile, in the same order.
+
+    """
+
+    def __init__(self, file, channels=None):
         IterWrappingFile.__init__(self, file)
-        self.buf = b""
+        self.channels = channels
+        self.buf = memoryview(b"")
+        self.buf_pos = 0  # position of the next record in self.buf
+        self.batched_rorps = collections.deque()
+        self.rorp_decoder = rorpcoding.RORPDecoder()
+        self.finished = False
 
     def __iter__(self):
         return self
@@ -425,27 +623,56 @@ class FileToMiscIter(IterWrappingFile):
         """Return next object in iter, or raise StopIteration"""
         if self.currently_in_file:
             self.currently_in_file.close()
+        if self.batched_rorps:
+            return self.batched_rorps.popleft()
+        if self.finished:
+            raise StopIteration
         type = None
         while not type:
             type, data = self._get()
         if type == b"z":
+            self.finished = True
             raise StopIteration
         elif type == b"r":
             return self._get_rorp(data)
+        elif type == b"p":
+            return self._get_rorp(self.rorp_decoder.decode(data))
+        elif type == b"b":
+            self._get_batch(data)
+            return self.batched_rorps.popleft()
         elif type == b"o":
             return data
         else:
             raise IterFileException("Bad file type %s" % (type, ))
 
-    def _get_rorp(self, pickled_tuple):
-        """Return rorp that data represents"""
-        index, data_dict, num_files = pickled_tuple
+    def _get_rorp(self, rorp_tuple):
+        """Return rorp that the (index, data, number of files) represents"""
+        index, data_dict, num_files = rorp_tuple
         rorp = rpath.RORPath(index, data_dict)
         if num_files:
             assert num_files == 1, "Only one file accepted right now"
             rorp.setfile(self._get_file())
         return rorp
 
+    def _get_batch(self, record):
+        """Queue the rorps of a batch of small files, with their files
+
+        The files are read from the record, see MiscIterToFile._add_batch,
+        which is copied only once, by the BatchedFile of each file.
+
+        """
+        pos = 7 + self._b2i(record[:7])
+        batch = pickle.loads(record[7:pos])
+        for index, data_dict, contents, close_value in batch:
+            rorp = rpath.RORPath(index, data_dict)
+            if isinstance(contents, Exception):
+                rorp.setfile(ErrorFile(contents))
+            else:
+                rorp.setfile(BatchedFile(record[pos:pos + contents],
+                                         close_value))
+                pos += contents
+            self.batched_rorps.append(rorp)
+
     def _get_file(self):
         """Read file object from file"""
         file_type, file_data = self._get()
@@ -464,24 +691,49 @@ class FileToMiscIter(IterWrappingFile):
 
         This is like UnwrapFile._get() but reads in variable length
         blocks.  Also type "z" is allowed, which means end of
-        iterator.  An empty read() is not considered to mark the end
-        of remote iter.
+        iterator, and type "b" for a batch of small files, whose record
+        is returned as memoryview.  An empty read() is not considered to
+        mark the end of remote iter.  The data of type "x" is received
+        over a data channel, and returned with the type it replaced.
+
+        The blocks read are used through a memoryview, so that only the
+        data of files is copied out of them.
 
         """
-        if not self.buf:
-            self.buf += self.file.read()
+        if self.buf_pos >= len(self.buf):
+            self.buf = memoryview(self.file.read())
+            self.buf_pos = 0
         if not self.buf:
             return None, None
 
-        assert len(self.buf) >= 8, "Unexpected end of MiscIter file"
+        pos = self.buf_pos
+        assert len(self.buf) - pos >= 8, "Unexpected end of MiscIter file"
         # [0:1] makes sure that the type remains a byte and not an int
-        type, length = self.buf[0:1], self._b2i(self.buf[1:8])
-        data = self.buf[8:8 + length]
-        self.buf = self.buf[8 + length:]
+        type = bytes(self.buf[pos:pos + 1])
+        length = self._b2i(self.buf[pos + 1:pos + 8])
+        self.buf_pos = pos + 8 + length
         if type in b"oerh":
-            return type, pickle.loads(data)
+            return type, pickle.loads(self.buf[pos + 8:self.buf_pos])
+        elif type == b"b":
+            return type, self.buf[pos + 8:self.buf_pos]
+        elif type == b"x":  # data of a file sent over a data channel
+            channel = self.channels[self.buf[pos + 9]]
+            return bytes(self.buf[pos + 8:pos + 9]), channel.receive()
         else:
-            return type, data
+            return type, bytes(self.buf[pos + 8:self.buf_pos])
+
+
+class BatchedFile(io.BytesIO):
+    """File-like holding a small file sent in a batch by MiscIterToFile"""
+
+    def __init__(self, contents, close_value):
+        """Initialize with the contents and close value of the file"""
+        io.BytesIO.__init__(self, contents)
+        self.close_value = close_value
+
+    def close(self):
+        io.BytesIO.close(self)
+        return self.close_value
 
 
 class ErrorFile:
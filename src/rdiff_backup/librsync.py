@@ -23,11 +23,37 @@ which is written in C.  The goal was to use C as little as possible...
 
 """
 
-import array
+import io
+import os
+import threading
 from . import _librsync
 
 blocksize = _librsync.RSM_JOB_BLOCKSIZE
 
+# Signature formats by name, with their magic number and the maximum
+# length of their strong sums.  The rk-* formats use the faster
+# RabinKarp rolling checksum and need librsync 2.2 or later.
+SIG_FORMATS = {
+    "md4": (0x72730136, 16),
+    "blake2": (0x72730137, 32),
+    "rk-md4": (0x72730146, 16),
+    "rk-blake2": (0x72730147, 32),
+}
+# historic signature format of rdiff-backup
+DEFAULT_SIG_FORMAT = "md4"
+DEFAULT_STRONG_LEN = 8
+
+# Length of the header of signatures (magic number, block length and
+# strong sum length) and of deltas (magic number), and of the end
+# command of deltas, needed to join signatures and deltas of segments
+SIG_HEADER_LEN = 12
+DELTA_HEADER_LEN = 4
+DELTA_END_LEN = 1
+
+# bytes of signature currently loaded by DeltaFile objects, and the peak
+_sig_memory_lock = threading.Lock()
+_sig_memory = _sig_memory_peak = 0
+
 
 class librsyncError(Exception):
     """Signifies error in internal librsync processing (bad signature, etc.)
@@ -42,7 +68,16 @@ class librsyncError(Exception):
 
 
 class LikeFile:
-    """File-like object used by SigFile, DeltaFile, and PatchFile"""
+    """File-like object used by SigFile, DeltaFile, and PatchFile
+
+    Data flows through two preallocated buffers, an input buffer filled
+    with readinto() where the input file supports it, and an output
+    buffer written into directly by librsync.  The valid data of each
+    lies between a start and an end offset, and it is only moved back
+    to the beginning of its buffer when room is needed, so that each
+    byte is copied at most once more when it is returned by read().
+
+    """
     mode = "rb"
 
     # This will be replaced in subclasses by an object with
@@ -54,8 +89,10 @@ class LikeFile:
         self._check_file(infile, need_seek)
         self.infile = infile
         self.closed = self.infile_closed = None
-        self.inbuf = b""
-        self.outbuf = array.array('b')
+        self.inbuf = bytearray(2 * blocksize)
+        self.inbuf_start = self.inbuf_end = 0
+        self.outbuf = bytearray(2 * blocksize)
+        self.outbuf_start = self.outbuf_end = 0
         self.eof = self.infile_eof = None
 
     def read(self, length=-1):
@@ -63,14 +100,17 @@ class LikeFile:
         if length == -1:
             while not self.eof:
                 self._add_to_outbuf_once()
-            real_len = len(self.outbuf)
+            real_len = self.outbuf_end - self.outbuf_start
         else:
-            while not self.eof and len(self.outbuf) < length:
+            while (not self.eof
+                   and self.outbuf_end - self.outbuf_start < length):
                 self._add_to_outbuf_once()
-            real_len = min(length, len(self.outbuf))
+            real_len = min(length, self.outbuf_end - self.outbuf_start)
 
-        return_val = self.outbuf[:real_len].tobytes()
-        del self.outbuf[:real_len]
+        with memoryview(self.outbuf) as view:
+            return_val = view[self.outbuf_start:
+                              self.outbuf_start + real_len].tobytes()
+        self.outbuf_start += real_len
         return return_val
 
     def close(self):
@@ -94,44 +134,71 @@ class LikeFile:
         """Add one cycle's worth of output to self.outbuf"""
         if not self.infile_eof:
             self._add_to_inbuf()
-        try:
-            self.eof, len_inbuf_read, cycle_out = self.maker.cycle(self.inbuf)
-        except _librsync.librsyncError as e:
-            raise librsyncError(str(e))
-        self.inbuf = self.inbuf[len_inbuf_read:]
-        self.outbuf.frombytes(cycle_out)
+        self.outbuf_start, self.outbuf_end = _make_room(
+            self.outbuf, self.outbuf_start, self.outbuf_end, blocksize)
+        with memoryview(self.inbuf) as inview, \
+                memoryview(self.outbuf) as outview:
+            try:
+                self.eof, len_inbuf_read, len_outbuf_written = \
+                    self.maker.cycle(
+                        inview[self.inbuf_start:self.inbuf_end],
+                        outview[self.outbuf_end:])
+            except _librsync.librsyncError as e:
+                raise librsyncError(str(e))
+        self.inbuf_start += len_inbuf_read
+        self.outbuf_end += len_outbuf_written
 
     def _add_to_inbuf(self):
-        """Make sure len(self.inbuf) >= blocksize"""
-        while len(self.inbuf) < blocksize:
-            new_in = self.infile.read(blocksize)
-            if not new_in:
+        """Make sure the input buffer holds at least blocksize bytes"""
+        self.inbuf_start, self.inbuf_end = _make_room(
+            self.inbuf, self.inbuf_start, self.inbuf_end, blocksize)
+        readinto = getattr(self.infile, "readinto", None)
+        while self.inbuf_end - self.inbuf_start < blocksize:
+            if readinto:
+                with memoryview(self.inbuf) as view:
+                    new_len = readinto(view[self.inbuf_end:])
+            else:
+                new_in = self.infile.read(len(self.inbuf) - self.inbuf_end)
+                new_len = len(new_in)
+                self.inbuf[self.inbuf_end:self.inbuf_end + new_len] = new_in
+            if not new_len:
                 self.infile_eof = 1
                 self.infile_closeval = self.infile.close()
                 self.infile_closed = 1
                 break
-            self.inbuf += new_in
+            self.inbuf_end += new_len
 
 
 class SigFile(LikeFile):
     """File-like object which incrementally generates a librsync signature"""
 
-    def __init__(self, infile, blocksize=_librsync.RS_DEFAULT_BLOCK_LEN):
+    def __init__(self, infile, blocksize=_librsync.RS_DEFAULT_BLOCK_LEN,
+                 sig_format=None):
         """SigFile initializer - takes basis file
 
         basis file only needs to have read() and close() methods.  It
         will be closed when we come to the end of the signature.
+        sig_format is a pair as returned by get_sig_format(), the
+        historic format is used if it isn't given.
 
         """
         LikeFile.__init__(self, infile)
         try:
-            self.maker = _librsync.new_sigmaker(blocksize)
+            self.maker = _librsync.new_sigmaker(
+                blocksize, *_get_sig_format_args(sig_format))
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
 
 
 class DeltaFile(LikeFile):
-    """File-like object which incrementally generates a librsync delta"""
+    """File-like object which incrementally generates a librsync delta
+
+    A signature given as file is loaded in chunks, so that only the
+    parsed signature is kept in memory.  The size of the signatures
+    loaded is tracked until the DeltaFile is closed, see
+    get_signature_memory().
+
+    """
 
     def __init__(self, signature, new_file):
         """DeltaFile initializer - call with signature and new file
@@ -142,17 +209,44 @@ class DeltaFile(LikeFile):
 
         """
         LikeFile.__init__(self, new_file)
-        if type(signature) is bytes:
-            sig_string = signature
-        else:
-            self._check_file(signature)
-            sig_string = signature.read()
-            signature.close()
+        self.sig_size = 0
         try:
-            self.maker = _librsync.new_deltamaker(sig_string)
+            if type(signature) is bytes:
+                self.maker = _librsync.new_deltamaker(signature)
+                self._add_sig_memory(len(signature))
+            else:
+                self._check_file(signature)
+                self.maker = _librsync.new_deltamaker()
+                self._load_signature(signature)
         except _librsync.librsyncError as e:
+            self._add_sig_memory(-self.sig_size)
             raise librsyncError(str(e))
 
+    def close(self):
+        """Close new file and forget about the memory of the signature"""
+        self._add_sig_memory(-self.sig_size)
+        return LikeFile.close(self)
+
+    def _load_signature(self, sig_file):
+        """Feed the signature file to the maker, chunk by chunk"""
+        try:
+            while True:
+                sig_chunk = sig_file.read(blocksize)
+                self.maker.load_sig(sig_chunk)
+                if not sig_chunk:
+                    break
+                self._add_sig_memory(len(sig_chunk))
+        finally:
+            sig_file.close()
+
+    def _add_sig_memory(self, size):
+        """Add size bytes to the signature memory, of self and overall"""
+        global _sig_memory, _sig_memory_peak
+        self.sig_size += size
+        with _sig_memory_lock:
+            _sig_memory += size
+            _sig_memory_peak = max(_sig_memory_peak, _sig_memory)
+
 
 class PatchedFile(LikeFile):
     """File-like object which applies a librsync delta incrementally"""
@@ -189,40 +283,178 @@ class SigGenerator:
 
     Input and output is same as SigFile, but the interface is like md5
     module, not filelike object
-    FIXME: is only used within test suite librsynctest.py
     """
 
-    def __init__(self, blocksize=_librsync.RS_DEFAULT_BLOCK_LEN):
-        """Return new signature instance"""
+    def __init__(self, blocksize=_librsync.RS_DEFAULT_BLOCK_LEN, outfile=None,
+                 sig_format=None):
+        """Return new signature instance
+
+        If outfile is given, the signature is written to it as it is
+        calculated, instead of being kept in memory for get_sig().
+        sig_format is the same as for SigFile.
+
+        """
         try:
-            self.sig_maker = _librsync.new_sigmaker(blocksize)
+            self.sig_maker = _librsync.new_sigmaker(
+                blocksize, *_get_sig_format_args(sig_format))
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
         self.gotsig = None
         self.buffer = b""
         self.sig_string = b""
+        self.outfile = outfile
 
     def update(self, buf):
         """Add buf to data that signature will be calculated over"""
         if self.gotsig:
             raise librsyncError("SigGenerator already provided signature")
-        self.buffer += buf
-        while len(self.buffer) >= blocksize:
-            if self._process_buffer():
-                raise librsyncError("Premature EOF received from sig_maker")
+        if self.buffer:  # only what was left over from the previous update
+            buf = self.buffer + buf
+        with memoryview(buf) as view:
+            pos = 0
+            while len(view) - pos >= blocksize:
+                eof, len_buf_read = self._process_buffer(view[pos:])
+                if eof:
+                    raise librsyncError("Premature EOF received from sig_maker")
+                pos += len_buf_read
+            self.buffer = view[pos:].tobytes()
 
     def get_sig(self):
         """Return signature over given data"""
-        while not self._process_buffer():
-            pass  # keep running until eof
+        eof = None
+        while not eof:  # keep running until eof
+            eof, len_buf_read = self._process_buffer(self.buffer)
+            self.buffer = self.buffer[len_buf_read:]
         return self.sig_string
 
-    def _process_buffer(self):
-        """Run self.buffer through sig_maker, add to self.sig_string"""
+    def _process_buffer(self, buf):
+        """Run buf through sig_maker, add to self.sig_string
+
+        Returns the pair (eof, number of bytes of buf processed).
+
+        """
         try:
-            eof, len_buf_read, cycle_out = self.sig_maker.cycle(self.buffer)
+            eof, len_buf_read, cycle_out = self.sig_maker.cycle(buf)
         except _librsync.librsyncError as e:
             raise librsyncError(str(e))
-        self.buffer = self.buffer[len_buf_read:]
-        self.sig_string += cycle_out
-        return eof
+        if self.outfile is None:
+            self.sig_string += cycle_out
+        else:
+            self.outfile.write(cycle_out)
+        return eof, len_buf_read
+
+
+def _get_sig_format_args(sig_format):
+    """Return the arguments of the _librsync signature functions"""
+    if sig_format is None:
+        return ()
+    magic, strong_len = sig_format
+    return strong_len, magic
+
+
+def _make_room(buf, start, end, room):
+    """Make room for at least room bytes after the data in buf[start:end]
+
+    The data is moved to the beginning of the buffer if necessary, and
+    the buffer is enlarged if this isn't enough.  Returns the new start
+    and end offsets of the data.
+
+    """
+    if len(buf) - end >= room:
+        return start, end
+    if start:
+        buf[:end - start] = buf[start:end]
+        end -= start
+        start = 0
+    if len(buf) - end < room:
+        buf.extend(bytes(max(room, len(buf))))
+    return start, end
+
+
+def get_sig_format(name=None, strong_len=None):
+    """Return signature format as pair of magic number and strong length
+
+    name is one of SIG_FORMATS, strong_len the length in bytes of the
+    strong sums, 0 standing for the maximum of the format and longer
+    lengths being reduced to it.  Both default to the historic format.
+
+    """
+    magic, max_strong_len = SIG_FORMATS[name or DEFAULT_SIG_FORMAT]
+    if strong_len is None:
+        strong_len = DEFAULT_STRONG_LEN
+    if not strong_len or strong_len > max_strong_len:
+        strong_len = max_strong_len
+    return magic, strong_len
+
+
+def join_signatures(sigs):
+    """Return the signature of a file given the signatures of its segments
+
+    All segments but the last one must be a multiple of the block size.
+
+    """
+    return b"".join(sig[SIG_HEADER_LEN if i else 0:]
+                    for i, sig in enumerate(sigs))
+
+
+def get_signature_memory():
+    """Return bytes of signature currently loaded for deltas, and the peak"""
+    with _sig_memory_lock:
+        return _sig_memory, _sig_memory_peak
+
+
+def is_true_file(fileobj):
+    """Return true if fileobj is a plain local file, usable from C
+
+    Compressed files or files of remote connections are not, even if
+    some of them have a fileno() method.
+
+    """
+    return isinstance(fileobj, (io.FileIO, io.BufferedReader,
+                                io.BufferedWriter, io.BufferedRandom))
+
+
+def write_signature(basis_file, sig_file,
+                    blocksize=_librsync.RS_DEFAULT_BLOCK_LEN, sig_format=None):
+    """Write the signature of basis_file to sig_file, completely in C
+
+    Like the other write_* functions, it takes true files (see
+    is_true_file), reads and writes them from their current position,
+    and leaves them open.  The output file is positioned at the end of
+    the written data, the position of the input files is undefined.
+    sig_format is the same as for SigFile.
+
+    """
+    _run_whole_job(_librsync.sig_file, (basis_file, sig_file), blocksize,
+                   *_get_sig_format_args(sig_format))
+
+
+def write_delta(sig_file, new_file, delta_file):
+    """Write the delta of new_file against sig_file to delta_file"""
+    _run_whole_job(_librsync.delta_file, (sig_file, new_file, delta_file))
+
+
+def write_patched(basis_file, delta_file, out_file):
+    """Write basis_file patched with delta_file to out_file"""
+    _run_whole_job(_librsync.patch_file, (basis_file, delta_file, out_file))
+
+
+def _run_whole_job(job, files, *args):
+    """Run the _librsync whole file job on the file descriptors of files
+
+    The position of the file descriptors is aligned with the one of the
+    buffered file objects before the job, and the one of the output file,
+    which comes last, the other way around after.
+
+    """
+    fds = []
+    for fileobj in files:
+        fileobj.flush()
+        fds.append(fileobj.fileno())
+        os.lseek(fds[-1], fileobj.tell(), os.SEEK_SET)
+    try:
+        job(*fds, *args)
+    except _librsync.librsyncError as e:
+        raise librsyncError(str(e))
+    finally:
+        files[-1].seek(os.lseek(fds[-1], 0, os.SEEK_CUR))
@@ -173,7 +173,7 @@ class Logger:
         assert not self.log_file_open, "Can't open an already opened logfile."
         rpath.conn.log.Log.open_logfile_local(rpath)
         for conn in Globals.connections:
-            conn.log.Log.open_logfile_allconn(rpath.conn)
+            conn.reval_async("log.Log.open_logfile_allconn", rpath.conn)
 
     # @API(Log.open_logfile_allconn, 200)
     def open_logfile_allconn(self, log_file_conn):
@@ -199,7 +199,7 @@ class Logger:
         """Close logfile and inform all connections"""
         if self.log_file_open:
             for conn in Globals.connections:
-                conn.log.Log.close_logfile_allconn()
+                conn.reval_async("log.Log.close_logfile_allconn")
             self.log_file_conn.log.Log.close_logfile_local()
 
     # @API(Log.close_logfile_allconn, 200)
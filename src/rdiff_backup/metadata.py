@@ -51,16 +51,83 @@ File <filename>
 Where the lines are separated by newlines.  See the code below for the
 field names and values.
 
+Metadata can also be stored in a more compact binary format, which is
+quicker to parse, see BinaryMetadataFile.  Both formats are recognized
+when reading, so that a repository can contain files of both.
+
+Compressed files written in the rdiff-backup-data directory consist of
+independent gzip members of a limited size, each starting with a new
+record.  A sidecar file in the rdiff-backup-data/indexes directory maps
+the index of the first record of each member to the member's offset, so
+that reading the records under a given index can start at the right
+member instead of the beginning of the file.  As a series of members is
+still a valid gzip file, files are read the same way with or without
+their sidecar file, which is only used if it matches the file.
+
+Metadata which has to be reconstructed from a snapshot and diffs is
+cached as a snapshot in the rdiff-backup-data/metadata_cache directory,
+up to Globals.metadata_cache_size bytes, see PatchDiffMan.  Large files
+are read in processes of their own, see _iterate_in_process.
+
 """
 
+import bisect
+import gzip
 import re
 import os
 import binascii
+import pickle
+import struct
+import threading
 from . import log, Globals, rpath, Time, rorpiter
 
 
 _chars_to_quote = re.compile(b"\\n|\\\\")
 
+# name of the directory of the sidecar index files, next to the indexed files
+_index_dirname = b"indexes"
+# magic, device, inode, size and mtime (in ns) of the indexed file, number
+# of members, followed by offset and path length plus path of each member
+_index_header_format = "!8sQQQqI"
+_index_header_size = struct.calcsize(_index_header_format)
+_index_entry_format = "!QI"
+_index_entry_size = struct.calcsize(_index_entry_format)
+_index_magic = b"rdbidx01"
+
+# name of the directory of the cached reconstructed metadata snapshots
+_cache_dirname = b"metadata_cache"
+
+# files of at least this (compressed) size are read in a process of their
+# own, which sends the objects read in batches of the given length
+_process_min_size = 1024 * 1024
+_process_batch_length = 1000
+
+# kinds of the entries of binary metadata files, each entry made of its
+# kind, the length of its payload and the payload, see BinaryMetadataFile
+_ENTRY_RESET, _ENTRY_NAME, _ENTRY_FILE = 0, 1, 2
+_entry_header = struct.Struct("!BI")
+_binary_magic = b"rdiff-backup binary metadata 1"
+# common prefix with the previous path, length of the rest, type, flags
+_file_header = struct.Struct("!IIBB")
+_binary_types = (None, "reg", "dir", "sym", "dev", "fifo", "sock")
+_binary_type_codes = {type_: code for code, type_ in enumerate(_binary_types)}
+# uid, gid, permissions, user and group name ids, then the modification
+# time if the type has one, and the size for regular files
+_file_fields = {
+    "reg": struct.Struct("!qqIIIqQ"),
+    "dir": struct.Struct("!qqIIIq"),
+    "fifo": struct.Struct("!qqIIIq"),
+    "sock": struct.Struct("!qqIIIq"),
+    "sym": struct.Struct("!qqIII"),
+    "dev": struct.Struct("!qqIII"),
+}
+# flags of the optional fields, following in this order
+_FLAG_HARDLINK, _FLAG_SHA1, _FLAG_RESOURCEFORK, _FLAG_CARBONFILE = 1, 2, 4, 8
+_FLAG_MIRRORNAME, _FLAG_INCNAME = 16, 32
+_hardlink_fields = struct.Struct("!QQQ")
+_device_fields = struct.Struct("!cII")
+_length_field = struct.Struct("!I")
+
 ManagerObj = None  # Set this later to Manager instance
 
 
@@ -260,13 +327,136 @@ class RorpExtractor(FlatExtractor):
         return rpath.RORPath(index, data_dict)
 
 
+class BinaryRorpExtractor:
+    """Iterate rorps from a binary metadata file, see BinaryMetadataFile"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj  # holds file object we are reading from
+        self.blocksize = 256 * 1024
+        self.names = []  # user and group names, by id - 1
+        self.path = b""  # path of the previous file entry
+
+    def iterate(self):
+        """Return iterator that yields all objects with records"""
+        return self._iterate_starting_with(())
+
+    def _iterate_starting_with(self, index):
+        """Iterate objects whose index starts with given index"""
+        length = len(index)
+        for path, buf, pos in self._iterate_files():
+            rec_index = tuple(path.split(b"/")) if path else ()
+            if rec_index < index:
+                continue  # without decoding anything but the path
+            if rec_index[:length] != index:
+                break
+            try:
+                yield self._file_to_object(rec_index, buf, pos)
+            except (struct.error, IndexError, ValueError) as exc:
+                log.Log("Error parsing binary metadata of '{path}': "
+                        "{exc}".format(path=os.fsdecode(path), exc=exc), 2)
+        self.fileobj.close()
+
+    def _iterate_files(self):
+        """Yield the path, buffer and offset of the rest of file entries
+
+        The other entries are processed on the way.
+
+        """
+        buf, pos = b"", 0
+        while True:
+            if pos + _entry_header.size <= len(buf):
+                kind, length = _entry_header.unpack_from(buf, pos)
+                start = pos + _entry_header.size
+                end = start + length
+                if end <= len(buf):
+                    pos = end
+                    if kind == _ENTRY_FILE:
+                        prefix, suffix = _file_header.unpack_from(buf, start)[:2]
+                        rest = start + _file_header.size + suffix
+                        self.path = (self.path[:prefix]
+                                     + buf[start + _file_header.size:rest])
+                        yield self.path, buf, start
+                    elif kind == _ENTRY_NAME:
+                        self.names.append(buf[start:end].decode())
+                    elif kind == _ENTRY_RESET:
+                        if buf[start:end] != _binary_magic:
+                            log.Log.FatalError(
+                                "Metadata file '{mf}' has an unknown binary "
+                                "format.".format(mf=self.fileobj.name))
+                        self.names, self.path = [], b""
+                    # entries of other kinds are skipped, so that they
+                    # can be added without making the files unreadable
+                    continue
+            newbuf = self.fileobj.read(self.blocksize)
+            if not newbuf:
+                if pos < len(buf):
+                    log.Log("Ignoring truncated record at the end of binary "
+                            "metadata file", 2)
+                return
+            buf = buf[pos:] + newbuf
+            pos = 0
+
+    def _file_to_object(self, index, buf, pos):
+        """Return the RORPath of the file entry in buf at pos"""
+        suffix, type_code, flags = _file_header.unpack_from(buf, pos)[1:]
+        pos += _file_header.size + suffix
+        type_ = _binary_types[type_code]
+        data_dict = {'type': type_}
+        if type_ is None:
+            return rpath.RORPath(index, data_dict)
+        fields = _file_fields[type_]
+        values = fields.unpack_from(buf, pos)
+        pos += fields.size
+        data_dict['uid'], data_dict['gid'], data_dict['perms'] = values[:3]
+        data_dict['uname'] = values[3] and self.names[values[3] - 1] or None
+        data_dict['gname'] = values[4] and self.names[values[4] - 1] or None
+        if len(values) > 5:
+            data_dict['mtime'] = values[5]
+            if type_ == "reg":
+                data_dict['size'] = values[6]
+        if type_ == "sym":
+            data, pos = self._get_bytes(buf, pos)
+            data_dict['linkname'] = data
+        elif type_ == "dev":
+            devchar, major, minor = _device_fields.unpack_from(buf, pos)
+            pos += _device_fields.size
+            data_dict['devnums'] = (devchar.decode('ascii'), major, minor)
+        if not flags:
+            return rpath.RORPath(index, data_dict)
+        if flags & _FLAG_HARDLINK:
+            (data_dict['nlink'], data_dict['inode'],
+             data_dict['devloc']) = _hardlink_fields.unpack_from(buf, pos)
+            pos += _hardlink_fields.size
+        if flags & _FLAG_SHA1:
+            data_dict['sha1'] = binascii.hexlify(buf[pos:pos + 20]).decode(
+                'ascii')
+            pos += 20
+        if flags & _FLAG_RESOURCEFORK:
+            data_dict['resourcefork'], pos = self._get_bytes(buf, pos)
+        if flags & _FLAG_CARBONFILE:
+            data, pos = self._get_bytes(buf, pos)
+            data_dict['carbonfile'] = _string2carbonfile(data.decode())
+        if flags & _FLAG_MIRRORNAME:
+            data_dict['mirrorname'], pos = self._get_bytes(buf, pos)
+        elif flags & _FLAG_INCNAME:
+            data_dict['incname'], pos = self._get_bytes(buf, pos)
+        return rpath.RORPath(index, data_dict)
+
+    @staticmethod
+    def _get_bytes(buf, pos):
+        """Return the length prefixed bytes in buf at pos, and the next pos"""
+        length = _length_field.unpack_from(buf, pos)[0]
+        pos += _length_field.size
+        return buf[pos:pos + length], pos + length
+
+
 class FlatFile:
     """Manage a flat file containing info on various files
 
     This is used for metadata information, and possibly EAs and ACLs.
     The main read interface is as an iterator.  The storage format is
-    a flat, probably compressed file, so random access is not
-    recommended.
+    a flat, probably compressed file, so random access is only possible
+    at the start of the gzip members of indexed files.
 
     Even if the file looks like a text file, it is actually a binary file,
     so that (especially) paths can be stored as bytes, without issue
@@ -275,6 +465,10 @@ class FlatFile:
     rp, fileobj, mode = None, None, None
     _buffering_on = 1  # Buffering may be useful because gzip writes are slow
     _record_buffer, _max_buffer_size = None, 100
+    _member_size = 256 * 1024  # uncompressed bytes after which members end
+    _compresslevel = 9  # of the gzip members
+    _members = None  # _GzipMembers if the file is written as indexed members
+    _records_started = False  # True once records are written (w/o members)
     _extractor = FlatExtractor  # Override to class that iterates objects
     _object_to_record = None  # Set to function converting object to record
     _prefix = None  # Set to required prefix
@@ -300,7 +494,16 @@ class FlatFile:
             self.rp = rp_base
             self.fileobj = self.rp.open("rb", compress)
         elif mode == 'w' or mode == 'wb':
-            if compress and check_path and not rp_base.isinccompressed():
+            if (compress and check_path and not rp_base.isinccompressed()
+                    and rp_base.conn is Globals.local_connection):
+
+                def callback(rp):
+                    self.rp = rp
+
+                self._members = _GzipMembers(rp_base, callback,
+                                             self._compresslevel)
+                self.fileobj = self._members
+            elif compress and check_path and not rp_base.isinccompressed():
 
                 def callback(rp):
                     self.rp = rp
@@ -319,29 +522,59 @@ class FlatFile:
 
     def write_object(self, object):
         """Convert one object to record and write to file"""
+        if self._members:
+            if self._members.is_member_full(self._member_size):
+                self._flush_records()
+                self._members.start_member(object.index)
+                self._start_records()
+        elif not self._records_started:
+            self._start_records()
         self._write_record(self._object_to_record(object))
 
     def get_objects(self, restrict_index=None):
         """Return iterator of objects records from file rp"""
         if not restrict_index:
-            return self._extractor(self.fileobj).iterate()
-        extractor = self._extractor(self.fileobj)
+            return self._get_extractor()(self.fileobj).iterate()
+        offset = _get_member_offset(self.rp, restrict_index)
+        if offset:
+            self.fileobj.close()
+            self.fileobj = _GzipMemberReader(self.rp.path, offset)
+        extractor = self._get_extractor()(self.fileobj)
         return extractor._iterate_starting_with(restrict_index)
 
     def close(self):
         """Close file, for when any writing is done"""
         assert self.fileobj, "Can't close file already closed."
-        if self._buffering_on and self._record_buffer:
-            self.fileobj.write(b"".join(self._record_buffer))
-            self._record_buffer = []
+        self._flush_records()
         result = self.fileobj.close()
         self.fileobj = None
         self.rp.fsync_with_dir()
         self.rp.setdata()
+        if self._members and len(self._members.members) > 1:
+            _write_index(self.rp, self._members.members)
         if self.callback:
             self.callback(self.rp)
         return result
 
+    def _get_extractor(self):
+        """Return the extractor class of the file being read"""
+        return self._extractor
+
+    def _start_records(self):
+        """Start writing records to a new file or gzip member
+
+        Override to write a header, and reset any state the writing of
+        records depends on, as each member must be readable on its own.
+
+        """
+        self._records_started = True
+
+    def _flush_records(self):
+        """Write the records buffered so far"""
+        if self._buffering_on and self._record_buffer:
+            self.fileobj.write(b"".join(self._record_buffer))
+            self._record_buffer = []
+
     def _write_record(self, record):
         """Write a (text) record into the file"""
         if self._buffering_on:
@@ -353,11 +586,99 @@ class FlatFile:
             self.fileobj.write(record)
 
 
+class _GzipMembers:
+    """Write a compressed flat file as a series of gzip members
+
+    Each member can be decompressed on its own, and starts with the
+    record given to start_member.  Like rpath.MaybeGzip, the '.gz'
+    suffix is added to the path if missing and the file is only created
+    once data is written, else an empty file without suffix is created.
+
+    """
+
+    def __init__(self, base_rp, callback=None, compresslevel=9):
+        """Write to base_rp, call callback on the final rp once known"""
+        assert not base_rp.lstat(), (
+            "Path '{rp!s}' shouldn't already exist.".format(rp=base_rp))
+        self.base_rp = base_rp
+        self.callback = callback
+        self.compresslevel = compresslevel
+        self.rawfile = None  # opened at the first write
+        self.gzfile = None  # the current member, if started
+        self.first_index = None  # index of the first record of next member
+        self.member_length = 0  # uncompressed length of the current member
+        self.members = []  # (index of first record, offset) of each member
+
+    def is_member_full(self, member_size):
+        """Return true if a new member must be started"""
+        return self.first_index is None or self.member_length >= member_size
+
+    def start_member(self, index):
+        """End the current member, the next starts with the record of index"""
+        if self.gzfile:
+            self.gzfile.close()  # the raw file stays open
+            self.gzfile = None
+        self.first_index = index
+        self.member_length = 0
+
+    def write(self, buf):
+        """Write buf to the current member"""
+        if not buf:
+            return
+        if not self.rawfile:
+            if self.base_rp.index:
+                rp = self.base_rp.new_index(self.base_rp.index[:-1] + (
+                    self.base_rp.index[-1] + b".gz", ))
+            else:
+                rp = self.base_rp.append_path(b".gz")
+            if self.callback:
+                self.callback(rp)
+            self.rawfile = rp.open("wb")
+        if not self.gzfile:
+            self.members.append((self.first_index, self.rawfile.tell()))
+            self.gzfile = gzip.GzipFile(fileobj=self.rawfile, mode="wb",
+                                        compresslevel=self.compresslevel)
+        self.member_length += len(buf)
+        return self.gzfile.write(buf)
+
+    def close(self):
+        """Close the last member and the file"""
+        if self.gzfile:
+            self.gzfile.close()
+        if self.rawfile:
+            return self.rawfile.close()
+        if self.callback:
+            self.callback(self.base_rp)
+        self.base_rp.touch()
+
+
+class _GzipMemberReader(gzip.GzipFile):
+    """Read a compressed flat file from the member at given offset on"""
+
+    def __init__(self, path, offset):
+        self.rawfile = open(path, "rb")
+        self.rawfile.seek(offset)
+        super().__init__(fileobj=self.rawfile, mode="rb")
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.rawfile.close()
+
+
 class MetadataFile(FlatFile):
     """Store/retrieve metadata from mirror_metadata as rorps"""
     _prefix = b"mirror_metadata"
     _extractor = RorpExtractor
 
+    def _get_extractor(self):
+        """Return the extractor of the text or binary format of the file"""
+        peek = getattr(self.fileobj, "peek", None)
+        if peek and peek(1)[:1] == bytes((_ENTRY_RESET, )):
+            return BinaryRorpExtractor
+        return self._extractor
+
     @staticmethod
     def _object_to_record(rorpath):
         """From RORPath, return text record of file's metadata"""
@@ -431,6 +752,109 @@ class MetadataFile(FlatFile):
         return b"".join(str_list)
 
 
+class BinaryMetadataFile(MetadataFile):
+    """Store metadata in the binary format, read by BinaryRorpExtractor
+
+    The file is a series of entries made of a byte for their kind, the
+    length of their payload and the payload.  Reset entries, starting
+    the file and each gzip member, hold the format's magic string and
+    start anew with an empty table of names and no previous path.  Name
+    entries add the next user or group name to the table, referred to
+    by file entries with their position starting at 1, 0 meaning no
+    name.  File entries start with the length of the prefix shared with
+    the previous path and the rest of the path, followed by struct
+    packed fields depending on the type of the file and its flags.
+
+    """
+    # the highest level takes many times longer on packed data, for little
+    _compresslevel = 6
+
+    def _start_records(self):
+        """Reset the names and path, and write the magic string"""
+        super()._start_records()
+        self._names = {}
+        self._path = b""
+        self._write_record(
+            _entry_header.pack(_ENTRY_RESET, len(_binary_magic))
+            + _binary_magic)
+
+    def _object_to_record(self, rorpath):
+        """From RORPath, return binary entries of file's metadata"""
+        entries = []
+        path = b"/".join(rorpath.index)
+        prefix = len(os.path.commonprefix((self._path, path)))
+        self._path = path
+        type_ = rorpath.gettype()
+        flags = 0
+        parts = [None, path[prefix:]]  # header set once flags are known
+        if type_ is not None:
+            if type_ not in _file_fields:
+                log.Log.FatalError("Type '{ftype}' of path '{path}' can't "
+                                   "be stored as binary metadata.".format(
+                                       ftype=type_, path=rorpath))
+            uid, gid = rorpath.getuidgid()
+            values = [uid, gid, rorpath.getperms(),
+                      self._get_name_id(rorpath.getuname(), entries),
+                      self._get_name_id(rorpath.getgname(), entries)]
+            if type_ != "sym" and type_ != "dev":
+                values.append(rorpath.getmtime())
+            if type_ == "reg":
+                values.append(rorpath.getsize())
+            parts.append(_file_fields[type_].pack(*values))
+            if type_ == "sym":
+                parts.append(self._pack_bytes(rorpath.readlink()))
+            elif type_ == "dev":
+                devchar, major, minor = rorpath.getdevnums()
+                parts.append(_device_fields.pack(devchar.encode('ascii'),
+                                                 major, minor))
+            if (type_ == "reg" and Globals.preserve_hardlinks != 0
+                    and rorpath.getnumlinks() > 1):
+                flags |= _FLAG_HARDLINK
+                parts.append(_hardlink_fields.pack(rorpath.getnumlinks(),
+                                                   rorpath.getinode(),
+                                                   rorpath.getdevloc()))
+            if type_ == "reg" and rorpath.has_sha1():
+                flags |= _FLAG_SHA1
+                parts.append(binascii.unhexlify(rorpath.get_sha1()))
+            if type_ == "reg" and rorpath.has_resource_fork():
+                flags |= _FLAG_RESOURCEFORK
+                parts.append(self._pack_bytes(
+                    rorpath.get_resource_fork() or b""))
+            if type_ == "reg" and rorpath.has_carbonfile():
+                flags |= _FLAG_CARBONFILE
+                parts.append(self._pack_bytes(
+                    _carbonfile2string(rorpath.get_carbonfile()).encode()))
+            if rorpath.has_alt_mirror_name():
+                flags |= _FLAG_MIRRORNAME
+                parts.append(self._pack_bytes(rorpath.get_alt_mirror_name()))
+            elif rorpath.has_alt_inc_name():
+                flags |= _FLAG_INCNAME
+                parts.append(self._pack_bytes(rorpath.get_alt_inc_name()))
+        parts[0] = _file_header.pack(prefix, len(path) - prefix,
+                                     _binary_type_codes[type_], flags)
+        payload = b"".join(parts)
+        entries.append(_entry_header.pack(_ENTRY_FILE, len(payload)))
+        entries.append(payload)
+        return b"".join(entries)
+
+    def _get_name_id(self, name, entries):
+        """Return the id of name, adding an entry to define it if new"""
+        if not name:
+            return 0
+        name_id = self._names.get(name)
+        if name_id is None:
+            encoded = name.encode()
+            entries.append(_entry_header.pack(_ENTRY_NAME, len(encoded)))
+            entries.append(encoded)
+            name_id = self._names[name] = len(self._names) + 1
+        return name_id
+
+    @staticmethod
+    def _pack_bytes(data):
+        """Return data prefixed with its length"""
+        return _length_field.pack(len(data)) + data
+
+
 class CombinedWriter:
     """Used for simultaneously writing metadata, eas, and acls"""
 
@@ -459,6 +883,42 @@ class CombinedWriter:
             self.winaclwriter.close()
 
 
+class DiffWriter:
+    """Write the metadata of a session and the reverse diff of the previous
+
+    All records are written to the snapshot by the writer, like without
+    DiffWriter, but the records of the files which changed since the
+    previous session are also written to the reverse diff of the
+    previous snapshot, given the metadata of each file in both sessions,
+    as known by the backup anyway.  This spares reading both snapshots
+    again to compare them, see PatchDiffMan.ConvertMetaToDiff.
+
+    """
+
+    def __init__(self, writer, diffwriter):
+        self.writer = writer
+        self.diffwriter = diffwriter
+
+    def write_diff(self, new_rorp, old_rorp):
+        """Write the metadata of a file, new and old ones can be None
+
+        The old rorp must be the one read from the previous session's
+        metadata, and the new one be the same object if unchanged.
+
+        """
+        if new_rorp:
+            self.writer.write_object(new_rorp)
+        if new_rorp is not old_rorp:
+            if old_rorp:
+                self.diffwriter.write_object(old_rorp)
+            elif new_rorp:  # added, hence deleted in the diff
+                self.diffwriter.write_object(rpath.RORPath(new_rorp.index))
+
+    def close(self):
+        self.writer.close()
+        self.diffwriter.close()
+
+
 class Manager:
     """Read/Combine/Write metadata files by time"""
     meta_prefix = b'mirror_metadata'
@@ -552,11 +1012,19 @@ class Manager:
             self.prefixmap[incbase] = [rp]
 
     def _iter_helper(self, prefix, flatfileclass, time, restrict_index):
-        """Used below to find the right kind of file by time"""
+        """Used below to find the right kind of file by time
+
+        Large files are read in a process of their own.
+
+        """
         if time not in self.timerpmap:
             return None
         for rp in self.timerpmap[time]:
             if rp.getincbase_bname() == prefix:
+                if _check_in_process([rp]):
+                    return _iterate_in_process(
+                        lambda: flatfileclass(rp, 'r').get_objects(
+                            restrict_index))
                 return flatfileclass(rp, 'r').get_objects(restrict_index)
         return None
 
@@ -579,8 +1047,16 @@ class Manager:
                                  restrict_index)
 
     def _get_meta_writer(self, typestr, time):
-        """Return MetadataFile object opened for writing at given time"""
-        return self._writer_helper(self.meta_prefix, MetadataFile, typestr,
+        """Return MetadataFile object opened for writing at given time
+
+        The object writes the format given by Globals.metadata_format.
+
+        """
+        if Globals.metadata_format == "binary":
+            flatfileclass = BinaryMetadataFile
+        else:
+            flatfileclass = MetadataFile
+        return self._writer_helper(self.meta_prefix, flatfileclass, typestr,
                                    time)
 
     def _get_ea_writer(self, typestr, time):
@@ -628,8 +1104,38 @@ class PatchDiffMan(Manager):
     replaces the mirror_metadata entry, unless it has Type None, which
     indicates the record should be deleted from the original.
 
+    With Globals.metadata_diffs, the backup writes the diff of the
+    previous snapshot along with the new snapshot, using a DiffWriter,
+    instead of reading both snapshots once written to compare them.
+
+    A chain of diffs grows up to max_diff_chain files, and only as long
+    as reconstructing the metadata at its end doesn't cost more than
+    max_chain_cost times reading the snapshot alone.  The cost of
+    reading a file is estimated in proportion to its size, plus the
+    chain_file_cost of collating it with the other files for each
+    record, measured to be about a twentieth of parsing a record.  The
+    metadata reconstructed for a time is kept in a cache, so that it
+    doesn't need to be reconstructed again.
+
     """
     max_diff_chain = 9  # After this many diffs, make a new snapshot
+    max_chain_cost = 2.0  # in reads of the snapshot, see above
+    chain_file_cost = 0.05  # in reads of the snapshot, for each file
+
+    diffed_rp = None  # the snapshot replaced by a DiffWriter's diff
+
+    def GetWriter(self, typestr=b'snapshot', time=None):
+        """Get a writer of the metadata, or a DiffWriter if appropriate"""
+        if typestr != b'snapshot' or not Globals.metadata_diffs:
+            return super().GetWriter(typestr, time)
+        oldrp = self._check_needs_reverse_diff()
+        if not oldrp:
+            return super().GetWriter(typestr, time)
+        log.Log("Writing mirror_metadata diff along the snapshot", 6)
+        writer = super().GetWriter(typestr, time)
+        self.diffed_rp = oldrp
+        return DiffWriter(writer,
+                          self._get_meta_writer(b'diff', oldrp.getinctime()))
 
     def _get_diffiter(self, new_iter, old_iter):
         """Iterate meta diffs of new_iter -> old_iter"""
@@ -688,17 +1194,67 @@ class PatchDiffMan(Manager):
             "New '{nrp!s}' and old '{orp!s}' paths must be of "
             "type 'snapshot'.".format(nrp=newrp, orp=oldrp))
 
-        chainlen = 1
+        diffrps = []
         for rp in inclist[2:]:
             if rp.getinctype() != b'diff':
                 break
-            chainlen += 1
-        if chainlen >= self.max_diff_chain:
+            diffrps.append(rp)
+        if not self._check_chain_extensible(newrp, diffrps):
             return (None, None)
         return (newrp, oldrp)
 
+    def _check_needs_reverse_diff(self):
+        """Return the snapshot the current session can write the diff of
+
+        This is the case if the newest metadata is the snapshot of the
+        previous session, which the backup compared the files with, and
+        the chain of diffs it starts can still be extended, estimating
+        the size of the new snapshot with the one of the previous.
+        Else None is returned.
+
+        """
+        inclist = self.sorted_prefix_inclist(b'mirror_metadata')
+        if (not inclist or inclist[0].getinctime() != Time.prevtime
+                or inclist[0].getinctype() != b'snapshot'):
+            return None
+        diffrps = []
+        for rp in inclist[1:]:
+            if rp.getinctype() != b'diff':
+                break
+            diffrps.append(rp)
+        if not self._check_chain_extensible(inclist[0], diffrps):
+            return None
+        return inclist[0]
+
+    def _check_chain_extensible(self, snapshotrp, diffrps):
+        """Check if a diff can be added to the chain of snapshotrp and diffrps
+
+        Reconstructing the metadata at the end of the chain, one diff
+        longer than now, must not cost more than max_chain_cost, see
+        the class description.  The size of the added diff isn't known
+        yet, so only the cost of collating it is accounted for.
+
+        """
+        if len(diffrps) + 1 >= self.max_diff_chain:
+            return False
+        cost = (1 + sum(rp.getsize() for rp in diffrps)
+                / max(snapshotrp.getsize(), 1)
+                + (len(diffrps) + 1) * self.chain_file_cost)
+        return cost <= self.max_chain_cost
+
     def ConvertMetaToDiff(self):
-        """Replace a mirror snapshot with a diff if it's appropriate"""
+        """Replace a mirror snapshot with a diff if it's appropriate
+
+        If the diff was already written by a DiffWriter, the snapshot is
+        only removed, the new snapshot being complete.
+
+        """
+        if self.diffed_rp:
+            log.Log("Removing mirror_metadata snapshot {rp} replaced by its "
+                    "diff".format(rp=self.diffed_rp.get_safepath()), 6)
+            self.diffed_rp.delete()
+            self.diffed_rp = None
+            return
         newrp, oldrp = self._check_needs_diff()
         if not newrp:
             return
@@ -713,16 +1269,149 @@ class PatchDiffMan(Manager):
         oldrp.delete()
 
     def get_meta_at_time(self, time, restrict_index):
-        """Get metadata rorp iter, possibly by patching with diffs"""
-        meta_iters = [
-            MetadataFile(rp, 'r').get_objects(restrict_index)
-            for rp in self._relevant_meta_incs(time)
-        ]
-        if not meta_iters:
+        """Get metadata rorp iter, possibly by patching with diffs
+
+        Metadata patched once is read from the cache afterwards.  Large
+        metadata is read and patched in a process of its own.
+
+        """
+        meta_rps = self._relevant_meta_incs(time)
+        if not meta_rps:
             return None
-        if len(meta_iters) == 1:
-            return meta_iters[0]
-        return self._iterate_patched_meta(meta_iters)
+        if _check_in_process(meta_rps):
+            return _iterate_in_process(
+                lambda: self._get_meta_iter(meta_rps, time, restrict_index))
+        return self._get_meta_iter(meta_rps, time, restrict_index)
+
+    def _get_meta_iter(self, meta_rps, time, restrict_index):
+        """Return metadata rorp iter at time from the files meta_rps"""
+        if len(meta_rps) == 1:
+            return MetadataFile(meta_rps[0], 'r').get_objects(restrict_index)
+        cache_rp = Globals.rbdir.append(
+            _cache_dirname,
+            b"mirror_metadata.%b.snapshot.gz" % Time.timetobytes(time))
+        if Globals.metadata_cache_size and cache_rp.lstat():
+            log.Log("Reading cached metadata {rp}".format(
+                rp=cache_rp.get_safepath()), 6)
+            if _check_may_cache():  # emptied of the least recently used first
+                try:
+                    os.utime(cache_rp.path)
+                except OSError:
+                    pass  # e.g. a read-only repository
+            return MetadataFile(cache_rp, 'r').get_objects(restrict_index)
+        meta_iter = self._iterate_patched_meta([
+            MetadataFile(rp, 'r').get_objects(restrict_index)
+            for rp in meta_rps
+        ])
+        if not restrict_index and self._check_needs_caching(meta_rps):
+            return self._iterate_caching_meta(meta_iter, cache_rp)
+        return meta_iter
+
+    def _check_needs_caching(self, meta_rps):
+        """Check if the metadata patched from meta_rps should be cached
+
+        The metadata of the newest session isn't, because it is only
+        read once by the next backup, and is removed again if the
+        session gets regressed.  Metadata expected to be larger than the
+        whole cache isn't either, nor any if the session may not write to
+        the repository.
+
+        """
+        if not Globals.metadata_cache_size or not _check_may_cache():
+            return False
+        newest_rp = self.sorted_prefix_inclist(b'mirror_metadata')[0]
+        if meta_rps[-1].getinctime() >= newest_rp.getinctime():
+            return False
+        return meta_rps[0].getsize() <= Globals.metadata_cache_size
+
+    def _iterate_caching_meta(self, meta_iter, cache_rp):
+        """Yield the rorps of meta_iter and write them to cache_rp
+
+        The rorps are written to a temporary file, renamed once all are
+        written, so that no incomplete metadata is ever cached.  The
+        binary format is used, as the cache is only read by us.
+
+        """
+        cache_dir = cache_rp.get_parent_rp()
+        try:
+            if not cache_dir.lstat():
+                cache_dir.mkdir()
+            temprp = cache_dir.get_temp_rpath()
+            writer = BinaryMetadataFile(temprp, 'wb', check_path=0)
+        except OSError as exc:
+            log.Log("Metadata can't be cached in {cdir}: {exc}".format(
+                cdir=cache_dir.get_safepath(), exc=exc), 4)
+            yield from meta_iter
+            return
+        complete = False
+        try:
+            for rorp in meta_iter:
+                if writer is not None:
+                    try:
+                        writer.write_object(rorp)
+                    except OSError as exc:
+                        self._discard_cached_meta(writer, temprp, exc)
+                        writer = None
+                yield rorp
+            if writer is None:
+                return
+            try:
+                writer.close()
+                rpath.rename(temprp, cache_rp)
+                log.Log("Cached metadata in {rp}".format(
+                    rp=cache_rp.get_safepath()), 5)
+                complete = True
+                self._evict_cached_meta(cache_dir)
+            except OSError as exc:
+                if not complete:
+                    self._discard_cached_meta(writer, temprp, exc)
+                    writer = None
+                else:
+                    log.Log("Cached metadata in {cdir} can't be evicted: "
+                            "{exc}".format(cdir=cache_dir.get_safepath(),
+                                           exc=exc), 4)
+        finally:
+            if not complete and writer is not None:  # given up before the end
+                self._discard_cached_meta(writer, temprp)
+
+    def _discard_cached_meta(self, writer, temprp, exc=None):
+        """Close and delete the temporary file of metadata being cached
+
+        Errors are only logged, as the metadata can still be read without
+        caching it.
+
+        """
+        if exc is not None:
+            log.Log("Metadata can't be cached in {rp}: {exc}".format(
+                rp=temprp.get_safepath(), exc=exc), 4)
+        if writer.fileobj:  # not yet closed by the writer
+            try:
+                writer.fileobj.close()
+            except OSError:
+                pass  # the file is deleted anyway
+        try:
+            temprp.setdata()
+            if temprp.lstat():
+                temprp.delete()
+        except OSError as exc:
+            log.Log("Temporary file {rp} can't be deleted: {exc}".format(
+                rp=temprp.get_safepath(), exc=exc), 3)
+
+    def _evict_cached_meta(self, cache_dir):
+        """Delete the least recently used cached metadata beyond the size"""
+        cached = []
+        for filename in cache_dir.listdir():
+            rp = cache_dir.append(filename)
+            cached.append((rp.getmtime(), filename, rp))
+        cached.sort()
+        total = sum(rp.getsize() for _, _, rp in cached)
+        for _, _, rp in cached:
+            if total <= Globals.metadata_cache_size:
+                break
+            log.Log("Removing cached metadata {rp}".format(
+                rp=rp.get_safepath()), 5)
+            total -= rp.getsize()
+            rp.delete()
 
     def _relevant_meta_incs(self, time):
         """Return list [snapshotrp, diffrps ...] time sorted"""
@@ -744,9 +1433,9 @@ class PatchDiffMan(Manager):
     def _iterate_patched_meta(self, meta_iter_list):
         """Return an iter of metadata rorps by combining the given iters
 
-        The iters should be given as a list/tuple in reverse
-        chronological order.  The earliest rorp in each iter will
-        supercede all the later ones.
+        The iters should be given as a list/tuple starting with the
+        snapshot, like _relevant_meta_incs returns the files.  The rorp
+        in the last iter having one supercedes the ones before.
 
         """
         for meta_tuple in rorpiter.CollateIterators(*meta_iter_list):
@@ -798,6 +1487,184 @@ def unquote_path(quoted_string):
     return re.sub(b"\\\\n|\\\\\\\\", replacement_func, quoted_string)
 
 
+def _get_index_rp(rp):
+    """Return the rp of the sidecar index file of the flat file rp"""
+    return rp.get_parent_rp().append(_index_dirname,
+                                     rp.dirsplit()[1] + b".index")
+
+
+def _write_index(rp, members):
+    """Write the index file of rp, a list of (first index, offset) pairs
+
+    The index files of flat files which don't exist anymore, e.g.
+    because they were converted to diffs or removed, are removed.
+
+    """
+    index_rp = _get_index_rp(rp)
+    index_dir = index_rp.get_parent_rp()
+    if not index_dir.lstat():
+        index_dir.mkdir()
+    data_dir = index_dir.get_parent_rp()
+    for filename in index_dir.listdir():
+        data_filename = filename[:-len(b".index")]
+        if (not filename.endswith(b".index")
+                or not data_dir.append(data_filename).lstat()):
+            index_dir.append(filename).delete()
+    stat = os.stat(rp.path)
+    parts = [struct.pack(_index_header_format, _index_magic, stat.st_dev,
+                         stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                         len(members))]
+    for index, offset in members:
+        path = b"/".join(index)
+        parts.append(struct.pack(_index_entry_format, offset, len(path)))
+        parts.append(path)
+    index_rp.write_bytes(b"".join(parts))
+    index_rp.fsync_with_dir()
+
+
+def _get_member_offset(rp, index):
+    """Return the offset of the member of rp where index would be found
+
+    None is returned if the member is the first, or if rp has no valid
+    index file, because it was written without, or doesn't match it.
+
+    """
+    if rp.conn is not Globals.local_connection:
+        return None
+    try:
+        with open(_get_index_rp(rp).path, "rb") as index_file:
+            data = index_file.read()
+        stat = os.stat(rp.path)
+    except OSError:
+        return None
+    if len(data) < _index_header_size:
+        return None
+    magic, dev, ino, size, mtime_ns, count = struct.unpack_from(
+        _index_header_format, data)
+    if (magic != _index_magic or (dev, ino, size, mtime_ns)
+            != (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)):
+        return None
+    first_indexes, offsets = [], []
+    pos = _index_header_size
+    for _ in range(count):
+        offset, length = struct.unpack_from(_index_entry_format, data, pos)
+        pos += _index_entry_size
+        path = data[pos:pos + length]
+        pos += length
+        first_indexes.append(tuple(path.split(b"/")) if path else ())
+        offsets.append(offset)
+    member = bisect.bisect_right(first_indexes, index) - 1
+    if member <= 0:
+        return None
+    return offsets[member]
+
+
+def _check_may_cache():
+    """Check if this session may write metadata to the repository cache
+
+    A read-only session must not write to the repository, and files
+    written by another user than the owner of the repository, e.g. by
+    root restoring, might not be removable by the owner later on.
+
+    """
+    if Globals.security_level == "read-only":
+        return False
+    if hasattr(os, "geteuid"):
+        try:
+            return os.stat(Globals.rbdir.path).st_uid == os.geteuid()
+        except OSError:
+            return False
+    return True
+
+
+def _check_in_process(rps):
+    """Check if the files rps should be read in a process of their own
+
+    On a single CPU, the process would only add the cost of pickling.
+    Forking while other threads run could leave locks they hold forever
+    locked in the child, hence processes are then not used at all.
+
+    """
+    if not Globals.metadata_processes or not hasattr(os, "fork"):
+        return False
+    if threading.active_count() > 1:
+        return False
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    return (cpu_count > 1
+            and sum(rp.getsize() for rp in rps) >= _process_min_size)
+
+
+def _iterate_in_process(get_iter):
+    """Yield the objects of the iterator returned by get_iter()
+
+    The iterator is created and iterated in a child process forked from
+    this one, which decompresses and parses the files while the
+    objects it already sent are consumed here.  Threads wouldn't work
+    in parallel, as parsing holds the GIL.  The objects are sent in
+    pickled batches through a pipe, followed by None at the end, or by
+    the exception which ended the iteration, raised here as well.  If
+    the consumer gives up, the child ends when sending its next batch.
+
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        _send_in_batches(get_iter, write_fd)
+    os.close(write_fd)
+    try:
+        with os.fdopen(read_fd, "rb") as reader:
+            while True:
+                try:
+                    batch = pickle.load(reader)
+                except EOFError:
+                    log.Log.FatalError(
+                        "Process {pid} reading metadata ended "
+                        "unexpectedly".format(pid=pid))
+                if batch is None:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield from batch
+    finally:
+        os.waitpid(pid, 0)
+
+
+def _send_in_batches(get_iter, write_fd):
+    """Send the objects of get_iter() to write_fd, in the child process"""
+    exit_code = 0
+    try:
+        if not log.Log.log_file_local:
+            log.Log.log_file_open = None  # never use the connections here
+        with os.fdopen(write_fd, "wb") as writer:
+            obj_iter = None
+            batch = []
+            try:
+                obj_iter = get_iter()
+                for obj in obj_iter:
+                    batch.append(obj)
+                    if len(batch) >= _process_batch_length:
+                        pickle.dump(batch, writer, pickle.HIGHEST_PROTOCOL)
+                        batch = []
+                pickle.dump(batch, writer, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(None, writer, pickle.HIGHEST_PROTOCOL)
+            except BrokenPipeError:
+                raise  # the consumer gave up
+            except BaseException as exc:
+                pickle.dump(batch, writer, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(exc, writer, pickle.HIGHEST_PROTOCOL)
+            finally:
+                if hasattr(obj_iter, "close"):
+                    obj_iter.close()  # e.g. removes an incomplete cache file
+    except BaseException:
+        exit_code = 1
+    finally:
+        os._exit(exit_code)  # nothing of the parent may be run here
+
+
 def SetManager():
     global ManagerObj
     ManagerObj = PatchDiffMan()
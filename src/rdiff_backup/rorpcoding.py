@@ -0,0 +1,270 @@
+# Copyright 2026 the rdiff-backup project
+#
+# This file is part of rdiff-backup.
+#
+# rdiff-backup is free software; you can redistribute it and/or modify
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# rdiff-backup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rdiff-backup; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA
+"""Compact binary encoding of RORPaths sent over a connection
+
+Pickling the (index, data) pair of each RORPath repeats the keys of the
+data dictionary and the whole path for every file.  Since API version
+201, RORPaths are instead sent as packed records:
+
+    flags            B   FLAG_FILE if a file follows, FLAG_EXTRAS
+    shared, new      HH  components shared with the previous index,
+                         followed by the new components, each as
+                         H length + bytes
+    type             B   position in TYPES, or NO_TYPE
+    mask             H   which of INT_FIELDS and STR_FIELDS follow, and
+                         which STR_FIELDS repeat the previous record
+    INT_FIELDS       q   for each field present
+    STR_FIELDS       B   length + UTF-8 bytes, for each field present
+    extras           I   length + pickle of the rest of the dictionary,
+                         only if FLAG_EXTRAS is set
+
+Values which don't fit these fields, e.g. too big integers or
+extended attributes, are sent in the pickled extras.  A RORPath which
+can't be packed at all is sent pickled as before.
+
+An encoder and a decoder used on both ends of the same stream must
+see the same records in the same order, because indexes and names are
+encoded relative to the previous record.
+
+"""
+
+import operator
+import pickle
+import struct
+from . import Globals
+
+TYPES = (None, 'reg', 'dir', 'sym', 'dev', 'fifo', 'sock')
+NO_TYPE = 255  # type missing or unknown, sent in the extras if present
+INT_FIELDS = ('size', 'perms', 'uid', 'gid', 'inode', 'devloc', 'nlink',
+              'mtime', 'atime', 'ctime')
+STR_FIELDS = ('uname', 'gname')
+
+FLAG_FILE = 1
+FLAG_EXTRAS = 2
+
+_MAX_INT = 1 << 63
+_STR_MASK_SHIFT = len(INT_FIELDS)
+_REPEAT_MASK_SHIFT = _STR_MASK_SHIFT + len(STR_FIELDS)
+_TYPE_CODES = {type_: code for code, type_ in enumerate(TYPES)}
+_KNOWN_KEYS = frozenset(('type', ) + INT_FIELDS + STR_FIELDS)
+
+_header = struct.Struct("!BHH")
+_len = struct.Struct("!H")
+_type_mask = struct.Struct("!BH")
+_ints = [struct.Struct("!%iq" % i) for i in range(len(INT_FIELDS) + 1)]
+_extras_len = struct.Struct("!I")
+
+
+def is_supported():
+    """Return true if the API version agreed allows packed records"""
+    return Globals.get_api_version() >= 201
+
+
+class RORPEncoder:
+    """Pack the index and data of consecutive RORPaths"""
+
+    def __init__(self):
+        self.prev_index = ()
+        self.prev_strs = [None] * len(STR_FIELDS)
+        self.layouts = {}  # _Layout of each tuple of keys already seen
+
+    def encode(self, index, data, has_file=False):
+        """Return the packed record of index and data, or None
+
+        None is returned if the index can't be packed, in which case
+        the record must be sent some other way.
+
+        """
+        if len(index) > 0xFFFF:
+            return None
+        prev_index = self.prev_index
+        max_shared = min(len(index), len(prev_index))
+        shared = 0
+        while shared < max_shared and index[shared] == prev_index[shared]:
+            shared += 1
+        parts = [None]
+        for comp in index[shared:]:
+            if type(comp) is not bytes or len(comp) > 0xFFFF:
+                return None
+            parts.append(_len.pack(len(comp)))
+            parts.append(comp)
+
+        keys = tuple(data)
+        layout = self.layouts.get(keys)
+        if layout is None:
+            layout = self.layouts[keys] = _Layout(keys)
+        parts_len = len(parts)
+        try:
+            flags = self._add_data(parts, data, layout)
+        except (struct.error, KeyError, TypeError, AttributeError,
+                UnicodeEncodeError):
+            # unusual values, those not fitting their field go to the extras
+            del parts[parts_len:]
+            flags = self._add_data(parts, data, _Layout(keys, data))
+        if has_file:
+            flags |= FLAG_FILE
+        parts[0] = _header.pack(flags, shared, len(index) - shared)
+        self.prev_index = index
+        return b"".join(parts)
+
+    def _add_data(self, parts, data, layout):
+        """Add the packed data to parts following layout, return flags"""
+        mask = layout.mask
+        strs = []
+        for pos, field in layout.str_fields:
+            value = data[field]
+            if value == self.prev_strs[pos] and value is not None:
+                mask |= 1 << (_REPEAT_MASK_SHIFT + pos)
+            else:
+                encoded = value.encode('utf-8')
+                if len(encoded) > 0xFF:
+                    raise struct.error("Name too long")
+                mask |= 1 << (_STR_MASK_SHIFT + pos)
+                strs.append(bytes((len(encoded), )) + encoded)
+        parts.append(_type_mask.pack(layout.get_type_code(data), mask))
+        parts.append(layout.ints.pack(*layout.get_ints(data)))
+        parts.extend(strs)
+        for pos, field in layout.str_fields:
+            self.prev_strs[pos] = data[field]
+        if not layout.extra_keys:
+            return 0
+        extras = {key: data[key] for key in layout.extra_keys}
+        pickled = pickle.dumps(extras, Globals.PICKLE_PROTOCOL)
+        parts.append(_extras_len.pack(len(pickled)))
+        parts.append(pickled)
+        return FLAG_EXTRAS
+
+
+class _Layout:
+    """Which keys of a data dictionary go in which fields of a record"""
+
+    def __init__(self, keys, data=None):
+        """Sort out the given keys
+
+        If data is given, only its values which fit in the fields are
+        put there, the others going to the extras.
+
+        """
+        def fits(field, check):
+            return data is None or check(data[field])
+
+        self.extra_keys = [key for key in keys if key not in _KNOWN_KEYS]
+        if 'type' in keys and fits('type', _is_type):
+            self.get_type_code = lambda data: _TYPE_CODES[data['type']]
+        else:
+            if 'type' in keys:
+                self.extra_keys.append('type')
+            self.get_type_code = lambda data: NO_TYPE
+
+        self.mask = 0
+        int_fields = []
+        for bit, field in enumerate(INT_FIELDS):
+            if field not in keys:
+                continue
+            if fits(field, lambda v: (type(v) is int
+                                      and -_MAX_INT <= v < _MAX_INT)):
+                self.mask |= 1 << bit
+                int_fields.append(field)
+            else:
+                self.extra_keys.append(field)
+        self.ints = _ints[len(int_fields)]
+        if len(int_fields) > 1:
+            self.get_ints = operator.itemgetter(*int_fields)
+        else:
+            self.get_ints = lambda data: [data[f] for f in int_fields]
+
+        self.str_fields = []
+        for pos, field in enumerate(STR_FIELDS):
+            if field not in keys:
+                continue
+            if fits(field, _is_short_str):
+                self.str_fields.append((pos, field))
+            else:
+                self.extra_keys.append(field)
+
+
+def _is_type(value):
+    """Return true if value is one of the TYPES"""
+    try:
+        return value in _TYPE_CODES
+    except TypeError:  # unhashable
+        return False
+
+
+def _is_short_str(value):
+    """Return true if value is a string of at most 255 bytes in UTF-8"""
+    try:
+        return type(value) is str and len(value.encode('utf-8')) <= 0xFF
+    except UnicodeEncodeError:
+        return False
+
+
+class RORPDecoder:
+    """Unpack the records of an RORPEncoder"""
+
+    def __init__(self):
+        self.prev_index = ()
+        self.prev_strs = [None] * len(STR_FIELDS)
+        self.int_fields = {}  # INT_FIELDS and struct of each mask seen
+
+    def decode(self, buf):
+        """Return (index, data, has_file) tuple packed in buf"""
+        flags, shared, new = _header.unpack_from(buf)
+        pos = _header.size
+        if new:
+            index = list(self.prev_index[:shared])
+            for i in range(new):
+                length = _len.unpack_from(buf, pos)[0]
+                pos += _len.size
+                index.append(bytes(buf[pos:pos + length]))
+                pos += length
+            index = tuple(index)
+        else:
+            index = self.prev_index[:shared]
+
+        type_code, mask = _type_mask.unpack_from(buf, pos)
+        pos += _type_mask.size
+        int_mask = mask & ((1 << _STR_MASK_SHIFT) - 1)
+        try:
+            fields, ints = self.int_fields[int_mask]
+        except KeyError:
+            fields = [field for bit, field in enumerate(INT_FIELDS)
+                      if int_mask & (1 << bit)]
+            ints = _ints[len(fields)]
+            self.int_fields[int_mask] = fields, ints
+        data = dict(zip(fields, ints.unpack_from(buf, pos)))
+        pos += ints.size
+        if type_code != NO_TYPE:
+            data['type'] = TYPES[type_code]
+        if mask >> _STR_MASK_SHIFT:
+            for field_pos, field in enumerate(STR_FIELDS):
+                if mask & (1 << (_REPEAT_MASK_SHIFT + field_pos)):
+                    data[field] = self.prev_strs[field_pos]
+                elif mask & (1 << (_STR_MASK_SHIFT + field_pos)):
+                    length = buf[pos]
+                    value = bytes(buf[pos + 1:pos + 1 + length]).decode()
+                    pos += 1 + length
+                    data[field] = self.prev_strs[field_pos] = value
+        if flags & FLAG_EXTRAS:
+            length = _extras_len.unpack_from(buf, pos)[0]
+            pos += _extras_len.size
+            data.update(pickle.loads(buf[pos:pos + length]))
+
+        self.prev_index = index
+        return index, data, bool(flags & FLAG_FILE)
@@ -189,6 +189,7 @@ class RORPath:
     def __setstate__(self, rorp_state):
         """Reproduce RORPath from __getstate__ output"""
         self.index, self.data = rorp_state
+        self.file = None
 
     def zero(self):
         """Set inside of self to type None"""
@@ -662,6 +663,7 @@ class RPath(RORPath):
         conn_number, self.base, self.index, self.data = rpath_state
         self.conn = Globals.connection_dict[conn_number]
         self.path = self.path_join(self.base, *self.index)
+        self.file = None
 
     def setdata(self):
         """Set data dictionary using the wrapper"""
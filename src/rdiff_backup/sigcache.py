@@ -0,0 +1,265 @@
+# Copyright 2026 the rdiff-backup project
+#
+# This file is part of rdiff-backup.
+#
+# rdiff-backup is free software; you can redistribute it and/or modify
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# rdiff-backup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rdiff-backup; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301, USA
+"""Cache the librsync signatures of mirror files between sessions
+
+Getting the signature of a changed mirror file means reading it
+completely.  As the mirror file was written by a previous session,
+its signature can instead be computed while it is written, stored in
+the rdiff-backup-data/signatures directory, and read back during the
+next backup in place of the mirror file.
+
+Each cache entry is a file named after the SHA1 digest of the index,
+spread over 256 sub-directories.  It starts with a header holding the
+index, the signature format, and the device, inode, size, mtime and
+ctime of the mirror file at the time the signature was stored.  An
+entry is only used if all of them still match, so that entries made
+obsolete by a regress, a failed session, a change of signature format
+or a change behind our back are simply ignored (and removed).
+
+"""
+
+import hashlib
+import os
+import struct
+from . import Globals, log, librsync, Rdiff
+
+# name of the cache directory within the rdiff-backup-data directory
+_cache_dirname = b"signatures"
+
+# magic, device, inode, size, mtime, ctime (both in ns), blocksize,
+# signature magic number and strong sum length, length of the signature
+# and length of the index following the header
+_header_format = "!8sQQQqqIIIQI"
+_header_size = struct.calcsize(_header_format)
+_header_magic = b"rdbsig02"
+
+
+def get_cache():
+    """Return the signature cache of the repository, None if disabled
+
+    Must be called on the destination side, after Globals.rbdir is set.
+
+    """
+    if not Globals.signature_cache:
+        return None
+    cache_rp = Globals.rbdir.append_path(_cache_dirname)
+    if not cache_rp.lstat():
+        cache_rp.mkdir()
+    return SigCache(cache_rp)
+
+
+class SigCache:
+    """Signatures of mirror files, stored under rdiff-backup-data
+
+    The signatures are stored in two steps: wrap() returns a file
+    object computing the signature while the new mirror file is written,
+    and update() stores it once the mirror file has been renamed into
+    place, or discard() throws it away if the mirror file was not
+    changed after all.
+
+    """
+
+    def __init__(self, cache_rp):
+        """Initialize the cache stored in the directory cache_rp"""
+        self.cache_rp = cache_rp
+        self._pending = {}  # index -> _SigTeeFile not yet stored
+
+    def get_signature(self, mirror_rp):
+        """Return file object with cached signature of mirror_rp, or None"""
+        entry_path = self._get_entry_path(mirror_rp.index)
+        try:
+            sig_fp = open(entry_path, "rb")
+        except FileNotFoundError:
+            return None
+        except OSError as exc:
+            log.Log("Unable to open cached signature of %s: %s" %
+                    (mirror_rp.get_safeindexpath(), exc), 3)
+            return None
+        try:
+            stat = os.lstat(mirror_rp.path)
+            header = sig_fp.read(_header_size)
+            index = self._get_index_bytes(mirror_rp.index)
+            sig_len = self._check_header(header, index, stat)
+            if (sig_len is not None and sig_fp.read(len(index)) == index
+                    and os.fstat(sig_fp.fileno()).st_size
+                    == _header_size + len(index) + sig_len):
+                log.Log("Using cached signature of %s" %
+                        mirror_rp.get_safeindexpath(), 7)
+                return sig_fp
+        except OSError as exc:
+            log.Log("Unable to read cached signature of %s: %s" %
+                    (mirror_rp.get_safeindexpath(), exc), 3)
+        sig_fp.close()
+        log.Log("Removing outdated cached signature of %s" %
+                mirror_rp.get_safeindexpath(), 7)
+        self._remove(entry_path)
+        return None
+
+    def wrap(self, index, fileobj, size):
+        """Return fileobj, computing its signature while it is read
+
+        size is the expected size of the data, it determines the block
+        size of the signature.  If the cache can't be written, fileobj
+        is returned unchanged.
+
+        """
+        self.discard(index)
+        entry_path = self._get_entry_path(index)
+        index_bytes = self._get_index_bytes(index)
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            sig_fp = open(entry_path + b".new", "wb")
+            # the real header is only written once the signature is stored
+            sig_fp.write(bytes(_header_size) + index_bytes)
+        except OSError as exc:
+            log.Log("Unable to cache signature of %s: %s" %
+                    (self._get_safe_index(index), exc), 3)
+            return fileobj
+        tee = _SigTeeFile(fileobj, Rdiff._find_blocksize(size), sig_fp,
+                          Rdiff.get_sig_format())
+        self._pending[index] = tee
+        return tee
+
+    def update(self, index, mirror_rp):
+        """Store the pending signature of index as the one of mirror_rp
+
+        This is called after mirror_rp has been changed.  If no complete
+        signature is pending, e.g. because mirror_rp isn't a regular
+        file anymore, any cached signature of index is removed.
+
+        """
+        tee = self._pending.pop(index, None)
+        entry_path = self._get_entry_path(index)
+        if tee is None or not tee.complete:
+            self._remove(entry_path)
+            if tee is not None:
+                tee.abort()
+            return
+        try:
+            stat = os.lstat(mirror_rp.path)
+            sig_len = tee.sig_fp.tell() - _header_size - len(
+                self._get_index_bytes(index))
+            tee.sig_fp.seek(0)
+            tee.sig_fp.write(struct.pack(
+                _header_format, _header_magic, stat.st_dev, stat.st_ino,
+                stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns,
+                Rdiff._find_blocksize(stat.st_size), *tee.sig_format,
+                sig_len, len(self._get_index_bytes(index))))
+            tee.sig_fp.close()
+            os.replace(tee.sig_fp.name, entry_path)
+        except OSError as exc:
+            log.Log("Unable to cache signature of %s: %s" %
+                    (self._get_safe_index(index), exc), 3)
+            tee.abort()
+            self._remove(entry_path)
+
+    def discard(self, index):
+        """Forget pending signature of index, the mirror file is unchanged"""
+        tee = self._pending.pop(index, None)
+        if tee is not None:
+            tee.abort()
+
+    def close(self):
+        """Forget all pending signatures, at the end of the session"""
+        for index in list(self._pending):
+            self.discard(index)
+
+    def _get_entry_path(self, index):
+        """Return path of the cache entry of index"""
+        digest = hashlib.sha1(self._get_index_bytes(index)).hexdigest()
+        return os.path.join(self.cache_rp.path, os.fsencode(digest[:2]),
+                            os.fsencode(digest[2:]))
+
+    def _get_index_bytes(self, index):
+        """Return index as bytes, as stored in the cache entry"""
+        return b"/".join(index)
+
+    def _get_safe_index(self, index):
+        """Return index in a form safe to log"""
+        return self._get_index_bytes(index).decode(errors="replace") or "."
+
+    def _check_header(self, header, index, stat):
+        """Return signature length if header matches stat, else None"""
+        if len(header) != _header_size:
+            return None
+        (magic, dev, inode, size, mtime, ctime, blocksize, sig_magic,
+         strong_len, sig_len, index_len) = struct.unpack(_header_format,
+                                                         header)
+        if (magic == _header_magic and dev == stat.st_dev
+                and inode == stat.st_ino and size == stat.st_size
+                and mtime == stat.st_mtime_ns and ctime == stat.st_ctime_ns
+                and blocksize == Rdiff._find_blocksize(size)
+                and (sig_magic, strong_len) == Rdiff.get_sig_format()
+                and index_len == len(index)):
+            return sig_len
+        return None
+
+    def _remove(self, path):
+        """Remove file at path if it exists"""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            log.Log("Unable to remove cached signature %s: %s" %
+                    (os.fsdecode(path), exc), 3)
+
+
+class _SigTeeFile:
+    """Pass on data read from a file, while computing its signature
+
+    Errors while computing or writing the signature are only logged,
+    they never disturb the reading of the data itself.
+
+    """
+
+    def __init__(self, fileobj, blocksize, sig_fp, sig_format):
+        self.fileobj = fileobj
+        self.sig_fp = sig_fp
+        self.sig_format = sig_format
+        self.sig_gen = librsync.SigGenerator(blocksize, sig_fp, sig_format)
+        self.complete = self.failed = False
+
+    def read(self, length=-1):
+        """Read from the file and feed the data to the signature"""
+        buf = self.fileobj.read(length)
+        if self.failed or self.complete:
+            return buf
+        try:
+            if buf:
+                self.sig_gen.update(buf)
+            elif length != 0:  # end of file
+                self.sig_gen.get_sig()
+                self.complete = True
+        except (OSError, librsync.librsyncError) as exc:
+            log.Log("Unable to compute signature to cache: %s" % exc, 3)
+            self.failed = True
+        return buf
+
+    def close(self):
+        """Close the file and return its close value"""
+        return self.fileobj.close()
+
+    def abort(self):
+        """Close and remove the unfinished signature file"""
+        self.sig_fp.close()
+        try:
+            os.unlink(self.sig_fp.name)
+        except OSError:
+            pass
@@ -38,7 +38,12 @@ class StatsObj:
                         'DeletedFiles', 'DeletedFileSize', 'ChangedFiles',
                         'ChangedSourceSize', 'ChangedMirrorSize',
                         'IncrementFiles', 'IncrementFileSize')
-    _stat_misc_attrs = ('Errors', 'TotalDestinationSizeChange')
+    _stat_misc_attrs = ('Errors', 'TotalDestinationSizeChange',
+                        'ConnectionDataSize', 'ConnectionCompressedSize',
+                        'ConnectionCompressionTime',
+                        'ConnectionRoundTripTime', 'ConnectionBandwidth',
+                        'PipelineMaxLength', 'ConnectionBufferSize',
+                        'BlockSize')
     _stat_time_attrs = ('StartTime', 'EndTime', 'ElapsedTime')
     _stat_attrs = (
         ('Filename', ) + _stat_time_attrs + _stat_misc_attrs + _stat_file_attrs)
@@ -231,6 +236,39 @@ class StatsObj:
                             (tdsc, self.get_byte_summary_string(tdsc)))
         if self.Errors is not None:
             misc_string += "Errors %d\n" % self.Errors
+        if self.ConnectionDataSize is not None:
+            misc_string += ("ConnectionDataSize %s (%s)\n" % (
+                self.ConnectionDataSize,
+                self.get_byte_summary_string(self.ConnectionDataSize)))
+        if self.ConnectionCompressedSize is not None:
+            if self.ConnectionDataSize:
+                ratio = ", %.1f%%" % (100.0 * self.ConnectionCompressedSize
+                                      / self.ConnectionDataSize)
+            else:
+                ratio = ""
+            misc_string += ("ConnectionCompressedSize %s (%s%s)\n" % (
+                self.ConnectionCompressedSize,
+                self.get_byte_summary_string(self.ConnectionCompressedSize),
+                ratio))
+        if self.ConnectionCompressionTime is not None:
+            misc_string += ("ConnectionCompressionTime %.2f (%s)\n" % (
+                self.ConnectionCompressionTime,
+                Time.inttopretty(self.ConnectionCompressionTime)))
+        if self.ConnectionRoundTripTime is not None:
+            misc_string += "ConnectionRoundTripTime %.4f (%.1f ms)\n" % (
+                self.ConnectionRoundTripTime,
+                self.ConnectionRoundTripTime * 1000)
+        if self.ConnectionBandwidth is not None:
+            misc_string += "ConnectionBandwidth %d (%s/s)\n" % (
+                self.ConnectionBandwidth,
+                self.get_byte_summary_string(self.ConnectionBandwidth))
+        if self.PipelineMaxLength is not None:
+            misc_string += "PipelineMaxLength %d\n" % self.PipelineMaxLength
+        for attr in ('ConnectionBufferSize', 'BlockSize'):
+            val = self.get_stat(attr)
+            if val is not None:
+                misc_string += "%s %d (%s)\n" % (
+                    attr, val, self.get_byte_summary_string(val))
         return misc_string
 
     def _set_stats_from_string(self, s):
@@ -432,6 +470,39 @@ def record_error():
         _active_statfileobj.add_error()
 
 
+# @API(statistics.set_connection_stats, 201)
+def set_connection_stats(data_size, compressed_size, compression_time):
+    """Record on active statfileobj the traffic of compressed connections
+
+    data_size and compressed_size are the bytes sent and received over
+    the connections before and after compression, compression_time the
+    seconds spent to compress and decompress them on all sides.
+
+    """
+    if _active_statfileobj:
+        _active_statfileobj.ConnectionDataSize = data_size
+        _active_statfileobj.ConnectionCompressedSize = compressed_size
+        _active_statfileobj.ConnectionCompressionTime = compression_time
+
+
+# @API(statistics.set_tuning_stats, 201)
+def set_tuning_stats(round_trip_time, bandwidth, pipeline_max_length,
+                     conn_bufsize, blocksize):
+    """Record on active statfileobj how the connections were tuned
+
+    round_trip_time and bandwidth are the measures of the slowest
+    connection, in seconds and bytes per second, followed by the values
+    chosen for them, see SetConnections.tune_connections.
+
+    """
+    if _active_statfileobj:
+        _active_statfileobj.ConnectionRoundTripTime = round_trip_time
+        _active_statfileobj.ConnectionBandwidth = int(bandwidth)
+        _active_statfileobj.PipelineMaxLength = pipeline_max_length
+        _active_statfileobj.ConnectionBufferSize = conn_bufsize
+        _active_statfileobj.BlockSize = blocksize
+
+
 def process_increment(inc_rorp):
     """Add statistics of increment rp incrp if there is active statfile"""
     if _active_statfileobj:
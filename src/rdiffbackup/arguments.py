@@ -175,6 +175,13 @@ COMMON_PARSER.add_argument(
 COMMON_PARSER.add_argument(
     "--fsync", default=True, action=BooleanOptionalAction,
     help="[opt] do (or not) often sync the file system (_not_ doing it is faster but can be dangerous)")
+COMMON_PARSER.add_argument(
+    "--metadata-cache-size", type=int, default=268435456, metavar="BYTES",
+    help="[opt] maximum size of the reconstructed metadata cached in the "
+         "repository, 0 for none (default is 256MiB)")
+COMMON_PARSER.add_argument(
+    "--metadata-processes", default=False, action=BooleanOptionalAction,
+    help="[opt] read (or not) large metadata files in parallel processes")
 COMMON_PARSER.add_argument(
     "--null-separator", action="store_true",
     help="[opt] use null instead of newline in input and output files")
@@ -201,6 +208,27 @@ COMMON_PARSER.add_argument(
     "--restrict-mode", type=str,
     choices=["read-write", "read-only", "update-only"], default="read-write",
     help="[opt] restriction mode for directory (default is 'read-write')")
+COMMON_PARSER.add_argument(
+    "--connection-compression", choices=("zlib", "lzma"),
+    help="[opt] compress the data sent over remote connections "
+         "(default is not to compress)")
+COMMON_PARSER.add_argument(
+    "--connection-compression-level", type=int, choices=range(0, 10),
+    default=6, metavar="LEVEL",
+    help="[opt] level of compression of remote connections (default is 6)")
+COMMON_PARSER.add_argument(
+    "--connection-channels", type=int, choices=range(1, 17), default=1,
+    metavar="COUNT",
+    help="[opt] number of pipes to each remote process, to transfer "
+         "file data in parallel (default is 1)")
+COMMON_PARSER.add_argument(
+    "--connection-tuning", action="store_true",
+    help="[opt] tune the pipeline length and buffer sizes to the latency "
+         "and bandwidth measured on remote connections")
+COMMON_PARSER.add_argument(
+    "--connection-statistics", type=str, metavar="FILE_PATH",
+    help="[opt] write statistics of the requests and data exchanged over "
+         "remote connections as YAML to the given file")
 COMMON_PARSER.add_argument(
     "--ssh-compression", default=True, action=BooleanOptionalAction,
     help="[opt] use SSH without compression with default remote-schema")
@@ -326,6 +354,54 @@ COMPRESSION_PARSER.add_argument(
     default=DEFAULT_NOT_COMPRESSED_REGEXP,
     help="[sub] regexp to select files not being compressed")
 
+PERFORMANCE_PARSER = argparse.ArgumentParser(
+    add_help=False,
+    description="[parent] options related to performance tuning")
+PERFORMANCE_PARSER.add_argument(
+    "--delta-buffer-size", type=int, default=67108864, metavar="BYTES",
+    help="[sub] maximum bytes of diffs computed in advance (default is 64MiB)")
+PERFORMANCE_PARSER.add_argument(
+    "--delta-workers", type=int, default=1, metavar="WORKERS",
+    help="[sub] number of threads computing diffs in advance (default is 1)")
+PERFORMANCE_PARSER.add_argument(
+    "--metadata-format", choices=("text", "binary"), default="text",
+    help="[sub] format of the metadata files written (default is text)")
+PERFORMANCE_PARSER.add_argument(
+    "--metadata-diffs", default=False, action=BooleanOptionalAction,
+    help="[sub] write (or not) the metadata diff of the previous backup "
+         "along with the new metadata")
+PERFORMANCE_PARSER.add_argument(
+    "--segment-memory", type=int, default=268435456, metavar="BYTES",
+    help="[sub] maximum size of the signatures loaded at once for the "
+         "segments of a file (default is 256MiB)")
+PERFORMANCE_PARSER.add_argument(
+    "--segment-size", type=int, default=0, metavar="BYTES",
+    help="[sub] split files bigger than this size in segments processed "
+         "in parallel (default is 0 for never)")
+PERFORMANCE_PARSER.add_argument(
+    "--segment-workers", type=int, default=4, metavar="WORKERS",
+    help="[sub] number of threads processing the segments of a file "
+         "(default is 4)")
+PERFORMANCE_PARSER.add_argument(
+    "--signature-cache", default=False, action=BooleanOptionalAction,
+    help="[sub] store (or not) signatures of mirror files in the repository")
+PERFORMANCE_PARSER.add_argument(
+    "--signature-format", choices=("md4", "blake2", "rk-md4", "rk-blake2"),
+    help="[sub] format of the signatures (default is the one recorded "
+         "in the repository, md4 for new repositories)")
+PERFORMANCE_PARSER.add_argument(
+    "--signature-strong-length", type=int, choices=range(0, 33),
+    metavar="BYTES",
+    help="[sub] length of the strong sums of signatures, 0 for the maximum "
+         "(default is the one recorded in the repository, else 8)")
+PERFORMANCE_PARSER.add_argument(
+    "--signature-workers", type=int, default=1, metavar="WORKERS",
+    help="[sub] number of threads computing signatures in advance (default is 1)")
+PERFORMANCE_PARSER.add_argument(
+    "--small-file-size", type=int, default=0, metavar="BYTES",
+    help="[sub] send files smaller than this size whole and in batches "
+         "(default is 0 for never)")
+
 STATISTICS_PARSER = argparse.ArgumentParser(
     add_help=False,
     description="[parent] options related to backup statistics")
@@ -360,7 +436,7 @@ PARENT_PARSERS = [
     COMMON_PARSER, COMMON_COMPAT200_PARSER,
     CREATION_PARSER, COMPRESSION_PARSER, SELECTION_PARSER,
     FILESYSTEM_PARSER, USER_GROUP_PARSER, STATISTICS_PARSER,
-    TIMESTAMP_PARSER
+    TIMESTAMP_PARSER, PERFORMANCE_PARSER
 ]
 
 
@@ -466,6 +542,7 @@ class BackupAction(BaseAction):
     parent_parsers = [
         CREATION_PARSER, COMPRESSION_PARSER, SELECTION_PARSER,
         FILESYSTEM_PARSER, USER_GROUP_PARSER, STATISTICS_PARSER,
+        PERFORMANCE_PARSER,
     ]
 
     @classmethod
@@ -628,7 +705,15 @@ class ServerAction(BaseAction):
     Start rdiff-backup in server mode (only meant for internal use).
     """
     name = "server"
-    # server has no specific sub-options
+
+    @classmethod
+    def add_action_subparser(cls, sub_handler):
+        subparser = super().add_action_subparser(sub_handler)
+        subparser.add_argument(
+            "--listen", type=str, metavar="SOCKET_PATH",
+            help="serve the clients connecting to the given Unix socket, "
+                 "each in its own process, until terminated")
+        return subparser
 
 
 class VerifyAction(BaseAction):
@@ -809,6 +894,11 @@ def _parse_compat200(args, version_string, parent_parsers=[]):
         "--verify-at-time", type=str, metavar="AT_TIME",
         help="[act=] verify hash values in backup repo (at given time)")
 
+    parser.add_argument(
+        "--listen", type=str, metavar="SOCKET_PATH",
+        help="[sub] with --server, serve the clients connecting to the "
+             "given Unix socket until terminated")
+
     parser.add_argument(
         "locations", nargs='*',
         help="[args] locations remote and local to be handled by chosen action")
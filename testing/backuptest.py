@@ -1,6 +1,7 @@
+import io
 import unittest
 from commontest import MirrorTest, old_inc1_dir, old_inc2_dir, old_inc3_dir, old_inc4_dir
-from rdiff_backup import Globals, SetConnections, user_group
+from rdiff_backup import Globals, SetConnections, user_group, backup, iterfile
 
 
 class RemoteMirrorTest(unittest.TestCase):
@@ -27,6 +28,111 @@ class RemoteMirrorTest(unittest.TestCase):
         MirrorTest(1, 1,
                    [old_inc1_dir, old_inc2_dir, old_inc3_dir, old_inc4_dir])
 
+    def _mirror_with(self, local, **settings):
+        """Run testMirror2 or its local version with the given globals"""
+        old_settings = {name: getattr(Globals, name) for name in settings}
+        for name, value in settings.items():
+            Globals.set(name, value)
+        try:
+            MirrorTest(local, local,
+                       [old_inc1_dir, old_inc2_dir, old_inc3_dir, old_inc4_dir])
+        finally:
+            for name, value in old_settings.items():
+                Globals.set(name, value)
+
+    def testMirrorSignatureWorkers(self):
+        """Test mirror with signatures computed in parallel"""
+        self._mirror_with(None, signature_workers=4)
+        self._mirror_with(1, signature_workers=4)
+
+    def testMirrorDeltaWorkers(self):
+        """Test mirror with diffs computed in parallel"""
+        self._mirror_with(None, delta_workers=4, delta_buffer_size=100000)
+        self._mirror_with(1, delta_workers=4, delta_buffer_size=100000)
+
+
+class FilePrefetcherTest(unittest.TestCase):
+    """Test the reading of files ahead of their consumer"""
+
+    def _get_objects(self, count, produced, prefetch=None):
+        """Yield count pairs of index and file, counting them in produced"""
+        for index in range(count):
+            produced.append(index)
+            fileobj = io.BytesIO(b"content %d" % index)
+            if prefetch:
+                fileobj = prefetch(fileobj, len(fileobj.getvalue()))
+            yield (index, fileobj)
+
+    def testOrder(self):
+        """Objects keep their order and files their content"""
+        prefetcher = backup._FilePrefetcher(4, 10)
+        produced = []
+        result = [(index, fileobj.read()) for index, fileobj in
+                  prefetcher.iterate(self._get_objects(
+                      100, produced, prefetcher.prefetch))]
+        self.assertEqual(result,
+                         [(index, b"content %d" % index)
+                          for index in range(100)])
+
+    def testMaxLag(self):
+        """No object is held back behind more than max_lag newer ones"""
+        prefetcher = backup._FilePrefetcher(4, 3)
+        produced = []
+        for index, fileobj in prefetcher.iterate(
+                self._get_objects(50, produced)):
+            self.assertLessEqual(len(produced) - 1 - index, 3)
+
+    def testMaxQueued(self):
+        """No more than twice the workers objects are held back"""
+        prefetcher = backup._FilePrefetcher(2, 1000)
+        produced = []
+        for index, fileobj in prefetcher.iterate(
+                self._get_objects(50, produced)):
+            self.assertLessEqual(len(produced) - 1 - index, 4)
+
+    def testFlush(self):
+        """A flush marker releases all objects before it"""
+        prefetcher = backup._FilePrefetcher(2, 1000)
+        objects = [1, 2, iterfile.MiscIterFlush, 3]
+        obj_iter = prefetcher.iterate(iter(objects))
+        self.assertEqual([next(obj_iter) for _ in range(3)], objects[:3])
+        self.assertEqual(list(obj_iter), [3])
+
+    def testMaxBytes(self):
+        """Files are only prefetched as long as they fit in max_bytes"""
+        prefetcher = backup._FilePrefetcher(2, 10, max_bytes=10)
+        try:
+            first = prefetcher.prefetch(io.BytesIO(b"123456"), 6)
+            self.assertIsInstance(first, backup._PrefetchedFile)
+            second = io.BytesIO(b"abcdef")
+            self.assertIs(prefetcher.prefetch(second, 6), second)
+            self.assertEqual(first.read(), b"123456")
+            self.assertEqual(first.read(), b"")  # releases the bytes
+            self.assertEqual(prefetcher.buffered_bytes, 0)
+            third = prefetcher.prefetch(io.BytesIO(b"ABCDEF"), 6)
+            self.assertIsInstance(third, backup._PrefetchedFile)
+            third.close()
+            self.assertEqual(prefetcher.buffered_bytes, 0)
+        finally:
+            prefetcher.pool.shutdown()
+
+    def testError(self):
+        """Errors of the worker are raised when the file is read"""
+
+        class BrokenFile(io.BytesIO):
+            def read(self, length=-1):
+                raise OSError("broken file")
+
+        prefetcher = backup._FilePrefetcher(2, 10, max_bytes=10)
+        try:
+            broken = BrokenFile()
+            prefetched = prefetcher.prefetch(broken, 5)
+            self.assertRaises(OSError, prefetched.read)
+            self.assertTrue(broken.closed)
+            self.assertEqual(prefetcher.buffered_bytes, 0)
+        finally:
+            prefetcher.pool.shutdown()
+
 
 if __name__ == "__main__":
     unittest.main()
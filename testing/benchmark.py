@@ -21,6 +21,16 @@ MANY_COUNT = 2000
 NESTED_DEPTH = 4
 NESTED_FACTOR = 7
 
+# Simulated links of the "link" benchmark as (name, latency in seconds,
+# bandwidth in bytes per second, jitter in seconds, window in bytes),
+# see slowlink.py
+LINK_PROFILES = (
+    ("pipe", 0, 0, 0, 0),
+    ("lan", 0.0005, 100000000, 0.0001, 1048576),
+    ("wan", 0.025, 10000000, 0.005, 262144),
+    ("slow", 0.1, 1000000, 0.02, 65536),
+)
+
 
 def run_cmd(cmd):
     """Run the given cmd, return the amount of time it took"""
@@ -151,6 +161,26 @@ def print_results(bench, results):
         print("")
 
 
+def link_benchmarks(profiles=LINK_PROFILES):
+    """Return remote backup/restore benchmarks over each simulated link"""
+    slowlink = os.fsencode(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "slowlink.py"))
+    benches = []
+    for name, latency, bandwidth, jitter, window in profiles:
+        schema = (b"%b %b --latency %f --bandwidth %d --jitter %f "
+                  b"--window %d {h}" % (os.fsencode(sys.executable), slowlink,
+                                        latency, bandwidth, jitter, window))
+        benches.append({
+            'name': 'link_%s' % name,
+            'func': many,
+            'backup': b"rdiff-backup --remote-schema '%b' "
+                      b"'%%b' 'rdiff-backup --server::%%b'" % schema,
+            'restore': b"rdiff-backup --remote-schema '%b' --force -r now "
+                       b"'rdiff-backup --server::%%b' '%%b'" % schema,
+        })
+    return benches
+
+
 # MAIN SECTION
 
 benchmarks = {
@@ -194,10 +224,11 @@ benchmarks = {
             'restore': b"rdiff-backup --no-fsync --force -r now '%b' '%b'",
         },
     ],
+    'link': link_benchmarks(),
 }
 
 if len(sys.argv) != 2:
-    print("Syntax:  benchmark.py many|nested")
+    print("Syntax:  benchmark.py many|nested|link")
     sys.exit(1)
 
 if 'BENCHMARKPYPATH' in os.environ:
@@ -1,12 +1,18 @@
 import unittest
 import tempfile
+import io
 import os
+import signal
+import socket
 import sys
 import subprocess
+import threading
+import time
 from commontest import old_test_dir, abs_test_dir
 from rdiff_backup.connection import LowLevelPipeConnection, PipeConnection, \
-    VirtualFile, SetConnections
-from rdiff_backup import Globals, rpath, FilenameMapping  # , log
+    VirtualFile, SetConnections, DataChannel
+from rdiff_backup import Globals, rpath, FilenameMapping, iterfile, \
+    daemon  # , log
 
 SourceDir = 'rdiff_backup'
 regfilename = os.path.join(old_test_dir, b"various_file_types",
@@ -81,6 +87,21 @@ class LowLevelPipeConnectionTest(unittest.TestCase):
             self.assertEqual((234, inbuf), LLPC._get())
         os.unlink(self.filename)
 
+    def testParts(self):
+        """Frames given as parts should be written whole and in order"""
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, "rb") as inpipe, \
+                os.fdopen(write_fd, "wb") as outpipe:
+            LLPC = LowLevelPipeConnection(inpipe, outpipe)
+            # more parts than a single gathering write takes, and more
+            # bytes than the pipe holds, so that writes are partial
+            parts = [bytes((i % 256, )) * i for i in range(2000)]
+            writer = threading.Thread(target=LLPC._write,
+                                      args=("b", parts, 7))
+            writer.start()
+            self.assertEqual(LLPC._get(), (7, b"".join(parts)))
+            writer.join()
+
     def testSendingExceptions(self):
         """Exceptions should also be sent down pipe well"""
         with open(self.filename, "wb") as outpipe:
@@ -94,6 +115,65 @@ class LowLevelPipeConnectionTest(unittest.TestCase):
                 self.assertIsInstance(incoming_exception[1], exception.__class__)
         os.unlink(self.filename)
 
+    def testCompression(self):
+        """Compressible frames should be compressed, others not"""
+        compressible = b"compressible " * 10000
+        incompressible = os.urandom(100000)
+        bufs = [compressible, incompressible, b"short", compressible[:-1]]
+        for method in ("zlib", "lzma"):
+            with open(self.filename, "wb") as outpipe:
+                LLPC = LowLevelPipeConnection(None, outpipe)
+                LLPC.compression = (method, 6)
+                for buf in bufs:
+                    LLPC._putbuf(buf, 5)
+            self.assertEqual(LLPC.compression_stats[0],
+                             4 * 9 + sum(map(len, bufs)))
+            self.assertLess(LLPC.compression_stats[1],
+                            len(incompressible) + 1000)
+            with open(self.filename, "rb") as inpipe:
+                frame_types = []
+                while True:
+                    header = inpipe.read(9)
+                    if not header:
+                        break
+                    frame_types.append(header[0:1])
+                    inpipe.seek(int.from_bytes(header[2:], "big"), 1)
+                self.assertEqual(frame_types, [b"z", b"b", b"b", b"z"])
+                inpipe.seek(0)
+                LLPC = LowLevelPipeConnection(inpipe, None)
+                for buf in bufs:
+                    self.assertEqual(LLPC._get(), (5, buf))
+            self.assertEqual(LLPC.compression_stats[0],
+                             4 * 9 + sum(map(len, bufs)))
+        os.unlink(self.filename)
+
+    def testDataChannels(self):
+        """Big chunks of files should be striped over the data channels"""
+        socket_pairs = [socket.socketpair() for i in range(3)]
+        senders = [DataChannel(a.makefile("rb"), a.makefile("wb"), sock=a)
+                   for a, b in socket_pairs]
+        receivers = [DataChannel(b.makefile("rb"), b.makefile("wb"), sock=b)
+                     for a, b in socket_pairs]
+        contents = [os.urandom(300000), b"small", os.urandom(500000)]
+        rorps = []
+        for i, content in enumerate(contents):
+            rorp = rpath.RORPath((b"file%d" % i, ), {'type': 'reg'})
+            rorp.setfile(io.BytesIO(content))
+            rorps.append(rorp)
+        filelike = iterfile.MiscIterToFile(iter(rorps), channels=senders)
+        bufs = []
+        while not filelike.finished:
+            bufs.append(filelike.read())
+            self.assertLess(len(bufs[-1]), 10000)
+        self.assertIn(b"x", b"".join(bufs))
+
+        i_out = iterfile.FileToMiscIter(io.BytesIO(b"".join(bufs)), receivers)
+        for rorp, content in zip(i_out, contents):
+            self.assertEqual(rorp.open("rb").read(), content)
+        self.assertRaises(StopIteration, next, i_out)
+        for channel in senders + receivers:
+            channel.close()
+
 
 class PipeConnectionTest(unittest.TestCase):
     """Test Pipe connection"""
@@ -174,6 +254,78 @@ class PipeConnectionTest(unittest.TestCase):
         qrp_class_str = self.conn.reval("lambda qrp: str(qrp.__class__)", qrp)
         self.assertGreater(qrp_class_str.find("QuotedRPath"), -1)
 
+    def testStreams(self):
+        """Test pushing iterators as streams"""
+        def failing_iter():
+            yield 1
+            yield iterfile.MiscIterFlush  # pause until read again
+            raise ValueError("failing iterator")
+
+        api_version = Globals.api_version["actual"]
+        Globals.api_version["actual"] = 201
+        self.conn.Globals.set_api_version(201)
+        try:
+            items = [b"x" * 100000] * 100 + list(range(1000))
+            stream = iterfile.MiscIterStream(iter(items))
+            self.assertEqual(self.conn.reval("lambda i: list(i)", stream),
+                             items)
+            self.assertRaises(ValueError, self.conn.reval, "lambda i: list(i)",
+                              iterfile.MiscIterStream(failing_iter()))
+            self.assertEqual(self.conn.pow(2, 3), 8)
+        finally:
+            Globals.api_version["actual"] = api_version
+        self.assertFalse(self.conn.out_streams)
+
+    def testAsyncRequests(self):
+        """Test asynchronous and batched requests"""
+        api_version = Globals.api_version["actual"]
+        Globals.api_version["actual"] = 201
+        self.conn.Globals.set_api_version(201)
+        try:
+            with self.conn.batch():
+                self.conn.reval_async("Globals.set", "tmp_async", 1)
+                self.conn.reval_async("Globals.set", "tmp_async2", 2)
+                self.assertTrue(self.conn.out_buffer)  # not sent yet
+            self.assertIsNone(self.conn.out_buffer)
+            self.assertEqual(self.conn.Globals.get("tmp_async"), 1)
+            self.assertEqual(self.conn.Globals.get("tmp_async2"), 2)
+
+            # an error is raised by the next synchronous request, and
+            # the asynchronous requests meanwhile are skipped
+            self.conn.reval_async("os.lstat", "asoeut haosetnuhaoseu tn")
+            self.conn.reval_async("Globals.set", "tmp_async", 3)
+            self.assertRaises(os.error, self.conn.Globals.get, "tmp_async")
+            self.assertEqual(self.conn.Globals.get("tmp_async"), 1)
+        finally:
+            Globals.api_version["actual"] = api_version
+
+    def testStatistics(self):
+        """Test the statistics of requests and frames"""
+        self.assertEqual(self.conn.pow(2, 3), 8)
+        self.assertEqual(self.conn.pow(2, 4), 16)
+        stats = self.conn.get_statistics()
+        self.assertEqual(stats["requests"]["pow"]["calls"], 2)
+        self.assertGreater(stats["requests"]["pow"]["sent_bytes"], 0)
+        self.assertGreater(stats["requests"]["pow"]["received_bytes"], 0)
+        self.assertGreaterEqual(stats["requests"]["pow"]["seconds"],
+                                stats["requests"]["pow"]["max_seconds"])
+        self.assertGreaterEqual(stats["frames"]["o"]["sent_frames"], 6)
+        self.assertEqual(
+            sum(frame["sent_bytes"] for frame in stats["frames"].values()),
+            self.conn.bytes_sent)
+
+        remote_stats = self.conn.SetConnections.get_connection_statistics()[0]
+        self.assertEqual(remote_stats["answers"]["pow"]["calls"], 2)
+
+    def testMeasure(self):
+        """Test measuring the round trip time and bandwidth"""
+        self.assertEqual(
+            len(self.conn.SetConnections.probe_connection(b"abc", 10)), 10)
+        round_trip_time, bandwidth = \
+            SetConnections._measure_connection(self.conn)
+        self.assertGreater(round_trip_time, 0)
+        self.assertGreater(bandwidth, 0)
+
     def testExceptions(self):
         """Test exceptional results"""
         self.assertRaises(os.error, self.conn.os.lstat,
@@ -235,5 +387,81 @@ class RedirectedConnectionTest(unittest.TestCase):
         SetConnections.CloseConnections()
 
 
+class DaemonTest(unittest.TestCase):
+    """Test sessions served by a server daemon"""
+
+    timeout = 10  # seconds to wait for the daemon
+
+    def setUp(self):
+        """Start a daemon listening on a socket in a temporary directory"""
+        self.tempdir = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.tempdir, "daemon.sock")
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                Globals.security_level = "override"
+                daemon.serve(os.fsencode(self.sock_path))
+            finally:
+                os._exit(0)
+        deadline = time.monotonic() + self.timeout
+        while not os.path.exists(self.sock_path):
+            if time.monotonic() > deadline:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+                self.fail("Daemon didn't create its socket in time")
+            time.sleep(0.1)
+
+    def _connect(self):
+        return SetConnections._init_connection("unix:" + self.sock_path)
+
+    def _get_cached_fsa(self):
+        """Return abilities of a new session once they come from the cache
+
+        The previous session reports its end, and hence its abilities, to
+        the daemon asynchronously, so new sessions are tried until one
+        doesn't need to detect the abilities anew.
+
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = self._connect()
+            fsa = conn.fs_abilities.get_readonly_fsa(
+                "cached", rpath.RPath(conn, self.tempdir))
+            if not conn.fs_abilities.get_cache_updates():
+                return fsa
+            SetConnections.CloseConnections()
+            if time.monotonic() > deadline:
+                self.fail("Abilities weren't cached in time")
+            time.sleep(0.1)
+
+    def testIsolation(self):
+        """Test that concurrent sessions don't share their globals"""
+        conna = self._connect()
+        connb = self._connect()
+        conna.Globals.set("tmp_val", 1)
+        connb.Globals.set("tmp_val", 2)
+        self.assertEqual(conna.Globals.get("tmp_val"), 1)
+        self.assertEqual(connb.Globals.get("tmp_val"), 2)
+        self.assertNotEqual(conna.os.getpid(), connb.os.getpid())
+
+    def testAbilitiesCache(self):
+        """Test that abilities detected by a session are re-used later"""
+        conn = self._connect()
+        fsa = conn.fs_abilities.get_readonly_fsa(
+            "cached", rpath.RPath(conn, self.tempdir))
+        self.assertTrue(conn.fs_abilities.get_cache_updates())
+        SetConnections.CloseConnections()
+        cached_fsa = self._get_cached_fsa()
+        self.assertEqual(cached_fsa.case_sensitive, fsa.case_sensitive)
+        self.assertEqual(cached_fsa.eas, fsa.eas)
+
+    def tearDown(self):
+        SetConnections.CloseConnections()
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.assertFalse(os.path.exists(self.sock_path))
+        os.rmdir(self.tempdir)
+
+
 if __name__ == "__main__":
     unittest.main()
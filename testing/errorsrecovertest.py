@@ -41,9 +41,11 @@ class BrokenRepoTest(unittest.TestCase):
         files_list = sorted(filter(
             lambda x: x.startswith(b"mirror_metadata."),
             rb_data_rp.listdir()))
-        meta_snapshot_rp = rb_data_rp.append(files_list[8])
+        snapshot_name = [x for x in files_list
+                         if x.endswith(b".snapshot.gz")][0]
+        meta_snapshot_rp = rb_data_rp.append(snapshot_name)
         # create a diff with the same data as the identified snapshot
-        meta_dupldiff_rp = rb_data_rp.append(files_list[8].replace(
+        meta_dupldiff_rp = rb_data_rp.append(snapshot_name.replace(
             b".snapshot.gz", b".diff.gz"))
         rpath.copy(meta_snapshot_rp, meta_dupldiff_rp)
 
@@ -141,6 +141,59 @@ class testMiscIters(unittest.TestCase):
 
         self.assertRaises(StopIteration, i_out.__next__)
 
+    def testReadLength(self):
+        """Reading with a length must return the data in order"""
+        regfile3_copy = self.outputrp.append("reg3")
+        regfile3_copy.setfile(regfile3_copy.open("rb"))
+        whole = MiscIterToFile(iter([5, self.regfile3, "hello"])).read()
+        filelike = MiscIterToFile(iter([5, regfile3_copy, "hello"]))
+        chunks = []
+        while sum(map(len, chunks)) < len(whole):
+            chunks.append(filelike.read(3))
+            self.assertEqual(len(chunks[-1]), 3)
+        self.assertEqual(b"".join(chunks)[:len(whole)], whole)
+
+    def testBatch(self):
+        """Test packing the snapshots of small files together"""
+        for rp in (self.regfile1, self.regfile2, self.regfile3):
+            rp.set_attached_filetype('snapshot')
+        rplist = [self.regfile1, self.regfile2, 5, self.regfile3]
+        api_version = Globals.api_version["actual"]
+        Globals.set("small_file_size", 6)
+        try:
+            # batches aren't understood before API version 201
+            rorp = self.regfile1.getRORPath()
+            rorp.setfile(io.BytesIO(b"hello"))
+            self.assertNotEqual(MiscIterToFile(iter([rorp])).read()[:1], b"b")
+            Globals.api_version["actual"] = 201
+            s = MiscIterToFile(iter(rplist)).read()
+        finally:
+            Globals.set("small_file_size", 0)
+            Globals.api_version["actual"] = api_version
+        self.assertEqual(s[0:1], b"b")
+        # the contents follow the pickled batch instead of being in it
+        record = s[8:8 + int.from_bytes(s[1:8], "big")]
+        pickle_len = int.from_bytes(record[:7], "big")
+        self.assertEqual(record[7 + pickle_len:], b"hello")
+        self.assertIn(b"f" + (7).to_bytes(7, "big") + b"goodbye", s)
+        i_out = FileToMiscIter(io.BytesIO(s))
+
+        out1 = next(i_out)
+        self.assertEqual(out1, self.regfile1)
+        fp = out1.open("rb")
+        self.assertEqual(fp.read(), b"hello")
+        self.assertFalse(fp.close())
+
+        out2 = next(i_out)
+        self.assertEqual(out2, self.regfile2)
+        self.assertEqual(out2.open("rb").read(), b"")
+        self.assertEqual(next(i_out), 5)
+
+        out3 = next(i_out)
+        self.assertEqual(out3, self.regfile3)
+        self.assertEqual(out3.open("rb").read(), b"goodbye")
+        self.assertRaises(StopIteration, i_out.__next__)
+
     def testFlush(self):
         """Test flushing property of MiscIterToFile"""
         rplist = [self.outputrp, MiscIterFlush, self.outputrp]
@@ -0,0 +1,242 @@
+import sys
+import os
+import io
+import tempfile
+import time
+import concurrent.futures
+from rdiff_backup import Globals, iterfile, librsync, rpath
+"""librsync_benchmark.py
+
+Measure the throughput of the librsync wrapper classes, independently
+of the rest of rdiff-backup.  Data is generated and kept in memory so
+that disk speed doesn't influence the results.  We just use clock time,
+so this isn't exact at all.
+
+"""
+
+# Size in bytes of the data processed by each job
+DATA_SIZE = 64 * 1024 * 1024
+
+# Block size used for signatures, as Rdiff would for files of DATA_SIZE
+SIG_BLOCKSIZE = 8192
+
+
+def make_data(size):
+    """Return size pseudo-random bytes, cheaper than os.urandom"""
+    block = os.urandom(1024 * 1024)
+    data = block * (size // len(block)) + block[:size % len(block)]
+    return data
+
+
+def modify_data(data):
+    """Return a copy of data with some changes, to get non-trivial deltas"""
+    changed = bytearray(data)
+    for pos in range(0, len(changed), len(changed) // 16):
+        changed[pos:pos + 100] = os.urandom(100)
+    return bytes(changed)
+
+
+def sig_job(data):
+    """Compute the signature of data, return its length"""
+    sig_fp = librsync.SigFile(io.BytesIO(data), SIG_BLOCKSIZE)
+    sig = sig_fp.read()
+    sig_fp.close()
+    return len(sig)
+
+
+def delta_job(sig, data):
+    """Compute the delta of data against sig, return its length"""
+    delta_fp = librsync.DeltaFile(sig, io.BytesIO(data))
+    delta = delta_fp.read()
+    delta_fp.close()
+    return len(delta)
+
+
+def run_threaded(func, args, threads):
+    """Run threads times func(*args) in parallel, return the time it took"""
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        t = time.time()
+        futures = [pool.submit(func, *args) for i in range(threads)]
+        for future in futures:
+            future.result()
+        return time.time() - t
+
+
+def threads(max_threads=None):
+    """Measure how SigFile and DeltaFile scale with the number of threads
+
+    Each thread processes its own DATA_SIZE bytes, so that with perfect
+    scaling the aggregated throughput grows linearly with the threads.
+
+    """
+    if not max_threads:
+        max_threads = os.cpu_count() or 1
+    basis = make_data(DATA_SIZE)
+    new = modify_data(basis)
+    sig = librsync.SigFile(io.BytesIO(basis), SIG_BLOCKSIZE).read()
+
+    thread_counts = []
+    count = 1
+    while count < max_threads:
+        thread_counts.append(count)
+        count *= 2
+    thread_counts.append(max_threads)
+
+    results = []
+    for count in thread_counts:
+        sig_time = run_threaded(sig_job, (basis, ), count)
+        delta_time = run_threaded(delta_job, (sig, new), count)
+        results.append((count,
+                        count * DATA_SIZE / sig_time / 1024 / 1024,
+                        count * DATA_SIZE / delta_time / 1024 / 1024))
+        print("{cnt} thread(s): signature {sig:.1f} MB/s, "
+              "delta {delta:.1f} MB/s".format(
+                  cnt=count, sig=results[-1][1], delta=results[-1][2]))
+    return results
+
+
+def time_stage(func, *args):
+    """Return the throughput in MB/s of func(*args) over DATA_SIZE bytes"""
+    t = time.time()
+    func(*args)
+    return DATA_SIZE / (time.time() - t) / 1024 / 1024
+
+
+def read_all(fileobj, length=Globals.blocksize):
+    """Read fileobj in chunks of length until the end, like rdiff-backup"""
+    while fileobj.read(length):
+        pass
+    fileobj.close()
+
+
+def readinto_all(fileobj, length=Globals.blocksize):
+    """Read fileobj into a single reused buffer until the end"""
+    buf = bytearray(length)
+    while fileobj.readinto(buf):
+        pass
+    fileobj.close()
+
+
+def iterfile_roundtrip(data):
+    """Send data through MiscIterToFile and FileToMiscIter"""
+    rorp = rpath.RORPath(("file", ))
+    rorp.setfile(io.BytesIO(data))
+    for rorp in iterfile.FileToMiscIter(iterfile.MiscIterToFile(iter([rorp]))):
+        read_all(rorp.open("rb"))
+
+
+def stages():
+    """Measure the throughput of each stage a file passes through
+
+    Single-threaded, so that the copying and buffer management overhead
+    of each stage becomes visible next to the librsync work itself.
+
+    """
+    basis = make_data(DATA_SIZE)
+    new = modify_data(basis)
+    sig = librsync.SigFile(io.BytesIO(basis), SIG_BLOCKSIZE).read()
+    delta = librsync.DeltaFile(sig, io.BytesIO(new)).read()
+    basis_fp = tempfile.TemporaryFile()  # patching needs a real basis file
+    basis_fp.write(basis)
+    basis_fp.seek(0)
+    results = [
+        ("read", time_stage(read_all, io.BytesIO(basis))),
+        ("readinto", time_stage(readinto_all, io.BytesIO(basis))),
+        ("signature",
+         time_stage(read_all, librsync.SigFile(io.BytesIO(basis),
+                                               SIG_BLOCKSIZE))),
+        ("delta",
+         time_stage(read_all, librsync.DeltaFile(sig, io.BytesIO(new)))),
+        ("patch",
+         time_stage(read_all, librsync.PatchedFile(basis_fp,
+                                                   io.BytesIO(delta)))),
+        ("iterfile", time_stage(iterfile_roundtrip, basis)),
+    ]
+    for name, speed in results:
+        print("{name}: {speed:.1f} MB/s".format(name=name, speed=speed))
+    return results
+
+
+def formats():
+    """Measure signature and delta throughput of each signature format
+
+    Each format is measured with the historic strong sum length of 8
+    bytes and with the maximum length of the format.  Formats which
+    the librsync library doesn't support are skipped.
+
+    """
+    basis = make_data(DATA_SIZE)
+    new = modify_data(basis)
+    results = []
+    for name, (magic, max_strong_len) in librsync.SIG_FORMATS.items():
+        for strong_len in sorted({librsync.DEFAULT_STRONG_LEN,
+                                  max_strong_len}):
+            sig_format = librsync.get_sig_format(name, strong_len)
+            try:
+                sig = librsync.SigFile(io.BytesIO(basis), SIG_BLOCKSIZE,
+                                       sig_format).read()
+            except librsync.librsyncError as exc:
+                print("{name}/{len}: not supported ({exc})".format(
+                    name=name, len=strong_len, exc=exc))
+                continue
+            sig_speed = time_stage(
+                read_all, librsync.SigFile(io.BytesIO(basis), SIG_BLOCKSIZE,
+                                           sig_format))
+            delta_speed = time_stage(
+                read_all, librsync.DeltaFile(sig, io.BytesIO(new)))
+            results.append((name, strong_len, len(sig),
+                            sig_speed, delta_speed))
+            print("{name}/{len}: signature {sig:.1f} MB/s, "
+                  "delta {delta:.1f} MB/s".format(
+                      name=name, len=strong_len, sig=sig_speed,
+                      delta=delta_speed))
+    return results
+
+
+def print_threads_results(results):
+    """Print a table with the absolute and relative results"""
+    print("threads;sig_MBps;delta_MBps;sig_speedup;delta_speedup;")
+    for count, sig_speed, delta_speed in results:
+        print("{cnt};{sig:.1f};{delta:.1f};{rsig:.2f};{rdelta:.2f};".format(
+            cnt=count, sig=sig_speed, delta=delta_speed,
+            rsig=sig_speed / results[0][1], rdelta=delta_speed / results[0][2]))
+
+
+def print_formats_results(results):
+    """Print a table with the results of each signature format"""
+    print("format;strong_len;sig_bytes;sig_MBps;delta_MBps;")
+    for name, strong_len, sig_len, sig_speed, delta_speed in results:
+        print("{name};{len};{sig_len};{sig:.1f};{delta:.1f};".format(
+            name=name, len=strong_len, sig_len=sig_len, sig=sig_speed,
+            delta=delta_speed))
+
+
+def print_stages_results(results):
+    """Print a table with the throughput of each stage"""
+    print("stage;MBps;")
+    for name, speed in results:
+        print("{name};{speed:.1f};".format(name=name, speed=speed))
+
+
+# MAIN SECTION
+
+benchmarks = {
+    'threads': (threads, print_threads_results),
+    'stages': (stages, print_stages_results),
+    'formats': (formats, print_formats_results),
+}
+
+if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+    print("Syntax:  librsync_benchmark.py threads [MAX_THREADS]")
+    print("         librsync_benchmark.py stages")
+    print("         librsync_benchmark.py formats")
+    sys.exit(1)
+
+benchmark_name = sys.argv[1]
+benchmark_args = list(map(int, sys.argv[2:]))
+print("=== Running '{bench}' benchmark ===".format(bench=benchmark_name))
+benchmark_func, print_results = benchmarks[benchmark_name]
+benchmark_results = benchmark_func(*benchmark_args)
+print("=== Results of '{bench}' benchmark (absolute and relative) ===".format(
+    bench=benchmark_name))
+print_results(benchmark_results)
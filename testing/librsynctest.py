@@ -2,6 +2,8 @@ import unittest
 import random
 import subprocess
 import os
+import io
+import concurrent.futures
 from commontest import abs_test_dir
 from rdiff_backup import Globals, librsync, rpath
 
@@ -166,6 +168,125 @@ class LibrsyncTest(unittest.TestCase):
 
             self.assertEqual(real_new, librsync_new)
 
+    def testThreads(self):
+        """Test that parallel signatures, deltas and patches stay correct"""
+
+        def sig_delta_patch(basis, new):
+            """Return the signature, the delta and the patched file"""
+            sig = librsync.SigFile(io.BytesIO(basis), 1024).read()
+            delta = librsync.DeltaFile(sig, io.BytesIO(new)).read()
+            with self.basis.open("rb") as basis_fp:
+                patched = librsync.PatchedFile(basis_fp,
+                                               io.BytesIO(delta)).read()
+            return sig, delta, patched
+
+        MakeRandomFile(self.basis.path, 500000)
+        with self.basis.open("rb") as fp:
+            basis = fp.read()
+        news = [basis[:i * 10000] + os.urandom(5000) + basis[i * 20000:]
+                for i in range(8)]
+        serial_results = [sig_delta_patch(basis, new) for new in news]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            parallel_results = list(pool.map(sig_delta_patch,
+                                             [basis] * len(news), news))
+        self.assertEqual(serial_results, parallel_results)
+        for new, result in zip(news, parallel_results):
+            self.assertEqual(result[2], new)
+
+    def testSignatureLoading(self):
+        """Test deltas from signatures loaded in chunks, and their memory"""
+        MakeRandomFile(self.basis.path, 500000)
+        with self.basis.open("rb") as fp:
+            basis = fp.read()
+        new = basis[:200000] + os.urandom(5000) + basis[300000:]
+        sig = librsync.SigFile(io.BytesIO(basis), 64).read()
+        self.assertGreater(len(sig), librsync.blocksize)
+
+        memory = librsync.get_signature_memory()[0]
+        delta_fp = librsync.DeltaFile(io.BytesIO(sig), io.BytesIO(new))
+        self.assertEqual(librsync.get_signature_memory()[0],
+                         memory + len(sig))
+        self.assertGreaterEqual(librsync.get_signature_memory()[1],
+                                memory + len(sig))
+        delta = delta_fp.read()
+        delta_fp.close()
+        delta_fp.close()
+        self.assertEqual(librsync.get_signature_memory()[0], memory)
+        delta_fp = librsync.DeltaFile(sig, io.BytesIO(new))
+        self.assertEqual(delta, delta_fp.read())
+        delta_fp.close()
+
+        self.assertRaises(librsync.librsyncError, librsync.DeltaFile,
+                          io.BytesIO(b"no signature"), io.BytesIO(new))
+        self.assertEqual(librsync.get_signature_memory()[0], memory)
+
+    def testSigFormat(self):
+        """Test the choice of signature format and strong sum length"""
+        md4_magic = librsync.SIG_FORMATS["md4"][0]
+        self.assertEqual(librsync.get_sig_format(), (md4_magic, 8))
+        self.assertEqual(librsync.get_sig_format("md4", 0), (md4_magic, 16))
+        self.assertEqual(librsync.get_sig_format("blake2", 64),
+                         (librsync.SIG_FORMATS["blake2"][0], 32))
+        self.assertEqual(librsync.get_sig_format("rk-md4", 12),
+                         (librsync.SIG_FORMATS["rk-md4"][0], 12))
+
+        MakeRandomFile(self.basis.path, 100000)
+        with self.basis.open("rb") as fp:
+            basis = fp.read()
+        sig_format = librsync.get_sig_format("blake2", 16)
+        sig = librsync.SigFile(io.BytesIO(basis), 1024, sig_format).read()
+        sig_gen = librsync.SigGenerator(1024, sig_format=sig_format)
+        sig_gen.update(basis)
+        self.assertEqual(sig_gen.get_sig(), sig)
+        self.assertEqual(librsync.DeltaFile(sig, io.BytesIO(basis)).read(),
+                         librsync.DeltaFile(
+                             librsync.SigFile(io.BytesIO(basis), 1024).read(),
+                             io.BytesIO(basis)).read())
+
+    def testWholeFile(self):
+        """Test the whole file jobs against the file-like objects"""
+        MakeRandomFile(self.basis.path, 300000)
+        with self.basis.open("rb") as fp:
+            basis = fp.read()
+        new = basis[:100000] + os.urandom(5000) + basis[150000:]
+        with self.new.open("wb") as fp:
+            fp.write(new)
+        for rp in (self.sig, self.delta, self.new2):
+            self._clean_file(rp)
+
+        with self.basis.open("rb") as basis_fp, \
+                self.sig.open("wb") as sig_fp:
+            sig_fp.write(b"prefix")
+            librsync.write_signature(basis_fp, sig_fp, 1024)
+            self.assertEqual(sig_fp.tell(),
+                             os.fstat(sig_fp.fileno()).st_size)
+        with self.sig.open("rb") as sig_fp:
+            self.assertEqual(sig_fp.read(6), b"prefix")
+            sig = sig_fp.read()
+        self.assertEqual(sig, librsync.SigFile(io.BytesIO(basis), 1024).read())
+
+        with self.sig.open("rb") as sig_fp, self.new.open("rb") as new_fp, \
+                self.delta.open("wb") as delta_fp:
+            sig_fp.read(6)
+            librsync.write_delta(sig_fp, new_fp, delta_fp)
+        with self.delta.open("rb") as delta_fp:
+            delta = delta_fp.read()
+        self.assertEqual(delta,
+                         librsync.DeltaFile(sig, io.BytesIO(new)).read())
+
+        with self.basis.open("rb") as basis_fp, \
+                self.delta.open("rb") as delta_fp, \
+                self.new2.open("wb") as new2_fp:
+            librsync.write_patched(basis_fp, delta_fp, new2_fp)
+        with self.new2.open("rb") as new2_fp:
+            self.assertEqual(new2_fp.read(), new)
+
+        with self.basis.open("rb") as basis_fp, \
+                io.BytesIO(b"no delta") as delta_fp, \
+                self.new2.open("wb") as new2_fp:
+            self.assertRaises(io.UnsupportedOperation, librsync.write_patched,
+                              basis_fp, delta_fp, new2_fp)
+
 
 if __name__ == "__main__":
     unittest.main()
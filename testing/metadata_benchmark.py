@@ -0,0 +1,91 @@
+"""metadata_benchmark.py
+
+Write the same metadata records in the text and the binary format of
+the mirror_metadata files, then time the parsing of both, e.g.:
+
+    python testing/metadata_benchmark.py 1000000
+
+The number of records defaults to 10 million, which takes a while, and
+a few hundred megabytes of disk space in the test directory.
+"""
+
+import sys
+import time
+from commontest import re_init_subdir, abs_test_dir
+from rdiff_backup import rpath, Globals
+from rdiff_backup.metadata import MetadataFile, BinaryMetadataFile
+
+# How many records to write and parse by default
+RECORD_COUNT = 10000000
+
+# How many files per directory
+FILES_PER_DIR = 1000
+
+
+def iterate_rorps(count):
+    """Yield count rorps of files in directories, like a backup would"""
+    common = {'uid': 1000, 'gid': 1000, 'perms': 0o644,
+              'uname': 'user', 'gname': 'users'}
+    yield rpath.RORPath((), dict(common, type='dir', mtime=1600000000))
+    for i in range(count - 1):
+        dirname = b"directory_%06d" % (i // FILES_PER_DIR)
+        if i % FILES_PER_DIR == 0:
+            yield rpath.RORPath((dirname, ),
+                                dict(common, type='dir', mtime=1600000000))
+            continue
+        yield rpath.RORPath(
+            (dirname, b"file_with_a_longer_name_%09d.txt" % i),
+            dict(common, type='reg', mtime=1600000000 + i, size=i * 17,
+                 sha1="%040x" % i))
+
+
+def write(flatfileclass, rp, count):
+    """Write count records with the flatfileclass, return the final rp"""
+    start_time = time.time()
+    mf = flatfileclass(rp, 'w')
+    for rorp in iterate_rorps(count):
+        mf.write_object(rorp)
+    mf.close()
+    print("Writing %d records with %s took %.1f seconds, file size is "
+          "%d bytes" % (count, flatfileclass.__name__,
+                        time.time() - start_time, mf.rp.getsize()))
+    return mf.rp
+
+
+def parse(rp):
+    """Parse all records in the file rp, return the time it took"""
+    start_time = time.time()
+    count = 0
+    for rorp in MetadataFile(rp, 'r').get_objects():
+        count += 1
+    seconds = time.time() - start_time
+    print("Parsing %d records of %s took %.1f seconds, %.2f us per record" %
+          (count, rp.dirsplit()[1].decode(), seconds, seconds / count * 1e6))
+    return seconds
+
+
+def main(count=RECORD_COUNT):
+    out_dir = re_init_subdir(abs_test_dir, b'metadata_out')
+    out_rp = rpath.RPath(Globals.local_connection, out_dir)
+    text_rp = write(MetadataFile, out_rp.append(
+        "mirror_metadata.2020-09-13T12:26:40Z.snapshot"), count)
+    binary_rp = write(BinaryMetadataFile, out_rp.append(
+        "mirror_metadata.2020-09-13T12:26:41Z.snapshot"), count)
+    text_seconds = parse(text_rp)
+    binary_seconds = parse(binary_rp)
+    print("Parsing the binary format is %.1f times faster than the text "
+          "format, the file is %.1f times smaller" %
+          (text_seconds / binary_seconds,
+           text_rp.getsize() / binary_rp.getsize()))
+    text_rp.delete()
+    binary_rp.delete()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Syntax: metadata_benchmark.py [record_count]")
+        sys.exit(1)
+    elif len(sys.argv) == 2:
+        main(int(sys.argv[1]))
+    else:
+        main()
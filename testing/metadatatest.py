@@ -1,11 +1,12 @@
 import unittest
 import os
 import io
+import threading
 import time
 from commontest import old_test_dir, abs_output_dir, iter_equal, xcopytree
-from rdiff_backup import rpath, Globals, selection
+from rdiff_backup import rpath, Globals, selection, metadata, rorpiter, Time
 from rdiff_backup.metadata import MetadataFile, PatchDiffMan, \
-    quote_path, unquote_path, RorpExtractor
+    quote_path, unquote_path, RorpExtractor, BinaryMetadataFile, DiffWriter
 
 tempdir = rpath.RPath(Globals.local_connection, abs_output_dir)
 
@@ -127,6 +128,105 @@ class MetadataTest(unittest.TestCase):
               (i, time.time() - start_time))
         self.assertEqual(i, 51)
 
+    def testIterate_indexed(self):
+        """Test getting rorps restricted to an index through the index file"""
+        self.make_temp()
+        temprp = tempdir.append(
+            "mirror_metadata.2005-11-03T15:51:06-06:00.snapshot")
+        rootrp = rpath.RPath(Globals.local_connection,
+                             os.path.join(old_test_dir, b"bigdir"))
+        mf = MetadataFile(temprp, 'w')
+        mf._member_size = 16 * 1024
+        for rp in selection.Select(rootrp).set_iter():
+            mf.write_object(rp)
+        mf.close()
+        temprp = mf.rp
+        self.assertTrue(temprp.isincfile() and temprp.isinccompressed())
+        index_rp = tempdir.append(b"indexes",
+                                  temprp.dirsplit()[1] + b".index")
+        self.assertTrue(index_rp.isreg())
+
+        restrict_index = (b"subdir3", b"subdir10")
+        self.assertTrue(metadata._get_member_offset(temprp, restrict_index))
+        mf = MetadataFile(temprp, 'r')
+        indexed_rorps = list(mf.get_objects(restrict_index))
+        mf.close()
+        self.assertEqual(len(indexed_rorps), 51)
+
+        # a stale index file is ignored and the file fully scanned
+        with open(index_rp.path, "r+b") as index_fp:
+            index_fp.seek(16)
+            index_fp.write(b"\xff" * 8)
+        self.assertIsNone(metadata._get_member_offset(temprp, restrict_index))
+        mf = MetadataFile(temprp, 'r')
+        scanned_rorps = list(mf.get_objects(restrict_index))
+        mf.close()
+        self.assertEqual(scanned_rorps, indexed_rorps)
+
+        # the file is a valid gzip file without the index file
+        index_rp.delete()
+        mf = MetadataFile(temprp, 'r')
+        self.assertEqual(len(list(mf.get_objects())),
+                         len(list(selection.Select(rootrp).set_iter())))
+        mf.close()
+
+    def get_binary_rorps(self):
+        """Return list of rorps of all types and with all optional fields"""
+        common = {'uid': 1000, 'gid': 100, 'perms': 0o644,
+                  'uname': 'user', 'gname': 'users'}
+        rorps = [rpath.RORPath((), dict(common, type='dir', mtime=10))]
+        for i in range(300):
+            index = (b"dir%03d" % (i // 30), b"file\n%03d" % i)
+            data = dict(common, type='reg', mtime=i, size=i * 1000)
+            if i % 7 == 0:
+                data.update(nlink=2, inode=10000 + i, devloc=2049)
+            if i % 11 == 0:
+                data['sha1'] = "%040x" % i
+            if i % 13 == 0:
+                data['uname'] = None
+                data['gname'] = 'group%d' % i
+            if i % 17 == 0:
+                data['mirrorname'] = b"%d" % i
+            if index[1] == b"file\n000":
+                rorps.append(rpath.RORPath(index[:1],
+                                           dict(common, type='dir', mtime=i)))
+            rorps.append(rpath.RORPath(index, data))
+        rorps.append(rpath.RORPath((b"dir999", b"dev"),
+                                   dict(common, type='dev',
+                                        devnums=('c', 4, 64))))
+        rorps.append(rpath.RORPath((b"dir999", b"gone"), {'type': None}))
+        rorps.append(rpath.RORPath((b"dir999", b"link"),
+                                   dict(common, type='sym',
+                                        linkname=b"../dir000")))
+        return rorps
+
+    def testBinaryFormat(self):
+        """Test writing binary metadata, and reading it like text metadata"""
+        self.make_temp()
+        rorps = self.get_binary_rorps()
+        for flatfileclass, hour in ((MetadataFile, 16),
+                                    (BinaryMetadataFile, 17)):
+            temprp = tempdir.append(
+                "mirror_metadata.2005-11-03T%d:51:06-06:00.snapshot" % hour)
+            mf = flatfileclass(temprp, 'w')
+            mf._member_size = 1024
+            for rorp in rorps:
+                mf.write_object(rorp)
+            mf.close()
+
+            reread_rorps = list(MetadataFile(mf.rp, 'r').get_objects())
+            self.assertEqual(len(reread_rorps), len(rorps))
+            for rorp, reread_rorp in zip(rorps, reread_rorps):
+                self.assertEqual(reread_rorp.index, rorp.index)
+                self.assertEqual(reread_rorp.data, rorp.data)
+
+            restricted_rorps = list(MetadataFile(mf.rp, 'r').get_objects(
+                (b"dir007", )))
+            self.assertEqual(restricted_rorps,
+                             [rorp for rorp in rorps
+                              if rorp.index[:1] == (b"dir007", )])
+        self.assertTrue(metadata._get_member_offset(mf.rp, (b"dir007", )))
+
     def test_write(self):
         """Test writing to metadata file, then reading back contents"""
         global tempdir
@@ -246,6 +346,240 @@ class MetadataTest(unittest.TestCase):
         compare(man, inc3, 30000)
         compare(man, inc4, 40000)
 
+    def test_written_diffs(self):
+        """Write diffs of changed rorps along the snapshots, then read them"""
+
+        def compare(man, rorps, time):
+            meta_rorps = list(man.get_meta_at_time(time, None))
+            self.assertEqual([rorp.index for rorp in meta_rorps],
+                             [rorp.index for rorp in rorps])
+            for meta_rorp, rorp in zip(meta_rorps, rorps):
+                self.assertEqual(meta_rorp.data, rorp.data)
+
+        self.make_temp()
+        Globals.rbdir = tempdir
+        rorps = [[rorp for rorp in self.get_binary_rorps() if rorp.lstat()]]
+        for i in range(1, 5):  # change, delete and add a few files
+            new_rorps = []
+            for rorp in rorps[-1]:
+                if rorp.isreg() and rorp.getmtime() % 10 == i:
+                    continue
+                new_rorp = rorp.getRORPath()
+                if rorp.isreg() and rorp.getmtime() % 10 == i + 1:
+                    new_rorp.data['size'] += 1
+                new_rorps.append(new_rorp)
+            new_rorps.append(rpath.RORPath(
+                (b"dir999", b"new%d" % i),
+                dict(rorps[0][1].data, type='reg', mtime=i, size=i)))
+            rorps.append(new_rorps)
+
+        man = PatchDiffMan()
+        writer = man.GetWriter(time=10000)
+        for rorp in rorps[0]:
+            writer.write_object(rorp)
+        writer.close()
+
+        old_prevtime = getattr(Time, "prevtime", None)
+        Time.prevtime = 10000
+        Globals.set("metadata_diffs", 1)
+        try:
+            for i in range(1, 5):
+                man = PatchDiffMan()
+                man.max_diff_chain = 3
+                writer = man.GetWriter(time=10000 * (i + 1))
+                if i != 3:
+                    self.assertIsInstance(writer, DiffWriter)
+                else:  # the chain is long enough, a snapshot is kept
+                    self.assertNotIsInstance(writer, DiffWriter)
+                old_iter = man.get_meta_at_time(Time.prevtime, None)
+                for new_rorp, old_rorp in rorpiter.Collate2Iters(
+                        iter(rorps[i]), old_iter):
+                    if new_rorp and old_rorp and new_rorp.data == old_rorp.data:
+                        new_rorp = old_rorp  # unchanged, like in a backup
+                    if isinstance(writer, DiffWriter):
+                        writer.write_diff(new_rorp, old_rorp)
+                    elif new_rorp:
+                        writer.write_object(new_rorp)
+                writer.close()
+                man.ConvertMetaToDiff()
+                Time.prevtime = 10000 * (i + 1)
+        finally:
+            Time.prevtime = old_prevtime
+            Globals.set("metadata_diffs", None)
+
+        man = PatchDiffMan()
+        rplist = man.sorted_prefix_inclist(b'mirror_metadata')
+        self.assertEqual([rp.getinctype() for rp in rplist],
+                         [b'snapshot', b'diff', b'snapshot', b'diff', b'diff'])
+        self.assertLess(rplist[1].getsize(), rplist[0].getsize())
+        for i in range(5):
+            compare(man, rorps[i], 10000 * (i + 1))
+
+    def test_metadata_cache(self):
+        """Cache patched metadata and evict the least recently used"""
+
+        def compare(man, rorps, time):
+            meta_rorps = list(man.get_meta_at_time(time, None))
+            self.assertEqual([rorp.index for rorp in meta_rorps],
+                             [rorp.index for rorp in rorps])
+            for meta_rorp, rorp in zip(meta_rorps, rorps):
+                self.assertEqual(meta_rorp.data, rorp.data)
+
+        self.make_temp()
+        Globals.rbdir = tempdir
+        cache_dir = tempdir.append(b"metadata_cache")
+        rorps = [rorp for rorp in self.get_binary_rorps() if rorp.lstat()]
+        all_rorps = []
+        for i in range(3):
+            all_rorps.append(rorps[:len(rorps) - 10 * i])
+            man = PatchDiffMan()
+            writer = man._get_meta_writer(b'snapshot', 10000 * (i + 1))
+            for rorp in all_rorps[-1]:
+                writer.write_object(rorp)
+            writer.close()
+            man.ConvertMetaToDiff()
+
+        old_cache_size = Globals.metadata_cache_size
+        try:
+            man = PatchDiffMan()
+            compare(man, all_rorps[2], 30000)  # snapshot, never cached
+            self.assertFalse(cache_dir.lstat())
+            compare(man, all_rorps[0], 10000)
+            cache_rp = cache_dir.append(
+                b"mirror_metadata.%b.snapshot.gz" % Time.timetobytes(10000))
+            self.assertEqual(cache_dir.listdir(), [cache_rp.dirsplit()[1]])
+            compare(man, all_rorps[0], 10000)  # now read from the cache
+            self.assertEqual(
+                [rorp.index for rorp in man.get_meta_at_time(10000,
+                                                             (b"dir001", ))],
+                [rorp.index for rorp in all_rorps[0]
+                 if rorp.index[:1] == (b"dir001", )])
+
+            # given up iterations don't leave anything behind
+            meta_iter = man.get_meta_at_time(20000, None)
+            next(meta_iter)
+            meta_iter.close()
+            self.assertEqual(cache_dir.listdir(), [cache_rp.dirsplit()[1]])
+
+            cache_rp.setdata()
+            Globals.metadata_cache_size = cache_rp.getsize() + 1
+            os.utime(cache_rp.path, (1000, 1000))
+            compare(man, all_rorps[1], 20000)
+            self.assertEqual(len(cache_dir.listdir()), 1)
+            cache_rp.setdata()
+            self.assertFalse(cache_rp.lstat())
+        finally:
+            Globals.metadata_cache_size = old_cache_size
+
+    def test_metadata_cache_read_only(self):
+        """Read-only sessions don't write to the metadata cache"""
+        self.make_temp()
+        Globals.rbdir = tempdir
+        rorps = [rorp for rorp in self.get_binary_rorps() if rorp.lstat()]
+        for i in range(2):
+            man = PatchDiffMan()
+            writer = man._get_meta_writer(b'snapshot', 10000 * (i + 1))
+            for rorp in rorps:
+                writer.write_object(rorp)
+            writer.close()
+            man.ConvertMetaToDiff()
+
+        old_security_level = Globals.security_level
+        try:
+            Globals.security_level = "read-only"
+            self.assertEqual(
+                [rorp.index
+                 for rorp in PatchDiffMan().get_meta_at_time(10000, None)],
+                [rorp.index for rorp in rorps])
+            self.assertFalse(tempdir.append(b"metadata_cache").lstat())
+        finally:
+            Globals.security_level = old_security_level
+
+    def test_metadata_cache_error(self):
+        """Metadata which can't be cached is still read completely"""
+        self.make_temp()
+        Globals.rbdir = tempdir
+        rorps = [rorp for rorp in self.get_binary_rorps() if rorp.lstat()]
+        cache_rp = tempdir.append(b"metadata_cache").append(
+            b"mirror_metadata.%b.snapshot.gz" % Time.timetobytes(10000))
+        cache_rp.makedirs()
+        cache_rp.append(b"blocker").touch()  # the rename fails
+        meta_iter = PatchDiffMan()._iterate_caching_meta(iter(rorps),
+                                                         cache_rp)
+        self.assertEqual([rorp.index for rorp in meta_iter],
+                         [rorp.index for rorp in rorps])
+        self.assertEqual(cache_rp.get_parent_rp().listdir(),
+                         [cache_rp.dirsplit()[1]])
+        self.assertEqual(cache_rp.listdir(), [b"blocker"])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Requires processes to fork")
+    def test_read_in_process(self):
+        """Read metadata in a child process, with errors and giving up"""
+        self.make_temp()
+        rorps = [rorp for rorp in self.get_binary_rorps() if rorp.lstat()]
+        rp = tempdir.append("mirror_metadata.2005-12-03T14:54:06Z.snapshot")
+        writer = MetadataFile(rp, 'w', callback=lambda x: None)
+        for rorp in rorps:
+            writer.write_object(rorp)
+        writer.close()
+
+        def get_iter():
+            return MetadataFile(writer.rp, 'r').get_objects()
+
+        read_rorps = list(metadata._iterate_in_process(get_iter))
+        self.assertEqual([rorp.index for rorp in read_rorps],
+                         [rorp.index for rorp in rorps])
+        for read_rorp, rorp in zip(read_rorps, rorps):
+            self.assertEqual(read_rorp.data, rorp.data)
+
+        def fail():
+            yield rorps[0]
+            raise ValueError("broken metadata")
+
+        meta_iter = metadata._iterate_in_process(fail)
+        self.assertEqual(next(meta_iter).index, rorps[0].index)
+        self.assertRaises(ValueError, next, meta_iter)
+
+        meta_iter = metadata._iterate_in_process(get_iter)
+        next(meta_iter)
+        meta_iter.close()  # the child ends and is waited for
+
+    def test_no_process_with_threads(self):
+        """Don't fork while other threads run"""
+        self.make_temp()
+        rp = tempdir.append("mirror_metadata.2005-12-03T14:54:06Z.snapshot")
+        rp.write_bytes(b"x" * metadata._process_min_size)
+        old_processes = Globals.metadata_processes
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        Globals.metadata_processes = True
+        thread.start()
+        try:
+            self.assertFalse(metadata._check_in_process([rp]))
+        finally:
+            stop.set()
+            thread.join()
+            Globals.metadata_processes = old_processes
+
+    def test_chain_cost(self):
+        """Extend chains of diffs as long as they are cheap enough"""
+        self.make_temp()
+        Globals.rbdir = tempdir
+        man = PatchDiffMan()
+        snapshot = rpath.RORPath((), {'type': 'reg', 'size': 1000})
+        small_diff = rpath.RORPath((), {'type': 'reg', 'size': 10})
+        large_diff = rpath.RORPath((), {'type': 'reg', 'size': 300})
+        self.assertTrue(man._check_chain_extensible(snapshot, []))
+        self.assertTrue(man._check_chain_extensible(snapshot,
+                                                    [small_diff] * 7))
+        # never longer than max_diff_chain, however cheap
+        self.assertFalse(man._check_chain_extensible(snapshot,
+                                                     [small_diff] * 8))
+        self.assertTrue(man._check_chain_extensible(snapshot,
+                                                    [large_diff] * 2))
+        self.assertFalse(man._check_chain_extensible(snapshot,
+                                                     [large_diff] * 3))
+
 
 if __name__ == "__main__":
     unittest.main()
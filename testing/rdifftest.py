@@ -1,8 +1,9 @@
 import unittest
 import random
 import os
+import hashlib
 from commontest import abs_test_dir, old_test_dir, abs_output_dir
-from rdiff_backup import Globals, Rdiff, rpath
+from rdiff_backup import Globals, Rdiff, rpath, librsync
 
 
 def MakeRandomFile(path):
@@ -148,6 +149,85 @@ class RdiffTest(unittest.TestCase):
         self.assertTrue(rpath.cmp(self.basis, self.new))
         list(map(rpath.RPath.delete, rplist))
 
+    def testRdiffSegments(self):
+        """Test signatures and deltas of files split in segments"""
+        rplist = [
+            self.basis, self.new, self.delta, self.signature, self.output
+        ]
+        for rp in rplist:
+            if rp.lstat():
+                rp.delete()
+
+        basis_data = os.urandom(300000)
+        self.basis.write_bytes(basis_data)
+        new_data = (basis_data[:100000] + os.urandom(20000)
+                    + basis_data[120000:])
+        self.new.write_bytes(new_data)
+        whole_sig = Rdiff.get_signature(self.basis).read()
+        old_workers = Globals.segment_workers
+        old_memory = Globals.segment_memory
+        Globals.set("segment_size", 50000)
+        Globals.set("segment_workers", 2)  # fewer than the segments
+        try:
+            sig_fp = Rdiff.get_signature(self.basis)
+            self.assertEqual(sig_fp.read(), whole_sig)
+            sig_fp.close()
+            self.signature.write_bytes(whole_sig)
+            memory = librsync.get_signature_memory()[0]
+            delta_fp = Rdiff.get_delta_sigrp_hash(self.signature, self.new)
+            report = self.delta.write_from_fileobj(delta_fp)
+            self.assertEqual(report.sha1_digest,
+                             hashlib.sha1(new_data).hexdigest())
+            self.assertTrue(self.delta.getsize() < 100000)
+            self.assertEqual(librsync.get_signature_memory()[0], memory)
+
+            # the memory allows fewer signatures than workers, but one
+            Globals.set("segment_memory", len(whole_sig) * 3 // 2)
+            self.assertEqual(Rdiff._get_segment_concurrency(len(whole_sig)),
+                             1)
+            Globals.set("segment_memory", 1)
+            self.assertEqual(Rdiff._get_segment_concurrency(len(whole_sig)),
+                             1)
+            delta_fp = Rdiff.get_delta_sigrp_hash(self.signature, self.new)
+            self.assertEqual(delta_fp.read(), self.delta.get_bytes())
+            delta_fp.close()
+        finally:
+            Globals.set("segment_size", 0)
+            Globals.set("segment_workers", old_workers)
+            Globals.set("segment_memory", old_memory)
+        Rdiff.patch_local(self.basis, self.delta, self.output)
+        self.assertTrue(rpath.cmp(self.new, self.output))
+        list(map(rpath.RPath.delete, rplist))
+
+    def testSegmentHasher(self):
+        """Test hashing a file from segments read out of order"""
+        if self.new.lstat():
+            self.new.delete()
+        data = os.urandom(100000)
+        self.new.write_bytes(data)
+        segments = Rdiff._get_segments(len(data), 30000)
+        hasher = Rdiff._SegmentHasher(self.new, segments)
+        files = [Rdiff._SegmentFile(self.new, *segment, hasher=hasher,
+                                    index=index)
+                 for index, segment in enumerate(segments)]
+        files[2].read(1000)
+        files[1].read()
+        files[1].read()  # completes the second segment
+        files[0].read(5000)
+        files[3].read()
+        files[0].read()
+        files[0].read()  # completes the first one and catches up
+        self.assertEqual(hasher.position, 61000)
+        files[2].read()  # hashed as read
+        self.assertEqual(hasher.position, 90000)
+        files[2].read()  # completes the third one and catches up
+        self.assertEqual(hasher.position, 100000)
+        for fileobj in files:
+            fileobj.close()
+        self.assertEqual(hasher.get_report().sha1_digest,
+                         hashlib.sha1(data).hexdigest())
+        self.new.delete()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import io
+import os
+import pickle
+from commontest import abs_test_dir
+from rdiff_backup import Globals, connection, iterfile, rorpcoding, rpath
+
+
+class RORPCodingTest(unittest.TestCase):
+    """Test the compact encoding of RORPaths"""
+
+    def setUp(self):
+        self.api_version = Globals.api_version["actual"]
+        Globals.api_version["actual"] = 201
+
+    def tearDown(self):
+        Globals.api_version["actual"] = self.api_version
+
+    def get_rorps(self):
+        """Return a list of RORPaths of the test directory, and odd ones"""
+        rorps = []
+        base_rp = rpath.RPath(Globals.local_connection, abs_test_dir)
+        for dirpath, dirnames, filenames in os.walk(abs_test_dir):
+            dirnames.sort()
+            for filename in [b"."] + sorted(filenames):
+                path = os.path.normpath(os.path.join(dirpath, filename))
+                index = tuple(os.path.relpath(path, abs_test_dir).split(b"/"))
+                rorps.append(base_rp.new_index(index).getRORPath())
+            if len(rorps) > 500:
+                break
+        rorps.append(rpath.RORPath((b"a", b"b")))
+        rorps.append(rpath.RORPath((b"a", ), {}))
+        rorps.append(rpath.RORPath((b"c", ), {
+            'type': 'weird', 'size': 1.5, 'mtime': 1 << 70, 'uname': None,
+            'gname': "g" * 300, 'ea': {b"user.a": b"b"}}))
+        rorps.append(rpath.RORPath((b"c", ), {
+            'type': 'reg', 'uname': "\udcff", 'gname': "root"}))
+        return rorps
+
+    def get_synthetic_rorps(self):
+        """Return a fixed list of RORPaths of a typical directory tree"""
+        rorps = []
+        for dir_num in range(10):
+            dir_index = (b"dir%03d" % dir_num, )
+            for file_num in range(-1, 20):
+                if file_num < 0:
+                    index, data = dir_index, {
+                        'type': 'dir', 'size': 4096, 'perms': 0o755}
+                else:
+                    index = dir_index + (b"file%03d.txt" % file_num, )
+                    data = {'type': 'reg', 'size': 1000 * file_num + 7,
+                            'perms': 0o644}
+                data.update({
+                    'uid': 1000, 'gid': 100, 'uname': "user",
+                    'gname': "users", 'inode': 100000 + len(rorps),
+                    'devloc': 2049, 'nlink': 1,
+                    'mtime': 1600000000 + 37 * len(rorps),
+                    'atime': 1600000000, 'ctime': 1600000000})
+                rorps.append(rpath.RORPath(index, data))
+        return rorps
+
+    def testRoundTrip(self):
+        """Test that decoded records are equal to the encoded ones"""
+        for rorps in (self.get_rorps(), self.get_synthetic_rorps()):
+            encoder = rorpcoding.RORPEncoder()
+            decoder = rorpcoding.RORPDecoder()
+            packed_len = pickled_len = 0
+            for i, rorp in enumerate(rorps):
+                packed = encoder.encode(rorp.index, rorp.data, i % 2)
+                packed_len += len(packed)
+                pickled_len += len(pickle.dumps(
+                    (rorp.index, rorp.data, i % 2), Globals.PICKLE_PROTOCOL))
+                self.assertEqual(decoder.decode(packed),
+                                 (rorp.index, rorp.data, bool(i % 2)))
+        # the size only depends on the rorps for the fixed ones
+        self.assertLess(packed_len, pickled_len * 2 / 3)
+        self.assertIsNone(encoder.encode(("not bytes", ), {}))
+
+    def testIterFile(self):
+        """Test that RORPaths are packed through iterators if supported"""
+        rorps = self.get_rorps()
+        buf = iterfile.MiscIterToFile(iter(rorps)).read()
+        self.assertEqual(buf[0:1], b"p")
+        self.assertEqual(list(iterfile.FileToMiscIter(io.BytesIO(buf))),
+                         rorps)
+
+        Globals.api_version["actual"] = 200
+        buf = iterfile.MiscIterToFile(iter(rorps)).read()
+        self.assertEqual(buf[0:1], b"r")
+        self.assertEqual(list(iterfile.FileToMiscIter(io.BytesIO(buf))),
+                         rorps)
+
+    def testConnection(self):
+        """Test sending single RORPaths through a connection"""
+        for api_version, format_char in ((201, b"p"), (200, b"r")):
+            Globals.api_version["actual"] = api_version
+            for rorp in self.get_rorps():
+                outpipe = io.BytesIO()
+                conn = connection.LowLevelPipeConnection(None, outpipe)
+                conn._put(rorp, 1)
+                self.assertEqual(outpipe.getvalue()[0:1], format_char)
+                conn.inpipe = io.BytesIO(outpipe.getvalue())
+                self.assertEqual(conn._get(), (1, rorp))
+
+
+if __name__ == "__main__":
+    unittest.main()
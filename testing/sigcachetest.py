@@ -0,0 +1,112 @@
+import unittest
+import os
+import time
+from commontest import abs_test_dir, re_init_subdir, InternalBackup, \
+    InternalRestore, compare_recursive
+from rdiff_backup import Globals, Rdiff, rpath, sigcache
+
+
+class SigCacheTest(unittest.TestCase):
+    """Test the persistent cache of mirror signatures"""
+    lc = Globals.local_connection
+
+    def setUp(self):
+        self.base_dir = re_init_subdir(abs_test_dir, b"sigcache")
+        self.cache_rp = rpath.RPath(
+            self.lc, os.path.join(self.base_dir, b"signatures"))
+        self.cache_rp.mkdir()
+        self.cache = sigcache.SigCache(self.cache_rp)
+
+    def write_mirror(self, index, data):
+        """Write data to the mirror file of index through the cache"""
+        mirror_rp = rpath.RPath(self.lc, self.base_dir, index)
+        src_rp = rpath.RPath(self.lc, self.base_dir, (b"source", ))
+        if src_rp.lstat():
+            src_rp.delete()
+        src_rp.write_bytes(data)
+        tf = mirror_rp.get_temp_rpath(sibling=True)
+        tf.write_from_fileobj(
+            self.cache.wrap(index, src_rp.open("rb"), len(data)))
+        rpath.rename(tf, mirror_rp)
+        self.cache.update(index, mirror_rp)
+        return mirror_rp
+
+    def testRoundtrip(self):
+        """Cached signature must be the one of the mirror file"""
+        mirror_rp = self.write_mirror((b"file", ), os.urandom(300000))
+        sig_fp = self.cache.get_signature(mirror_rp)
+        self.assertIsNotNone(sig_fp)
+        with sig_fp:
+            self.assertEqual(sig_fp.read(),
+                             Rdiff.get_signature(mirror_rp).read())
+
+    def testOutdated(self):
+        """Signature of a changed mirror file must not be used"""
+        mirror_rp = self.write_mirror((b"file", ), os.urandom(3000))
+        time.sleep(0.01)
+        with open(mirror_rp.path, "r+b") as fp:
+            fp.write(b"changed")
+        mirror_rp.setdata()
+        self.assertIsNone(self.cache.get_signature(mirror_rp))
+        self.assertIsNone(self.cache.get_signature(mirror_rp))
+
+    def testFormatChange(self):
+        """Signature in another format than the current must not be used"""
+        mirror_rp = self.write_mirror((b"file", ), os.urandom(3000))
+        Globals.set("signature_format", "blake2")
+        try:
+            self.assertIsNone(self.cache.get_signature(mirror_rp))
+        finally:
+            Globals.set("signature_format", None)
+
+    def testDiscard(self):
+        """Discarded signatures must neither be used nor leave files"""
+        index = (b"file", )
+        mirror_rp = self.write_mirror(index, b"first version")
+        src_rp = rpath.RPath(self.lc, self.base_dir, (b"source", ))
+        tf = mirror_rp.get_temp_rpath(sibling=True)
+        tf.write_from_fileobj(self.cache.wrap(index, src_rp.open("rb"), 13))
+        tf.delete()
+        self.cache.discard(index)
+        sig_fp = self.cache.get_signature(mirror_rp)
+        self.assertIsNotNone(sig_fp)
+        sig_fp.close()
+        self.cache.update(index, mirror_rp)  # as if mirror was deleted
+        self.assertIsNone(self.cache.get_signature(mirror_rp))
+        for dirpath, dirnames, filenames in os.walk(self.cache_rp.path):
+            self.assertEqual(filenames, [])
+
+    def testBackup(self):
+        """Test incremental backups using cached signatures"""
+        src_rp = rpath.RPath(self.lc, os.path.join(self.base_dir, b"src"))
+        src_rp.mkdir()
+        src_rp.append("big").write_bytes(os.urandom(500000))
+        src_rp.append("small").write_bytes(b"small file")
+        dest_dir = os.path.join(self.base_dir, b"dest")
+        restore_dir = os.path.join(self.base_dir, b"restore")
+        Globals.set("signature_cache", 1)
+        try:
+            InternalBackup(1, 1, src_rp.path, dest_dir, 10000)
+            big_path = src_rp.append("big").path
+            with open(big_path, "r+b") as fp:
+                fp.seek(200000)
+                fp.write(b"changed" * 100)
+            os.utime(big_path, (15000, 15000))
+            InternalBackup(1, 1, src_rp.path, dest_dir, 20000)
+        finally:
+            Globals.set("signature_cache", None)
+        dest_cache = sigcache.SigCache(rpath.RPath(
+            self.lc, dest_dir, (b"rdiff-backup-data", b"signatures")))
+        sig_fp = dest_cache.get_signature(
+            rpath.RPath(self.lc, dest_dir, (b"big", )))
+        self.assertIsNotNone(sig_fp)
+        sig_fp.close()
+        InternalRestore(1, 1, dest_dir, restore_dir, 20000)
+        restore_rp = rpath.RPath(self.lc, restore_dir)
+        self.assertTrue(compare_recursive(src_rp, restore_rp))
+        self.assertTrue(rpath.cmp(src_rp.append("big"),
+                                  restore_rp.append("big")))
+
+
+if __name__ == "__main__":
+    unittest.main()
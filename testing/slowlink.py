@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""slowlink.py
+
+Runs a command and relays its standard input and output with the given
+one-way latency, bandwidth cap, jitter and window, so that a local pipe
+behaves like a slower network link.  It is meant to be used as (part of) the
+remote schema, e.g.:
+
+    rdiff-backup --remote-schema 'slowlink.py --latency 0.05 {h}' \\
+        backup /some/dir 'rdiff-backup --server::/some/repo'
+
+Data keeps its order, as over a TCP connection, so jitter delays the
+data following a late chunk as well.  As with a full TCP window, no more
+is read from the sender while a window of bytes hasn't been delivered.
+"""
+
+import argparse
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# size of the chunks read from either side
+CHUNK_SIZE = 65536
+
+
+class Link:
+    """One direction of a simulated link, relaying data from one fd to another
+
+    A reader thread timestamps each chunk with the time it would arrive at
+    the other end, and the relaying thread writes it once that time has
+    come, so that reading isn't throttled by the delay.  The reader only
+    reads as much as the window leaves free of bytes in flight, i.e. read
+    but not yet written, so that the sender blocks when it is full.
+
+    """
+
+    def __init__(self, in_fd, out_fd, latency=0.0, bandwidth=0, jitter=0.0,
+                 window=0):
+        """Relay from in_fd to out_fd, bandwidth in bytes per second, 0 for
+        no cap, latency and jitter in seconds, window in bytes, 0 for no
+        limit"""
+        self.in_fd = in_fd
+        self.out_fd = out_fd
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.window = window
+        self.queue = queue.Queue()
+        self.in_flight = 0  # bytes read but not yet written
+        self.window_free = threading.Condition()
+        self.free_time = 0.0  # when the link has sent the previous chunk
+        self.last_due = 0.0  # when the previous chunk arrives
+
+    def start(self):
+        """Start relaying and return the relaying thread"""
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+        relay = threading.Thread(target=self._relay, daemon=True)
+        relay.start()
+        return relay
+
+    def _get_due(self, length, now):
+        """Return the time when a chunk of given length read now arrives"""
+        if self.bandwidth:
+            self.free_time = (max(now, self.free_time)
+                              + length / self.bandwidth)
+            sent = self.free_time
+        else:
+            sent = now
+        due = sent + self.latency
+        if self.jitter:
+            due += random.uniform(0, self.jitter)
+        self.last_due = max(due, self.last_due)
+        return self.last_due
+
+    def _read(self):
+        """Read chunks and queue them with their arrival time"""
+        while True:
+            try:
+                data = os.read(self.in_fd, self._wait_window())
+            except OSError:
+                data = b""
+            with self.window_free:
+                self.in_flight += len(data)
+            self.queue.put((self._get_due(len(data), time.monotonic()),
+                            data))
+            if not data:
+                return
+
+    def _wait_window(self):
+        """Wait for the window to have room, return how much may be read"""
+        if not self.window:
+            return CHUNK_SIZE
+        with self.window_free:
+            while self.in_flight >= self.window:
+                self.window_free.wait()
+            return min(CHUNK_SIZE, self.window - self.in_flight)
+
+    def _relay(self):
+        """Write the queued chunks once they are due, close at the end"""
+        while True:
+            due, data = self.queue.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                break
+            length = len(data)
+            try:
+                while data:
+                    data = data[os.write(self.out_fd, data):]
+            except OSError:  # the other end is gone, drop the rest
+                break
+            with self.window_free:
+                self.in_flight -= length
+                self.window_free.notify()
+        os.close(self.out_fd)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Run a command over a simulated slow link.")
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="one-way delay in seconds (default: 0)")
+    parser.add_argument(
+        "--bandwidth", type=int, default=0,
+        help="bandwidth in bytes per second and direction (default: 0, "
+             "unlimited)")
+    parser.add_argument(
+        "--jitter", type=float, default=0.0,
+        help="maximum random additional delay in seconds (default: 0)")
+    parser.add_argument(
+        "--window", type=int, default=262144,
+        help="maximum bytes in flight per direction, the sender blocking "
+             "once they are reached (default: 262144, 0 for unlimited)")
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER,
+        help="the shell command to run, e.g. 'rdiff-backup --server'")
+    values = parser.parse_args(args)
+    if not values.command:
+        parser.error("a command to run is required")
+    return values
+
+
+def main(args):
+    values = parse_args(args)
+    process = subprocess.Popen(" ".join(values.command), shell=True,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               bufsize=0)
+    link_args = (values.latency, values.bandwidth, values.jitter,
+                 values.window)
+    Link(sys.stdin.fileno(), os.dup(process.stdin.fileno()),
+         *link_args).start()
+    process.stdin.close()
+    back_link = Link(os.dup(process.stdout.fileno()), sys.stdout.fileno(),
+                     *link_args).start()
+    process.stdout.close()
+    back_link.join()
+    return process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))